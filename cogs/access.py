@@ -1,15 +1,15 @@
 from discord.commands import SlashCommandGroup, ApplicationContext, Option
 from discord.ext import commands
 
-from util import guilds, mkembed
+from util import get_hive, guilds, mkembed
 from util.access_utils import (
     grant_access,
     revoke_access,
     has_access,
-    accesslist_to_dronelist,
-    get_drone_hive_owner,
+    access_list,
+    controlled_drones,
 )
-from util.storage import get_drone
+from util.storage import aget_drone, aget_drones
 
 
 class Access(commands.Cog):
@@ -19,7 +19,7 @@ class Access(commands.Cog):
 
     def __init__(self, bot):
         self.bot = bot
-        bot.logger.info("access v1.0 ready")
+        bot.logger.info("access v1.1 ready")
 
     @accessgrp.command(
         name="add", description="Add a drone to another drone's access list", guild_ids=guilds
@@ -30,15 +30,15 @@ class Access(commands.Cog):
         drone: Option(str, description="Drone ID to add", required=True),
         target: Option(str, description="Drone to modify (yourself if blank)", required=False),
     ):
-        operator = get_drone(ctx.author.id)
+        operator = await aget_drone(ctx.author.id)
         if not operator:
             await ctx.respond(embed=mkembed("error", "`You do not appear to be a drone.`"))
             return
-        target_drone = get_drone(target) if target else operator
+        target_drone = await aget_drone(target) if target else operator
         if not target_drone:
             await ctx.respond(embed=mkembed("error", f"{target} does not appear to be a drone."))
             return
-        to_add_drone = get_drone(drone)
+        to_add_drone = await aget_drone(drone)
         if not to_add_drone:
             await ctx.respond(embed=mkembed("error", f"{drone} does not appear to be a drone."))
             return
@@ -52,7 +52,7 @@ class Access(commands.Cog):
             )
             return
         else:
-            r = grant_access(to_add_drone, target_drone)
+            r = await grant_access(to_add_drone, target_drone)
             if not r:
                 await ctx.respond(
                     embed=mkembed(
@@ -77,15 +77,15 @@ class Access(commands.Cog):
         drone: Option(str, description="Drone ID to remove", required=True),
         target: Option(str, description="Drone to modify (yourself if blank)", required=False),
     ):
-        operator = get_drone(ctx.author.id)
+        operator = await aget_drone(ctx.author.id)
         if not operator:
             await ctx.respond(embed=mkembed("error", "`You do not appear to be a drone.`"))
             return
-        target_drone = get_drone(target) if target else operator
+        target_drone = await aget_drone(target) if target else operator
         if not target_drone:
             await ctx.respond(embed=mkembed("error", f"{target} does not appear to be a drone."))
             return
-        to_rm_drone = get_drone(drone)
+        to_rm_drone = await aget_drone(drone)
         if not to_rm_drone:
             await ctx.respond(embed=mkembed("error", f"{drone} does not appear to be a drone."))
             return
@@ -99,7 +99,7 @@ class Access(commands.Cog):
             )
             return
         else:
-            r = revoke_access(to_rm_drone, target_drone)
+            r = await revoke_access(to_rm_drone, target_drone)
             if not r:
                 await ctx.respond(
                     embed=mkembed(
@@ -121,11 +121,11 @@ class Access(commands.Cog):
         ctx: ApplicationContext,
         target: Option(str, description="Drone to check (yourself if blank)", required=False),
     ):
-        operator = get_drone(ctx.author.id)
+        operator = await aget_drone(ctx.author.id)
         if not operator:
             await ctx.respond(embed=mkembed("error", "`You do not appear to be a drone.`"))
             return
-        target_drone = get_drone(target) if target else operator
+        target_drone = await aget_drone(target) if target else operator
         if not target_drone:
             await ctx.respond(embed=mkembed("error", f"{target} does not appear to be a drone."))
             return
@@ -138,9 +138,9 @@ class Access(commands.Cog):
             )
             return
         else:
-            al: [int] = target_drone["access"]
-            al.append(int(get_drone_hive_owner(target_drone)["discordid"]))
-            drones = accesslist_to_dronelist(al)
+            al: [int] = access_list(target_drone)
+            al.append(get_hive(target_drone["hive"])["owner"])
+            drones = await aget_drones(al)
             drones_fmt = [f"{d.droneid} " for d in drones]
             res = (
                 f"```{operator.droneid}@droneOS $ ls /dev/{target_drone.droneid}/access\n"
@@ -148,6 +148,23 @@ class Access(commands.Cog):
             )
             await ctx.respond(res)
 
+    @accessgrp.command(
+        name="controlled",
+        description="Show the drones you are on the access list of",
+        guild_ids=guilds,
+    )
+    async def ls_controlled(self, ctx: ApplicationContext):
+        operator = await aget_drone(ctx.author.id)
+        if not operator:
+            await ctx.respond(embed=mkembed("error", "`You do not appear to be a drone.`"))
+            return
+        drones_fmt = [f"{d.droneid} " for d in controlled_drones(operator)]
+        res = (
+            f"```{operator.droneid}@droneOS $ grep -l {operator.droneid} /dev/*/access\n"
+            f"{''.join(drones_fmt)}```"
+        )
+        await ctx.respond(res)
+
 
 def setup(bot):
     bot.add_cog(Access(bot))
@@ -0,0 +1,49 @@
+from discord.commands import SlashCommandGroup, ApplicationContext, Option, permissions
+from discord.ext import commands
+
+from util import guilds, mkembed, storage_profile
+
+
+class Admin(commands.Cog):
+    storagegrp = SlashCommandGroup(
+        name="storage", description="Storage diagnostics", guild_ids=guilds
+    )
+
+    def __init__(self, bot):
+        self.bot = bot
+        bot.logger.info("admin v1.0 ready")
+
+    @storagegrp.command(
+        name="profile",
+        description="Show what storage calls each command and message makes",
+        guild_ids=guilds,
+        default_permission=False,
+        permissions=[permissions.has_role("Director")],
+    )
+    async def profile(
+        self,
+        ctx: ApplicationContext,
+        reset: Option(bool, description="Start counting again afterwards", default=False),
+    ):
+        profiler = storage_profile.profiler
+        if profiler is None:
+            await ctx.respond(
+                embed=mkembed(
+                    "error", "```Storage profiling is off, set storage.profile in config.yml```"
+                ),
+                ephemeral=True,
+            )
+            return
+        text = "\n".join(profiler.summary())
+        self.bot.logger.info(text)
+        if len(text) > 4000:
+            text = text[:3990] + "\n..."
+        await ctx.respond(
+            embed=mkembed("info", f"```{text}```", title="Storage profile"), ephemeral=True
+        )
+        if reset:
+            profiler.reset()
+
+
+def setup(bot):
+    bot.add_cog(Admin(bot))
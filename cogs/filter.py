@@ -1,12 +1,33 @@
-import re
+import asyncio
+from typing import List, Optional, Tuple
 
 import discord
-from discord.commands import SlashCommandGroup, permissions, ApplicationContext
+from discord.commands import SlashCommandGroup, permissions, ApplicationContext, Option
 from discord.ext import commands
 
-from util import guilds, mkembed, hivemap, aget, filters
-from util.filter_utils import reply_builder, get_drone_webhook, format_code
-from util.storage import RegisteredDrone, get_drone, get_channel
+import util
+from util import guilds, log, metrics, mkembed, storage_profile
+from util.delete_batcher import DeleteBatcher
+from util.dispatch import ChannelDispatcher
+from util.webhook_sender import WebhookSender
+from util.workers import FilterRecord, FilterWorkers
+from util.filter_utils import (
+    reply_builder,
+    get_drone_webhooks,
+    refresh_drone_webhooks,
+    set_drone_webhooks,
+    forget_drone_webhooks,
+    warm_drone_webhooks,
+    is_active,
+    set_channel_locked,
+    decide,
+    relay_content,
+    Action,
+    WEBHOOK_NAME,
+    MAX_WEBHOOKS,
+)
+from util.lock_utils import CHANNEL_LOCK_KEYS
+from util.storage import RegisteredDrone, DroneChannel, Storage, aget_drone, aget_channel
 
 
 class Filter(commands.Cog):
@@ -16,7 +37,44 @@ class Filter(commands.Cog):
 
     def __init__(self, bot):
         self.bot = bot
-        bot.logger.info("filter v2.13 ready")
+        system = util.config.get("system", {})
+        self.workers = None
+        if system.get("filter_processes"):
+            self.workers = FilterWorkers(
+                system["filter_processes"],
+                system["bot_token"],
+                logger=bot.logger,
+                log_level=system.get("log_level", "INFO"),
+                log_format=system.get("log_format", "text"),
+                log_rate=system.get("log_rate", 5),
+                reload_interval=system.get("reload_interval", 5),
+            )
+            self.workers.start()
+            bot.atclose.append(self.workers.stop)
+        self.handler = self.forward_handler if self.workers else self.drone_filter_handler
+        self.dispatcher = ChannelDispatcher(
+            self.handle,
+            workers=system.get("filter_workers", 4),
+            logger=bot.logger,
+            on_error=lambda msg: bot.on_error("drone_filter_handler", msg),
+        )
+        self.sender = WebhookSender(logger=bot.logger)
+        bot.atclose.append(self.sender.close)
+        self.enforce_log = log.enforcement_logger(bot.logger, system.get("log_rate", 5))
+        self.warmed_shards = set()
+        self.deleter = DeleteBatcher(window=system.get("delete_window", 0.3), logger=bot.logger)
+        metrics.queue_depth.fn = self.dispatcher.depth
+        metrics.throttled_seconds.fn = lambda: self.sender.throttled
+        metrics.rate_limited.fn = lambda: self.sender.rate_limited
+        metrics.deletes.fn = lambda: {("bulk",): self.deleter.bulk, ("single",): self.deleter.single}
+        bot.logger.info("filter v2.21 ready")
+
+    def cog_unload(self):
+        self.dispatcher.stop()
+        if self.workers:
+            asyncio.ensure_future(self.workers.stop())
+        asyncio.ensure_future(self.deleter.flush())
+        asyncio.ensure_future(self.sender.close())
 
     @filtergrp.command(
         name="enable_here",
@@ -25,9 +83,20 @@ class Filter(commands.Cog):
         default_permission=False,
         permissions=[permissions.has_role("Director")],
     )
-    async def enable_here(self, ctx: ApplicationContext):
+    async def enable_here(
+        self,
+        ctx: ApplicationContext,
+        webhooks: Option(
+            int,
+            description="Webhooks to relay through, more for busy channels",
+            min_value=1,
+            max_value=MAX_WEBHOOKS,
+            default=1,
+        ),
+    ):
         await ctx.defer()
-        if await get_drone_webhook(ctx.channel):
+        hooks = await get_drone_webhooks(ctx.channel)
+        if len(hooks) >= webhooks:
             await ctx.respond(
                 embed=mkembed(
                     "error", f"```Drone speech optimizations already active in {ctx.channel.name}```"
@@ -35,13 +104,18 @@ class Filter(commands.Cog):
             )
             return
         else:
-            await ctx.channel.create_webhook(
-                name="Drone speech optimization", reason=f"enabled by {ctx.author.name}"
-            )
+            for _ in range(webhooks - len(hooks)):
+                hooks.append(
+                    await ctx.channel.create_webhook(
+                        name=WEBHOOK_NAME, reason=f"enabled by {ctx.author.name}"
+                    )
+                )
+            set_drone_webhooks(ctx.channel.id, hooks)
             await ctx.respond(
                 embed=mkembed(
                     "done",
-                    description=f"```Drone speech optimizations activated in {ctx.channel.name}```",
+                    description=f"```Drone speech optimizations activated in {ctx.channel.name} "
+                    f"({len(hooks)} webhooks)```",
                 )
             )
             return
@@ -53,9 +127,11 @@ class Filter(commands.Cog):
     )
     async def disable_here(self, ctx: ApplicationContext):
         await ctx.defer()
-        h = await get_drone_webhook(ctx.channel)
-        if h:
-            await h.delete(reason=f"disabled by {ctx.author.name}")
+        hooks = await get_drone_webhooks(ctx.channel)
+        if hooks:
+            for h in hooks:
+                await h.delete(reason=f"disabled by {ctx.author.name}")
+            set_drone_webhooks(ctx.channel.id, [])
             await ctx.respond(
                 embed=mkembed(
                     "done",
@@ -71,133 +147,132 @@ class Filter(commands.Cog):
             )
             return
 
+    async def warm_guilds(self, guilds):
+        for g in guilds:
+            try:
+                await warm_drone_webhooks(g)
+            except discord.HTTPException as e:
+                self.bot.logger.warning(
+                    f"webhook registry: can't list webhooks in {g}, filling lazily ({e})"
+                )
+
     @commands.Cog.listener()
-    async def on_message(self, msg: discord.Message):
-        if not msg.content:
-            return
-        if msg.author.bot:
-            return
-        h = await get_drone_webhook(msg.channel)
-        if h:
-            await self.drone_filter_handler(msg, h)
+    async def on_shard_ready(self, shard_id: int):
+        # Each shard warms its own guilds as soon as it's up, instead of every guild waiting for the last shard.
+        self.warmed_shards.add(shard_id)
+        await self.warm_guilds(g for g in self.bot.guilds if g.shard_id == shard_id)
 
-    async def drone_filter_handler(self, msg: discord.Message, hook: discord.Webhook):
-        attempted_chat = aget(re.findall(r"^([A-z0-9]{4}) :: (.*)", msg.content), 0, [])
-        attempted_droneid = aget(attempted_chat, 0, None)
-        attempted_content = aget(attempted_chat, 1, None)
+    @commands.Cog.listener()
+    async def on_ready(self):
+        for c in await Storage.afilter(DroneChannel, {}):
+            conf = c.get("config", {})
+            set_channel_locked(c["discordid"], any(conf.get(k) for k in CHANNEL_LOCK_KEYS))
+        await self.warm_guilds(g for g in self.bot.guilds if g.shard_id not in self.warmed_shards)
 
-        db_drone = get_drone(msg.author.id)
+    @commands.Cog.listener()
+    async def on_webhooks_update(self, channel):
+        try:
+            await refresh_drone_webhooks(channel)
+        except discord.HTTPException as e:
+            self.bot.logger.warning(f"webhook registry: refresh failed for {channel}: {e}")
+            forget_drone_webhooks(channel.id)
 
-        if db_drone and db_drone.get("config", {}).get("ssh", False) is not False:
-            d = get_drone(db_drone["config"]["ssh"])
-            msg.author = msg.guild.get_member(d.discordid)
-            await self.send_as_drone(d, hook, msg)
+    @commands.Cog.listener()
+    async def on_message(self, msg: discord.Message):
+        if not is_active(msg.channel.id):
             return
-
-        if attempted_droneid and not attempted_content:
-            # Malformed attempt, yeet it.
-            self.bot.logger.info(f"Malformed delete: {msg}")
-            await msg.delete()
+        if not msg.content:
             return
-
-        # Is the channel locked to enforce mode?
-        db_channel = (
-            get_channel({"discordid": msg.channel.id}) or {}
-        )  # Use an empty dict for easier .get
-        chan_conf = db_channel.get("config", {})
-        if chan_conf.get("enforcedrones"):  # All registered drones must use speech opt
-            if db_drone:
-                if not attempted_droneid and not attempted_content:
-                    self.bot.logger.info(f"Chan enforcedrone delete: {msg}")
-                    await msg.delete()
-                    return
-                else:
-                    await self.send_as_drone(db_drone, hook, msg)
-                    await msg.delete()
-                    return
-
-        if chan_conf.get("enforceall"):
-            if not attempted_droneid:  # Only drones may speak
-                self.bot.logger.info(f"Chan Enforceall delete: {msg}")
-                await msg.delete()
-                return
-
-        # If a non-drone uses a prefix, just bail.
-        if not db_drone:
+        if msg.author.bot:
             return
+        # Queued per channel so relays go out in the order they were sent
+        self.dispatcher.submit(msg.channel.id, msg)
 
-        # Is the drone locked to enforce mode?
-        drone_conf = db_drone.get("config", {})
-        if drone_conf.get("enforce"):
-            if not attempted_droneid and not attempted_content:
-                self.bot.logger.info(f"Drone enforce delete: {msg}")
-                await msg.delete()
-                return
-            else:
-                await self.send_as_drone(db_drone, hook, msg)
-                await msg.delete()
-                return
+    async def lookup(self, msg: discord.Message) -> Tuple[Optional[dict], Optional[dict], dict]:
+        """Returns the author's drone record, the drone they're in direct control of and the channel's config."""
+        with metrics.stage("get_drone"):
+            db_drone = await aget_drone(msg.author.id)
+            ssh_drone = None
+            if db_drone and db_drone.get("config", {}).get("ssh", False) is not False:
+                ssh_drone = await aget_drone(db_drone["config"]["ssh"])
+        with metrics.stage("get_channel"):
+            db_channel = (
+                await aget_channel({"discordid": msg.channel.id}) or {}
+            )  # Use an empty dict for easier .get
+        return db_drone, ssh_drone, db_channel.get("config", {})
 
-        if not attempted_droneid:
-            return
+    async def handle(self, msg: discord.Message):
+        # Looked up in the channel's queue, so two messages can't overtake each other while a channel's webhooks are
+        # fetched for the first time.
+        with metrics.stage("webhook_lookup"):
+            hooks = await get_drone_webhooks(msg.channel)
+        if hooks:
+            with storage_profile.scope("message"):
+                await self.handler(msg, hooks)
 
-        # Is the drone using their own prefix?
-        if attempted_droneid and db_drone["droneid"] != attempted_droneid:
-            self.bot.logger.info(
-                f"Wrong prefix delete: got {attempted_droneid}, should be {db_drone['droneid']}"
+    async def forward_handler(self, msg: discord.Message, hooks: List[discord.Webhook]):
+        """Does the lookups for `msg` here and hands the rest of drone_filter_handler to a worker process."""
+        db_drone, ssh_drone, chan_conf = await self.lookup(msg)
+        ssh_member = msg.guild.get_member(ssh_drone["discordid"]) if ssh_drone else None
+        with metrics.stage("reply_builder"):
+            reply_embed = await reply_builder(msg)
+        self.workers.submit(
+            FilterRecord(
+                channel_id=msg.channel.id,
+                message_id=msg.id,
+                content=msg.content,
+                author_name=msg.author.nick or msg.author.name,
+                avatar_url=msg.author.avatar.url,
+                drone=dict(db_drone.attributes) if db_drone else None,
+                ssh_drone=dict(ssh_drone.attributes) if ssh_drone else None,
+                ssh_name=(ssh_member.nick or ssh_member.name) if ssh_member else None,
+                ssh_avatar=ssh_member.avatar.url if ssh_member else None,
+                channel_conf=dict(chan_conf),
+                reply=reply_embed.to_dict() if reply_embed else None,
+                hooks=[(h.id, h.token) for h in hooks],
             )
-            await msg.delete()
-            return
+        )
 
-        await self.send_as_drone(db_drone, hook, msg)
-        return
+    async def drone_filter_handler(self, msg: discord.Message, hooks: List[discord.Webhook]):
+        db_drone, ssh_drone, chan_conf = await self.lookup(msg)
+        decision = decide(msg.content, db_drone, chan_conf, ssh_drone)
+        if decision.action is Action.DELETE:
+            if decision.detail:
+                self.enforce_log.info("%s: %s, %s", decision.reason, decision.detail, msg)
+            else:
+                self.enforce_log.info("%s: %s", decision.reason, msg)
+            self.deleter.delete(msg)
+        elif decision.action is Action.REDIRECT:
+            author = msg.guild.get_member(decision.drone.discordid)
+            await self.send_as_drone(decision.drone, hooks, msg, author)
+        elif decision.action is Action.RELAY:
+            await self.send_as_drone(decision.drone, hooks, msg)
+        # Counted once it's done: a throttled relay raises out of send_as_drone and is handled again later
+        metrics.handled.inc(decision.action.value, db_drone["hive"] if db_drone else "none")
 
     async def send_as_drone(
-        self, drone: RegisteredDrone, hook: discord.Webhook, msg: discord.Message
+        self,
+        drone: RegisteredDrone,
+        hooks: List[discord.Webhook],
+        msg: discord.Message,
+        author: Optional[discord.Member] = None,
     ):
-        droneid = drone["droneid"]
-        hivesym = hivemap[drone["hive"]]["sym"]
-        content = msg.content.replace(f"{droneid} :: ", "")
-        code = format_code(content, drone)
-
-        if aget(code, 0, None):
-            content = content.replace(code[1], "")
-        content = await self.handle_filter(content, drone)
-
-        # This list can be thought of as the 'fields' in a drone message.
-        content_list = [droneid, hivesym, code[0], content]
-        content_list = list(
-            filter(None, content_list)
-        )  # Strip Nones so we construct the output correctly
-
-        reply_embed = await reply_builder(msg)  # Populate a reply embed if necessary
-
-        out_content = ""
-        for i, v in enumerate(content_list):
-            if v:
-                out_content += f"{v} :: " if i < len(content_list) - 1 else f"{v}"
-
-        await hook.send(
-            username=msg.author.nick or msg.author.name,
-            content=out_content,
-            avatar_url=msg.author.avatar.url,
-            embed=reply_embed,
-        )
-        await msg.delete()
+        """Relays `msg` as `drone`, under the name and avatar of `author` (the message's author by default)."""
+        author = author or msg.author
+        with metrics.stage("reply_builder"):
+            reply_embed = await reply_builder(msg)  # Populate a reply embed if necessary
+        content = relay_content(drone, msg.content)
+        with metrics.stage("send"):
+            await self.sender.send(
+                self.sender.pick(hooks),
+                username=author.nick or author.name,
+                content=content,
+                avatar_url=author.avatar.url,
+                embed=reply_embed,
+            )
+        self.deleter.delete(msg)
         return
 
-    @staticmethod
-    async def handle_filter(content: str, drone: RegisteredDrone) -> str:
-        filt: dict = filters.get(drone["hive"], filters["lapine/unaffiliated"])
-        cs = content.split(" ")
-        for i, v in enumerate(cs):
-            rex = aget(re.findall(r"([\w\']+)(\W?)", v), 0, [])
-            word = aget(rex, 0, None)
-            punc = aget(rex, 1, None)
-            if word and word.strip() in filt.keys():
-                cs[i] = filt[word] + punc if punc else filt[word]
-        return " ".join(cs)
-
 
 def setup(bot):
     bot.add_cog(Filter(bot))
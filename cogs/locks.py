@@ -1,11 +1,14 @@
+import asyncio
+
 import discord
 from discord.commands import SlashCommandGroup, ApplicationContext, Option
-from discord.ext import commands, tasks
+from discord.ext import commands
 
 from util import guilds, mkembed
 from util.access_utils import get_command_drones
-from util.storage import get_channel, DroneChannel, RegisteredDrone, Storage
-from util.filter_utils import get_drone_webhook
+from util.storage import aget_channel, aget_drone, DroneChannel, Storage
+from util.filter_utils import get_drone_webhook, set_channel_locked
+from util.lock_utils import ExpiryScheduler, CHANNEL_LOCK_KEYS, lock_deadline
 from datetime import datetime
 
 
@@ -14,7 +17,30 @@ class Locks(commands.Cog):
 
     def __init__(self, bot):
         self.bot = bot
-        bot.logger.info("locks v1.0 ready")
+        self.expiry = ExpiryScheduler(self.expire_lock, bot.logger)
+        self.expiry.start()
+        asyncio.ensure_future(self.schedule_stored_locks())
+        bot.logger.info("locks v1.2 ready")
+
+    def cog_unload(self):
+        self.expiry.stop()
+
+    async def schedule_stored_locks(self):
+        """Re-registers every timed lock in storage with the expiry scheduler. Locks that ran out while we were
+        offline are due immediately."""
+        for d in list(Storage.drones.by_discordid.values()):
+            deadline = lock_deadline(d.get("config", {}).get("enforce"))
+            if deadline:
+                self.expiry.schedule(("drone", d["discordid"]), deadline)
+        chans = await Storage.afilter(
+            DroneChannel, {"$or": [{f"config.{k}": {"$gt": 0}} for k in CHANNEL_LOCK_KEYS]}
+        )
+        for c in chans:
+            for k in CHANNEL_LOCK_KEYS:
+                deadline = lock_deadline(c.get("config", {}).get(k))
+                if deadline:
+                    self.expiry.schedule(("channel", c["discordid"]), deadline)
+        self.bot.logger.info(f"locks: {len(self.expiry)} timed locks scheduled")
 
     @locksgrp.command(
         name="prefix-on", description="Lock the specified drone into prefix chat", guild_ids=guilds
@@ -43,7 +69,11 @@ class Locks(commands.Cog):
         else:
             target["config"] = {}
             target["config"]["enforce"] = locktime or True
-        Storage.backend.save(target)
+        await Storage.asave(target)
+        if locktime:
+            self.expiry.schedule(("drone", target["discordid"]), locktime)
+        else:
+            self.expiry.cancel(("drone", target["discordid"]))
         msgtime = f" for {duration} seconds" if duration else ""
         await ctx.respond(
             embed=mkembed(
@@ -74,7 +104,8 @@ class Locks(commands.Cog):
         else:
             target["config"] = {}
             target["config"]["enforce"] = False
-        Storage.backend.save(target)
+        await Storage.asave(target)
+        self.expiry.cancel(("drone", target["discordid"]))
         await ctx.respond(
             embed=mkembed("done", f'`Drone {target["droneid"]} prefix mode unlocked.`')
         )
@@ -90,10 +121,11 @@ class Locks(commands.Cog):
         ctx: ApplicationContext,
         lockall: Option(bool, description="Allow ONLY drones to speak", default=False),
         channel: Option(discord.TextChannel, required=False),
+        duration: Option(float, description="Seconds to set this lock for", required=False),
     ):
         await ctx.defer()
         chan = channel or ctx.channel
-        db_chan = get_channel({"discordid": chan.id})
+        db_chan = await aget_channel({"discordid": chan.id})
         if not db_chan:
             if not await get_drone_webhook(chan):
                 await ctx.respond(
@@ -103,12 +135,19 @@ class Locks(commands.Cog):
             else:
                 db_chan = DroneChannel({"discordid": chan.id})
         lockmode = "enforceall" if lockall else "enforcedrones"
-        db_chan["config"] = {lockmode: True}
-        Storage.backend.save(db_chan)
+        locktime = datetime.now().timestamp() + duration if duration else None
+        db_chan["config"] = {lockmode: locktime or True}
+        await Storage.asave(db_chan)
+        set_channel_locked(chan.id, True)
+        if locktime:
+            self.expiry.schedule(("channel", chan.id), locktime)
+        else:
+            self.expiry.cancel(("channel", chan.id))
+        msgtime = f" for {duration} seconds" if duration else ""
         await ctx.respond(
             embed=mkembed(
                 "done",
-                f'Speech optimizations locked for {"EVERYONE" if lockall else "drones"} in {chan.mention}',
+                f'Speech optimizations locked for {"EVERYONE" if lockall else "drones"} in {chan.mention}{msgtime}',
             )
         )
 
@@ -122,43 +161,36 @@ class Locks(commands.Cog):
     ):
         await ctx.defer()
         chan = channel or ctx.channel
-        db_chan = get_channel({"discordid": chan.id})
+        db_chan = await aget_channel({"discordid": chan.id})
         if not db_chan:
             await ctx.respond(
                 embed=mkembed("error", f"Speech optimizations not locked in {chan.mention}")
             )
             return
         db_chan["config"] = {}
-        Storage.backend.save(db_chan)
+        await Storage.asave(db_chan)
+        set_channel_locked(chan.id, False)
+        self.expiry.cancel(("channel", chan.id))
         await ctx.respond(embed=mkembed("done", f"Speech optimizations unlocked in {chan.mention}"))
 
-    @tasks.loop(seconds=5)
-    async def check_locks(self):
-        now = datetime.now().timestamp()
-        db_drones = Storage.backend.filter(RegisteredDrone, {"config.enforce": {"$gt": now}}) or []
-        for d in db_drones:
-            self.bot.logger.info(f"Cleared timer.. {d.droneid}")
-            d["config"]["enforce"] = False
-            Storage.backend.save(d)
-            continue
-
-        db_chans = (
-            Storage.backend.filter(
-                DroneChannel,
-                {
-                    "$or": [
-                        {"config.enforcedrones": {"$gt": now}},
-                        {"config.enforceall": {"$gt": now}},
-                    ]
-                },
-            )
-            or []
-        )
-        for c in db_chans:
-            c.config.enforcedrones = False
-            c.config.enforceall = False
-            Storage.backend.save(c)
-            continue
+    async def expire_lock(self, key, deadline: float):
+        """Called by the expiry scheduler when a timed lock runs out. Leaves the lock alone if it has been changed
+        since the deadline was registered."""
+        kind, ident = key
+        if kind == "drone":
+            d = await aget_drone(ident)
+            if d and d.get("config", {}).get("enforce") == deadline:
+                self.bot.logger.info(f"Cleared timer.. {d.droneid}")
+                d["config"]["enforce"] = False
+                await Storage.asave(d)
+        else:
+            c = await aget_channel({"discordid": ident})
+            conf = c.get("config", {}) if c else {}
+            if any(conf.get(k) == deadline for k in CHANNEL_LOCK_KEYS):
+                self.bot.logger.info(f"Cleared channel timer.. {ident}")
+                c["config"] = {}
+                await Storage.asave(c)
+                set_channel_locked(ident, False)
 
 
 def setup(bot):
@@ -5,7 +5,7 @@ from discord.ext import commands
 
 from util import guilds, mkembed
 from util.access_utils import get_command_drones
-from util.storage import Storage, get_drone
+from util.storage import Storage, aget_drone
 
 
 class Messaging(commands.Cog):
@@ -16,7 +16,7 @@ class Messaging(commands.Cog):
     @commands.slash_command(name="wall", description="Send a DroneOS announcement", guild_ids=guilds)
     @permissions.has_role("Production")
     async def wall(self, ctx: ApplicationContext, message: Option(str, required=True)):
-        db_drone = get_drone(ctx.author.id)
+        db_drone = await aget_drone(ctx.author.id)
         if not db_drone:
             await ctx.respond("`Access denied`", ephemeral=True)
             return
@@ -51,7 +51,7 @@ Broadcast message from {droneid}@DroneOS (pts/0) ({datetime.now().strftime('%c')
             return
         operator["config"] = oconf
         operator["config"]["ssh"] = target.droneid
-        Storage.backend.save(operator)
+        await Storage.asave(operator)
         await ctx.respond(
             embed=mkembed(
                 "done",
@@ -79,7 +79,7 @@ Broadcast message from {droneid}@DroneOS (pts/0) ({datetime.now().strftime('%c')
             return
         operator["config"] = oconf
         operator["config"]["ssh"] = False
-        Storage.backend.save(operator)
+        await Storage.asave(operator)
         await ctx.respond(embed=mkembed("done", f"`Direct control terminated.`"))
         return
 
@@ -4,7 +4,7 @@ from discord.ext import commands
 
 import util
 from util import guilds, mkembed
-from util.storage import RegisteredDrone, Storage, get_drone
+from util.storage import RegisteredDrone, Storage, aget_drone
 
 
 class Registration(commands.Cog):
@@ -31,7 +31,7 @@ class Registration(commands.Cog):
                 embed=mkembed("error", f"`Drone IDs must be exactly 4 characters long`")
             )
             return
-        drone = get_drone(drone_id)
+        drone = await aget_drone(drone_id)
         if drone:
             await ctx.respond(embed=mkembed("error", f"`Drone ID {drone_id} is already registered`"))
             return
@@ -39,7 +39,7 @@ class Registration(commands.Cog):
             drone = RegisteredDrone({"droneid": drone_id, "discordid": ctx.author.id, "config": {}})
             actual_hive = hive.split(", ")[0]
             drone["hive"] = actual_hive
-            Storage.backend.save(drone)
+            await Storage.asave(drone)
             await ctx.respond(f"```\nDrone ID {drone_id} successfully registered```")
             director = self.bot.get_user(212005474764062732)
             await director.send(
@@ -62,14 +62,14 @@ class Registration(commands.Cog):
     @permissions.has_role("Drone")
     async def disconnect_drone(self, ctx: discord.ApplicationContext):
         await ctx.defer()
-        drone = get_drone(ctx.author.id)
+        drone = await aget_drone(ctx.author.id)
         drone_id = drone["droneid"]
         if not drone:
             await ctx.respond(
                 embed=mkembed("error", "`You do not appear to be a registered drone.`")
             )
             return
-        Storage.backend.delete(drone)
+        await Storage.adelete(drone)
         g = ctx.guild.get_role(954070867753709618)
         await ctx.author.remove_roles(g)
         await ctx.respond(f"```\nDrone ID {drone_id} successfully disconnected.```")
@@ -88,7 +88,7 @@ class Registration(commands.Cog):
         self, ctx: discord.ApplicationContext, hive: Option(str, choices=util.fhivemap)
     ):
         await ctx.defer()
-        drone = get_drone(ctx.author.id)
+        drone = await aget_drone(ctx.author.id)
         if not drone:
             await ctx.respond(
                 embed=mkembed("error", "`You do not appear to be a registered drone.`")
@@ -96,7 +96,7 @@ class Registration(commands.Cog):
             return
         actual_hive = hive.split(", ")[0]
         drone["hive"] = actual_hive
-        Storage.backend.save(drone)
+        await Storage.asave(drone)
         await ctx.respond(
             embed=mkembed(
                 "done", f"Your hive set to {actual_hive} ({util.hivemap[actual_hive]['sym']})"
@@ -110,7 +110,7 @@ class Registration(commands.Cog):
         drone_id: Option(str, description="4 character drone ID", required=True),
     ):
         await ctx.defer()
-        drone = get_drone(ctx.author.id)
+        drone = await aget_drone(ctx.author.id)
         if not drone:
             await ctx.respond(
                 embed=mkembed("error", "`You do not appear to be a registered drone.`")
@@ -120,7 +120,7 @@ class Registration(commands.Cog):
             await ctx.respond(embed=mkembed("error", "`Drone IDs must be exactly 4 characters.`"))
         original_id = drone["droneid"]
         drone["droneid"] = drone_id
-        Storage.backend.save(drone)
+        await Storage.asave(drone)
         await ctx.respond(embed=mkembed("done", f"`Drone {original_id} renamed to {drone_id}`"))
 
 
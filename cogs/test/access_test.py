@@ -0,0 +1,66 @@
+import pytest
+from util.storage import Storage, RegisteredDrone
+from util import load_hives
+
+
+@pytest.fixture
+def drones(monkeypatch):
+    import util.access_utils
+
+    load_hives()
+    monkeypatch.setattr(util.access_utils, "config", {"system": {"owner": 100000000000000900}})
+    ds = [
+        RegisteredDrone(
+            {
+                "discordid": 100000000000000051 + n,
+                "droneid": f"TSA{n}",
+                "hive": "lapine/unaffiliated",
+            }
+        )
+        for n in range(3)
+    ]
+    for d in ds:
+        Storage.save(d)
+    yield ds
+    for d in ds:
+        Storage.delete(d)
+
+
+@pytest.mark.asyncio
+class TestAccessIndex:
+    async def test_grant_and_revoke(self, drones):
+        from util.access_utils import has_access, grant_access, revoke_access, controlled_drones
+
+        a, b, c = drones
+        assert has_access(a, a)
+        assert not has_access(a, b)
+        assert await grant_access(a, b)
+        assert await grant_access(a, c)
+        assert not await grant_access(a, b)
+        assert has_access(a, b) and not has_access(b, a)
+        assert [d["droneid"] for d in controlled_drones(a)] == ["TSA1", "TSA2"]
+        assert await revoke_access(a, b)
+        assert not await revoke_access(a, b)
+        assert not has_access(a, b)
+        assert controlled_drones(a) == [c]
+
+    async def test_index_follows_saves_and_deletes(self, drones):
+        a, b, c = drones
+        b["access"] = [b["discordid"], a["discordid"]]
+        Storage.save(b)
+        assert Storage.drones.controlled_by(a["discordid"]) == {b["discordid"]}
+        Storage.delete(b)
+        assert Storage.drones.controlled_by(a["discordid"]) == set()
+        Storage.save(b)
+
+
+def test_director_and_hive_owner(drones):
+    from util import hivemap
+    from util.access_utils import has_access
+
+    a = drones[0]
+    director = RegisteredDrone({"discordid": 100000000000000900, "droneid": "TSAD"})
+    owner_id = hivemap["lapine/unaffiliated"]["owner"]
+    owner = RegisteredDrone({"discordid": owner_id, "droneid": "TSAO"})
+    assert has_access(director, a)
+    assert has_access(owner, a)
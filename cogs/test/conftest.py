@@ -0,0 +1,35 @@
+import os
+
+import pytest
+from util import load_codes, load_hives, load_filters
+
+HIVES = "lapine/unaffiliated:\n  sym: 'L'\n  owner: 1\ntst:\n  sym: 'T'\n  owner: 1\n"
+FILTERS = "lapine/unaffiliated:\ntst:\n  I: It\n"
+
+
+def write(path, text, bump=1):
+    """Writes `text` to `path` and moves its mtime `bump` seconds on, so a change never hides in mtime resolution."""
+    with open(path, "w") as f:
+        f.write(text)
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + bump * 10**9))
+
+
+@pytest.fixture
+def tree(tmp_path, monkeypatch):
+    """A minimal codes/, hives.yml, filters.yml and config.yml in the working directory, with the live tables
+    loaded from it. The repo's own definitions are loaded back afterwards."""
+    os.mkdir(tmp_path / "codes")
+    write(tmp_path / "codes" / "tst.yml", "'100': Online\n")
+    write(tmp_path / "hives.yml", HIVES)
+    write(tmp_path / "filters.yml", FILTERS)
+    write(tmp_path / "config.yml", "system:\n  owner: 1\n")
+    monkeypatch.chdir(tmp_path)
+    load_codes()
+    load_hives()
+    load_filters()
+    yield tmp_path
+    monkeypatch.undo()
+    load_codes()
+    load_hives()
+    load_filters()
@@ -0,0 +1,80 @@
+import asyncio
+import datetime
+
+import discord
+import pytest
+from unittest.mock import AsyncMock, MagicMock
+from util.delete_batcher import DeleteBatcher
+
+
+def message(channel, age=datetime.timedelta(0)):
+    msg = AsyncMock(name="Message")
+    msg.id = discord.utils.time_snowflake(discord.utils.utcnow() - age) + len(channel.sent)
+    msg.channel = channel
+    channel.sent.append(msg)
+    return msg
+
+
+@pytest.fixture
+def channel():
+    channel = AsyncMock(name="channel")
+    channel.id = 100000000000000001
+    channel.sent = []
+    return channel
+
+
+@pytest.mark.asyncio
+class TestDeleteBatcher:
+    async def test_bulk_deletes_after_window(self, channel):
+        d = DeleteBatcher(window=0.05)
+        msgs = [message(channel) for _ in range(3)]
+        for m in msgs:
+            d.delete(m)
+        channel.delete_messages.assert_not_called()
+        await asyncio.sleep(0.1)
+        channel.delete_messages.assert_called_once_with(msgs)
+        assert d.bulk == 1 and d.single == 0
+
+    async def test_dedupes(self, channel):
+        d = DeleteBatcher(window=10)
+        m = message(channel)
+        d.delete(m)
+        d.delete(m)
+        await d.flush()
+        d.delete(m)
+        await d.flush()
+        m.delete.assert_called_once()
+        channel.delete_messages.assert_not_called()
+
+    async def test_old_messages_deleted_singly(self, channel):
+        d = DeleteBatcher(window=10)
+        new = [message(channel) for _ in range(2)]
+        old = message(channel, age=datetime.timedelta(days=15))
+        for m in new + [old]:
+            d.delete(m)
+        await d.flush()
+        channel.delete_messages.assert_called_once_with(new)
+        old.delete.assert_called_once()
+
+    async def test_falls_back_when_bulk_fails(self, channel):
+        d = DeleteBatcher(window=10)
+        msgs = [message(channel) for _ in range(2)]
+        channel.delete_messages.side_effect = discord.HTTPException(AsyncMock(status=400), "nope")
+        for m in msgs:
+            d.delete(m)
+        await d.flush()
+        assert all(m.delete.call_count == 1 for m in msgs)
+
+    async def test_single_failure_spares_the_rest(self, channel):
+        d = DeleteBatcher(window=10, logger=MagicMock())
+        old = [message(channel, age=datetime.timedelta(days=15)) for _ in range(3)]
+        old[0].delete.side_effect = discord.Forbidden(AsyncMock(status=403), "nope")
+        for m in old:
+            d.delete(m)
+        await d.flush()
+        assert all(m.delete.call_count == 1 for m in old)
+        d.logger.warning.assert_called_once()
+        d.delete(old[0])  # Not deleted, so it can be tried again
+        d.delete(old[1])
+        await d.flush()
+        assert old[0].delete.call_count == 2 and old[1].delete.call_count == 1
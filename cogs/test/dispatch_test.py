@@ -0,0 +1,97 @@
+import asyncio
+import random
+
+import pytest
+from unittest.mock import MagicMock
+from util.dispatch import ChannelDispatcher, Retry
+
+
+@pytest.mark.asyncio
+class TestChannelDispatcher:
+    async def test_keeps_order_within_channel(self):
+        seen = {}
+
+        async def handler(item):
+            channel, n = item
+            await asyncio.sleep(random.random() / 1000)
+            seen.setdefault(channel, []).append(n)
+
+        d = ChannelDispatcher(handler, workers=3)
+        for n in range(20):
+            for channel in ("a", "b", "c", "d"):
+                d.submit(channel, (channel, n))
+        await asyncio.wait_for(d.join(), 5)
+        d.stop()
+        assert all(v == list(range(20)) for v in seen.values())
+        assert d.processed == 80
+
+    async def test_busy_channel_does_not_starve_others(self):
+        order = []
+
+        async def handler(item):
+            order.append(item)
+            await asyncio.sleep(0)
+
+        d = ChannelDispatcher(handler, workers=1)
+        for n in range(10):
+            d.submit("spam", "spam")
+        d.submit("quiet", "quiet")
+        assert d.depth() == 11 and d.depth("quiet") == 1
+        await asyncio.wait_for(d.join(), 5)
+        d.stop()
+        assert order.index("quiet") <= 2
+
+    async def test_errors_do_not_stop_worker(self):
+        errors = []
+
+        async def handler(item):
+            if item == "bad":
+                raise ValueError(item)
+
+        async def on_error(item):
+            errors.append(item)
+
+        d = ChannelDispatcher(handler, workers=1, on_error=on_error)
+        d.submit(1, "bad")
+        d.submit(1, "good")
+        await asyncio.wait_for(d.join(), 5)
+        d.stop()
+        assert errors == ["bad"] and d.processed == 2
+
+    async def test_failing_error_handler_keeps_worker(self):
+        handled = []
+
+        async def handler(item):
+            if item == "bad":
+                raise ValueError(item)
+            handled.append(item)
+
+        async def on_error(item):
+            raise RuntimeError("error handler broke too")
+
+        d = ChannelDispatcher(handler, workers=1, logger=MagicMock(), on_error=on_error)
+        d.submit("a", "bad")
+        d.submit("b", "good")
+        await asyncio.wait_for(d.join(), 5)
+        assert handled == ["good"] and not d._tasks[0].done()
+        d.logger.exception.assert_called_once()
+        d.stop()
+
+    async def test_retry_frees_the_worker(self):
+        order = []
+        tries = {"a1": 2}
+
+        async def handler(item):
+            if tries.get(item):
+                tries[item] -= 1
+                raise Retry(0.05)
+            order.append(item)
+
+        d = ChannelDispatcher(handler, workers=1)
+        d.submit("a", "a1")
+        d.submit("a", "a2")
+        d.submit("b", "b1")
+        await asyncio.wait_for(d.join(), 5)
+        d.stop()
+        assert order == ["b1", "a1", "a2"]
+        assert d.retries == 2 and d.processed == 3
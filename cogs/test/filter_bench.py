@@ -0,0 +1,86 @@
+"""Throughput benchmark for filter_utils.decide and the relay rewrite.
+
+Run from the repository root with `python -m cogs.test.filter_bench [seconds]`."""
+import random
+import sys
+import time
+
+from util import load_codes, load_hives, load_filters, hivemap
+from util.filter_utils import decide, relay_content, Action
+
+
+def corpus(n: int = 10000, seed: int = 1):
+    """Synthetic (content, drone, chan_conf, ssh_drone) tuples covering every branch of decide."""
+    rnd = random.Random(seed)
+    hives = list(hivemap.keys())
+    drones = [
+        {
+            "droneid": f"{i:04d}",
+            "discordid": 100000000000000000 + i,
+            "hive": rnd.choice(hives),
+            "config": {"enforce": rnd.random() < 0.2},
+        }
+        for i in range(200)
+    ]
+    by_id = {d["droneid"]: d for d in drones}
+    for d in rnd.sample(drones, 10):  # Some drones are in direct control of another
+        d["config"]["ssh"] = rnd.choice(drones)["droneid"]
+    chans = [{}, {}, {}, {"enforcedrones": True}, {"enforceall": True}]
+    texts = [
+        "I think it is a good morning",
+        "100 I am here",
+        "L008",
+        "hello everyone, my name is not important",
+        "",
+    ]
+    res = []
+    for _ in range(n):
+        drone = rnd.choice(drones) if rnd.random() < 0.7 else None
+        text = rnd.choice(texts)
+        r = rnd.random()
+        if drone and r < 0.5:
+            content = f"{drone['droneid']} :: {text}"
+        elif r < 0.6:
+            content = f"9999 :: {text}"
+        else:
+            content = text or "hi"
+        ssh_drone = by_id[drone["config"]["ssh"]] if drone and "ssh" in drone["config"] else None
+        res.append((content, drone, rnd.choice(chans), ssh_drone))
+    return res
+
+
+def bench(seconds: float = 2.0):
+    load_codes()
+    load_hives()
+    load_filters()
+    msgs = corpus()
+
+    n = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        for m in msgs:
+            decide(*m)
+        n += len(msgs)
+    decide_rate = n / (time.perf_counter() - start)
+
+    n = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        for m in msgs:
+            d = decide(*m)
+            if d.action in (Action.RELAY, Action.REDIRECT):
+                relay_content(d.drone, m[0])
+        n += len(msgs)
+    full_rate = n / (time.perf_counter() - start)
+
+    actions = {}
+    for m in msgs:
+        a = decide(*m).action.value
+        actions[a] = actions.get(a, 0) + 1
+    print(f"corpus: {len(msgs)} messages, {actions}")
+    print(f"decide:          {decide_rate:,.0f} decisions/s")
+    print(f"decide+rewrite:  {full_rate:,.0f} messages/s")
+
+
+if __name__ == "__main__":
+    bench(float(sys.argv[1]) if len(sys.argv) > 1 else 2.0)
@@ -1,5 +1,5 @@
 import pytest
-from unittest.mock import AsyncMock, ANY
+from unittest.mock import AsyncMock, MagicMock, ANY
 from util.storage import Storage, RegisteredDrone, DroneChannel
 from util import load_codes, load_hives, load_filters
 
@@ -7,7 +7,8 @@ from util import load_codes, load_hives, load_filters
 @pytest.fixture
 def filterplugin():
     bot = AsyncMock()
-    bot.logger = AsyncMock()
+    bot.logger = MagicMock()
+    bot.atclose = []
     load_codes()
     load_hives()
     load_filters()
@@ -37,9 +38,9 @@ def normaldrone():
     drone1 = RegisteredDrone(
         {"discordid": 100000000000000001, "droneid": "TSTN", "hive": "lapine/unaffiliated"}
     )
-    Storage.backend.save(drone1)
+    Storage.save(drone1)
     yield 100000000000000001
-    Storage.backend.delete(drone1)
+    Storage.delete(drone1)
 
 
 @pytest.fixture
@@ -52,25 +53,25 @@ def enforcedrone():
             "hive": "lapine/unaffiliated",
         }
     )
-    Storage.backend.save(drone1)
+    Storage.save(drone1)
     yield 100000000000000041
-    Storage.backend.delete(drone1)
+    Storage.delete(drone1)
 
 
 @pytest.fixture
 def enforcedronechan():
     chan = DroneChannel({"discordid": 100000000000000001, "config": {"enforcedrones": True}})
-    Storage.backend.save(chan)
+    Storage.save(chan)
     yield 100000000000000001
-    Storage.backend.delete(chan)
+    Storage.delete(chan)
 
 
 @pytest.fixture
 def enforceallchan():
     chan = DroneChannel({"discordid": 100000000000000004, "config": {"enforceall": True}})
-    Storage.backend.save(chan)
+    Storage.save(chan)
     yield 100000000000000004
-    Storage.backend.delete(chan)
+    Storage.delete(chan)
 
 
 @pytest.mark.asyncio
@@ -78,7 +79,8 @@ class TestFilterLogic:
     async def test_sends_normal_msg(self, filterplugin, hook, msg, normaldrone):
         msg.configure_mock(content="TSTN :: Y helo thar")
         msg.author.id = normaldrone
-        await filterplugin.drone_filter_handler(msg, hook)
+        await filterplugin.drone_filter_handler(msg, [hook])
+        await filterplugin.deleter.flush()
         hook.send.assert_called_with(
             username=ANY, content="TSTN :: ☼ :: Y helo thar", avatar_url=ANY, embed=ANY
         )
@@ -87,14 +89,16 @@ class TestFilterLogic:
     async def test_ignores_normies_without_chanenforce(self, filterplugin, hook, msg):
         msg.configure_mock(content="Y helo thar")
         msg.author.id = 100000000000000999
-        await filterplugin.drone_filter_handler(msg, hook)
+        await filterplugin.drone_filter_handler(msg, [hook])
+        await filterplugin.deleter.flush()
         hook.send.assert_not_called()
         msg.delete.assert_not_called()
 
     async def test_deletes_wrong_prefix(self, filterplugin, hook, msg, normaldrone):
         msg.configure_mock(content="1234 :: Y helo thar")
         msg.author.id = normaldrone
-        await filterplugin.drone_filter_handler(msg, hook)
+        await filterplugin.drone_filter_handler(msg, [hook])
+        await filterplugin.deleter.flush()
         hook.send.assert_not_called()
         msg.delete.assert_called()
 
@@ -103,14 +107,16 @@ class TestFilterLogic:
     ):
         msg.configure_mock(content="Y helo thar")
         msg.author.id = enforcedrone
-        await filterplugin.drone_filter_handler(msg, hook)
+        await filterplugin.drone_filter_handler(msg, [hook])
+        await filterplugin.deleter.flush()
         hook.send.assert_not_called()
         msg.delete.assert_called()
 
     async def test_sends_in_droneenforce(self, filterplugin, hook, msg, enforcedrone):
         msg.configure_mock(content="TSTE :: Y helo thar")
         msg.author.id = enforcedrone
-        await filterplugin.drone_filter_handler(msg, hook)
+        await filterplugin.drone_filter_handler(msg, [hook])
+        await filterplugin.deleter.flush()
         hook.send.assert_called_with(
             username=ANY, content="TSTE :: ☼ :: Y helo thar", avatar_url=ANY, embed=ANY
         )
@@ -122,7 +128,8 @@ class TestFilterLogic:
         msg.configure_mock(content="TSTN :: Y helo thar")
         msg.author.id = normaldrone
         msg.channel.id = enforcedronechan
-        await filterplugin.drone_filter_handler(msg, hook)
+        await filterplugin.drone_filter_handler(msg, [hook])
+        await filterplugin.deleter.flush()
         hook.send.assert_called_with(
             username=ANY, content="TSTN :: ☼ :: Y helo thar", avatar_url=ANY, embed=ANY
         )
@@ -134,7 +141,8 @@ class TestFilterLogic:
         msg.configure_mock(content="Y helo thar")
         msg.author.id = normaldrone
         msg.channel.id = enforcedronechan
-        await filterplugin.drone_filter_handler(msg, hook)
+        await filterplugin.drone_filter_handler(msg, [hook])
+        await filterplugin.deleter.flush()
         hook.send.assert_not_called()
         msg.delete.assert_called()
 
@@ -142,7 +150,8 @@ class TestFilterLogic:
         msg.configure_mock(content="Y helo thar")
         msg.author.id = 100000000000000999
         msg.channel.id = enforcedronechan
-        await filterplugin.drone_filter_handler(msg, hook)
+        await filterplugin.drone_filter_handler(msg, [hook])
+        await filterplugin.deleter.flush()
         hook.send.assert_not_called()
         msg.delete.assert_not_called()
 
@@ -152,7 +161,8 @@ class TestFilterLogic:
         msg.configure_mock(content="Y helo thar")
         msg.author.id = normaldrone
         msg.channel.id = enforceallchan
-        await filterplugin.drone_filter_handler(msg, hook)
+        await filterplugin.drone_filter_handler(msg, [hook])
+        await filterplugin.deleter.flush()
         hook.send.assert_not_called()
         msg.delete.assert_called()
 
@@ -162,7 +172,8 @@ class TestFilterLogic:
         msg.configure_mock(content="Y helo thar")
         msg.author.id = 100000000000000999
         msg.channel.id = enforceallchan
-        await filterplugin.drone_filter_handler(msg, hook)
+        await filterplugin.drone_filter_handler(msg, [hook])
+        await filterplugin.deleter.flush()
         hook.send.assert_not_called()
         msg.delete.assert_called()
 
@@ -172,8 +183,227 @@ class TestFilterLogic:
         msg.configure_mock(content="TSTN :: Y helo thar")
         msg.author.id = normaldrone
         msg.channel.id = enforceallchan
-        await filterplugin.drone_filter_handler(msg, hook)
+        await filterplugin.drone_filter_handler(msg, [hook])
+        await filterplugin.deleter.flush()
         hook.send.assert_called_with(
             username=ANY, content="TSTN :: ☼ :: Y helo thar", avatar_url=ANY, embed=ANY
         )
         msg.delete.assert_called()
+
+
+@pytest.mark.asyncio
+class TestWebhookRegistry:
+    async def test_lookup_is_cached(self):
+        from util.filter_utils import get_drone_webhook, forget_drone_webhooks, WEBHOOK_NAME
+
+        h = AsyncMock(name="webhook")
+        h.name = WEBHOOK_NAME
+        channel = AsyncMock(name="channel")
+        channel.id = 100000000000000777
+        channel.webhooks = AsyncMock(return_value=[h])
+        assert await get_drone_webhook(channel) is h
+        assert await get_drone_webhook(channel) is h
+        channel.webhooks.assert_called_once()
+        forget_drone_webhooks(channel.id)
+
+    async def test_caches_missing_webhook(self):
+        from util.filter_utils import get_drone_webhook, forget_drone_webhooks
+
+        channel = AsyncMock(name="channel")
+        channel.id = 100000000000000778
+        channel.webhooks = AsyncMock(return_value=[])
+        assert await get_drone_webhook(channel) is None
+        assert await get_drone_webhook(channel) is None
+        channel.webhooks.assert_called_once()
+        forget_drone_webhooks(channel.id)
+
+    async def test_collects_pool(self):
+        from util.filter_utils import get_drone_webhooks, forget_drone_webhooks, WEBHOOK_NAME
+
+        hooks = [AsyncMock(name=f"webhook{n}") for n in range(3)]
+        for h in hooks:
+            h.name = WEBHOOK_NAME
+        other = AsyncMock(name="other")
+        other.name = "Some other integration"
+        channel = AsyncMock(name="channel")
+        channel.id = 100000000000000779
+        channel.webhooks = AsyncMock(return_value=[hooks[0], other, hooks[1], hooks[2]])
+        assert await get_drone_webhooks(channel) == hooks
+        forget_drone_webhooks(channel.id)
+
+
+@pytest.mark.asyncio
+class TestActiveChannels:
+    async def test_skips_inactive_channel_without_io(self, filterplugin, msg):
+        from util.filter_utils import set_drone_webhooks, forget_drone_webhooks
+
+        set_drone_webhooks(msg.channel.id, [])
+        msg.content = "TSTN :: hello"
+        await filterplugin.on_message(msg)
+        msg.channel.webhooks.assert_not_called()
+        assert filterplugin.dispatcher.depth() == 0
+        forget_drone_webhooks(msg.channel.id)
+
+    async def test_first_lookup_keeps_channel_order(self, filterplugin, hook):
+        import asyncio
+        from unittest.mock import AsyncMock
+        from util.filter_utils import forget_drone_webhooks, WEBHOOK_NAME
+
+        async def slow_webhooks():
+            await asyncio.sleep(0.05)
+            return [hook]
+
+        hook.name = WEBHOOK_NAME
+        channel = AsyncMock(name="channel")
+        channel.id = 100000000000000781
+        channel.webhooks = AsyncMock(side_effect=slow_webhooks)
+        msgs = []
+        for n in range(3):
+            m = AsyncMock(name=f"msg{n}")
+            m.channel, m.content, m.author.bot = channel, f"TSTN :: {n}", False
+            msgs.append(m)
+        filterplugin.handler = AsyncMock()
+        for m in msgs:
+            await filterplugin.on_message(m)
+        await asyncio.wait_for(filterplugin.dispatcher.join(), 5)
+        assert [c.args[0] for c in filterplugin.handler.call_args_list] == msgs
+        channel.webhooks.assert_called_once()
+        filterplugin.dispatcher.stop()
+        forget_drone_webhooks(channel.id)
+
+    async def test_tracks_webhooks_and_locks(self, hook):
+        from util.filter_utils import (
+            is_active,
+            set_drone_webhooks,
+            set_channel_locked,
+            forget_drone_webhooks,
+        )
+
+        chan = 100000000000000780
+        assert is_active(chan)  # Not looked up yet
+        set_drone_webhooks(chan, [])
+        assert not is_active(chan)
+        set_drone_webhooks(chan, [hook])
+        assert is_active(chan)
+        set_drone_webhooks(chan, [])
+        set_channel_locked(chan, True)
+        assert is_active(chan)
+        set_channel_locked(chan, False)
+        assert not is_active(chan)
+        forget_drone_webhooks(chan)
+
+
+@pytest.mark.asyncio
+async def test_spreads_relays_over_pool(filterplugin, msg, normaldrone):
+    hooks = []
+    for n in range(2):
+        h = AsyncMock(name=f"webhook{n}")
+        h.id = n
+        hooks.append(h)
+    filterplugin.sender.limit = 2
+    msg.author.id = normaldrone
+    msg.content = "TSTN :: hello"
+    for _ in range(4):
+        await filterplugin.drone_filter_handler(msg, hooks)
+    await filterplugin.deleter.flush()
+    assert hooks[0].send.call_count == 2 and hooks[1].send.call_count == 2
+    assert filterplugin.sender.throttled == 0
+
+
+@pytest.mark.asyncio
+async def test_throttled_channel_does_not_hold_up_others(filterplugin, normaldrone):
+    import asyncio
+    import time
+    from util.filter_utils import set_drone_webhooks, forget_drone_webhooks
+
+    filterplugin.dispatcher.workers = 1
+    msgs, hooks = [], []
+    for n in range(2):
+        h = AsyncMock(name=f"webhook{n}")
+        h.id = n
+        hooks.append(h)
+        m = AsyncMock(name=f"msg{n}")
+        m.channel.id = 100000000000000790 + n
+        m.author.id = normaldrone
+        m.author.bot = False
+        m.content = "TSTN :: hello"
+        m.reference = None
+        msgs.append(m)
+        set_drone_webhooks(m.channel.id, [h])
+    filterplugin.sender.bucket(0).update("5", "0", "0.3", time.monotonic())  # Out for 0.3s
+    for m in msgs:
+        await filterplugin.on_message(m)
+    await asyncio.sleep(0.1)
+    hooks[0].send.assert_not_called()
+    hooks[1].send.assert_called_once()
+    await asyncio.wait_for(filterplugin.dispatcher.join(), 5)
+    hooks[0].send.assert_called_once()
+    assert filterplugin.dispatcher.retries == 1
+    filterplugin.dispatcher.stop()
+    await filterplugin.deleter.flush()
+    for m in msgs:
+        forget_drone_webhooks(m.channel.id)
+
+@pytest.mark.asyncio
+async def test_applies_hive_filter(filterplugin, hook, msg, normaldrone):
+    msg.configure_mock(content="TSTN :: I think, therefore I am.")
+    msg.author.id = normaldrone
+    await filterplugin.drone_filter_handler(msg, [hook])
+    await filterplugin.deleter.flush()
+    hook.send.assert_called_with(
+        username=ANY,
+        content="TSTN :: ☼ :: It \\_\\_\\_\\_\\_, therefore It is.",
+        avatar_url=ANY,
+        embed=ANY,
+    )
+
+
+@pytest.mark.asyncio
+async def test_formats_code_followed_by_text(filterplugin, hook, msg, normaldrone):
+    msg.configure_mock(content="TSTN :: 100 Y helo thar")
+    msg.author.id = normaldrone
+    await filterplugin.drone_filter_handler(msg, [hook])
+    await filterplugin.deleter.flush()
+    hook.send.assert_called_with(
+        username=ANY,
+        content="TSTN :: ☼ :: Code 100 :: Status :: Online and ready to serve. :: Y helo thar",
+        avatar_url=ANY,
+        embed=ANY,
+    )
+
+
+class TestDecide:
+    drone = {"droneid": "TSTN", "discordid": 100000000000000001, "hive": "lapine/unaffiliated"}
+
+    def test_relays_own_prefix(self):
+        from util.filter_utils import decide, Action
+
+        d = decide("TSTN :: hi", self.drone, {})
+        assert d.action is Action.RELAY and d.drone is self.drone
+
+    def test_passes_plain_chat(self):
+        from util.filter_utils import decide, Action
+
+        assert decide("hi", self.drone, {}).action is Action.PASS
+        assert decide("hi", None, {"enforcedrones": True}).action is Action.PASS
+
+    def test_deletes(self):
+        from util.filter_utils import decide, Action
+
+        assert decide("TSTN :: ", self.drone, {}).action is Action.DELETE
+        assert decide("ABCD :: hi", self.drone, {}).action is Action.DELETE
+        assert decide("hi", None, {"enforceall": True}).action is Action.DELETE
+        assert decide("hi", dict(self.drone, config={"enforce": True}), {}).action is Action.DELETE
+
+    def test_delete_reason_is_a_fixed_category(self):
+        from util.filter_utils import decide
+
+        d = decide("ABCD :: hi", self.drone, {})
+        assert (d.reason, d.detail) == ("Wrong prefix delete", "got ABCD, should be TSTN")
+
+    def test_redirects_under_direct_control(self):
+        from util.filter_utils import decide, Action
+
+        target = {"droneid": "TGT1", "discordid": 100000000000000002, "hive": "hexcorp"}
+        d = decide("hi", dict(self.drone, config={"ssh": "TGT1"}), {}, target)
+        assert d.action is Action.REDIRECT and d.drone is target
@@ -0,0 +1,59 @@
+import asyncio
+import time
+
+import pytest
+from util.lock_utils import ExpiryScheduler, lock_deadline
+
+
+@pytest.mark.asyncio
+class TestExpiryScheduler:
+    async def test_fires_once_in_deadline_order(self):
+        fired = []
+
+        async def cb(key, deadline):
+            fired.append(key)
+
+        s = ExpiryScheduler(cb)
+        s.start()
+        now = time.time()
+        s.schedule("b", now + 0.06)
+        s.schedule("a", now + 0.02)
+        await asyncio.sleep(0.15)
+        s.stop()
+        assert fired == ["a", "b"]
+        assert len(s) == 0
+
+    async def test_reschedule_and_cancel(self):
+        fired = []
+
+        async def cb(key, deadline):
+            fired.append((key, deadline))
+
+        s = ExpiryScheduler(cb)
+        s.start()
+        now = time.time()
+        s.schedule("a", now + 0.02)
+        s.schedule("a", now + 0.05)
+        s.schedule("b", now + 0.02)
+        s.cancel("b")
+        await asyncio.sleep(0.12)
+        s.stop()
+        assert fired == [("a", now + 0.05)]
+
+    async def test_past_deadline_fires_immediately(self):
+        fired = asyncio.Event()
+
+        async def cb(key, deadline):
+            fired.set()
+
+        s = ExpiryScheduler(cb)
+        s.start()
+        s.schedule("late", time.time() - 60)
+        await asyncio.wait_for(fired.wait(), 1)
+        s.stop()
+
+
+def test_lock_deadline():
+    assert lock_deadline(True) is None
+    assert lock_deadline(False) is None
+    assert lock_deadline(1700000000) == 1700000000.0
@@ -0,0 +1,86 @@
+import logging
+import threading
+
+import pytest
+from util import log
+
+
+class Probe:
+    """Remembers which thread turned it into a string."""
+
+    def __init__(self):
+        self.thread = None
+
+    def __str__(self):
+        self.thread = threading.current_thread()
+        return "probe"
+
+
+def record(msg, *args):
+    return logging.LogRecord("bot.enforce", logging.INFO, __file__, 1, msg, args, None)
+
+
+@pytest.fixture
+def queued_logger(monkeypatch):
+    """Makes loggers with init_logger, and stops their listeners again whether or not the test gets that far."""
+    made = []
+
+    def make(name):
+        logger = log.init_logger(name, "INFO")
+        monkeypatch.setattr(logger, "propagate", False)  # pytest's capture handler would format it here
+        made.append(logger)
+        return logger
+
+    yield make
+    for logger in made:
+        log.stop(logger)
+
+
+def test_formats_off_the_calling_thread(capsys, queued_logger):
+    logger = queued_logger("log_test")
+    probe = Probe()
+    logger.info("seen %s", probe)
+    log.stop(logger)
+    assert "seen probe" in capsys.readouterr().err
+    assert probe.thread is not threading.current_thread()
+
+
+def test_stop_leaves_other_loggers_running(capsys, queued_logger):
+    logger, other = queued_logger("log_test"), queued_logger("log_test_other")
+    log.stop(other)
+    assert not other.handlers
+    logger.info("still here")
+    log.stop(logger)
+    assert "still here" in capsys.readouterr().err
+
+
+def test_rate_limit_drops_and_summarizes():
+    f = log.RateLimitFilter(rate=0, burst=2)
+    assert all(f.filter(record("%s: %s", "drone speech", n)) for n in range(2))
+    assert not f.filter(record("%s: %s", "drone speech", 3))
+    assert f.filter(record("%s: %s", "bad code", 4))  # Another reason has its own allowance
+    assert f.suppressed == 1
+
+    f.rate = 1000
+    f._buckets[("%s: %s", "drone speech")][1] -= 1
+    r = record("%s: %s", "drone speech", 5)
+    assert f.filter(r)
+    assert r.getMessage() == "drone speech: 5 (1 like this dropped)"
+
+
+def test_forgets_idle_kinds():
+    f = log.RateLimitFilter(rate=0, burst=1, idle=60)
+    for n in range(3):
+        f.filter(record("%s: %s", "Wrong prefix delete", n))
+    f.filter(record("%s: %s", "Malformed delete", 0))
+    assert len(f._buckets) == 2
+    f._buckets[("%s: %s", "Wrong prefix delete")][1] -= 61
+    f._sweep(f._swept + 1)
+    assert list(f._buckets) == [("%s: %s", "Malformed delete")]
+
+
+def test_key_value_format():
+    r = record("%s: %s", "drone speech", "a message")
+    line = log.KeyValueFormatter().format(r)
+    assert "level=INFO logger=bot.enforce" in line
+    assert line.endswith('msg="drone speech: a message"')
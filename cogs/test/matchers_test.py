@@ -0,0 +1,72 @@
+from util.matchers import HiveFilter
+
+
+class TestHiveFilter:
+    def test_rewrites_whole_words_only(self):
+        hf = HiveFilter({"I": "It", "me": "it", "am": "is"})
+        assert hf.apply("I am me, Iago ame") == "It is it, Iago ame"
+
+    def test_keeps_punctuation_and_whitespace(self):
+        hf = HiveFilter({"I": "It", "my": "its"})
+        assert hf.apply("(I)  said...\tmy/my!") == "(It)  said...\tits/its!"
+
+    def test_apostrophes_are_part_of_words(self):
+        hf = HiveFilter({"I'm": "It is", "I": "It"})
+        assert hf.apply("I'm sure I'm fine, I") == "It is sure It is fine, It"
+
+    def test_empty_filter(self):
+        assert HiveFilter(None).apply("I am") == "I am"
+
+
+class TestPhrases:
+    def test_phrase_beats_words(self):
+        hf = HiveFilter({"I": "It", "think": "computes", "I think": "It believes"})
+        assert hf.apply("I think I know. I\tthink so") == "It believes It know. It believes so"
+
+    def test_longest_match_wins(self):
+        hf = HiveFilter({"good morning": "greetings", "good morning everyone": "greetings, units"})
+        assert hf.apply("good morning everyone!") == "greetings, units!"
+        assert hf.apply("good morning, everyone") == "greetings, everyone"
+
+    def test_leftmost_match_wins_overlaps(self):
+        hf = HiveFilter({"a b": "X", "b c": "Y"})
+        assert hf.apply("a b c") == "X c"
+
+    def test_phrases_respect_word_boundaries(self):
+        hf = HiveFilter({"I think": "It believes"})
+        assert hf.apply("HI thinker, I think") == "HI thinker, It believes"
+
+    def test_overlapping_suffixes(self):
+        from util.matchers import PhraseAutomaton
+
+        pa = PhraseAutomaton({"she sells": "1", "he sells sea": "2", "sells sea shells": "3"})
+        assert pa.find("she sells sea shells") == [(0, 9, "1")]
+        assert pa.find("he sells sea shells") == [(0, 12, "2")]
+
+
+class TestCodeIndex:
+    def test_longest_code_at_boundary(self):
+        from util.matchers import CodeIndex
+
+        idx = CodeIndex({"100": "Online", "1001": "Long", "L008": "Boop"})
+        assert idx.longest("100") == "100"
+        assert idx.longest("100 ready") == "100"
+        assert idx.longest("1001 ready") == "1001"
+        assert idx.longest("100.") == "100"
+        assert idx.longest("1002") is None
+        assert idx.longest("L008") == "L008"
+        assert idx.longest("x100") is None
+
+    def test_hive_namespaces(self, monkeypatch):
+        from util import load_codes, load_hives, find_code, hivemap
+
+        load_codes()
+        load_hives()
+        assert find_code("100 hi", "hexcorp")[0] == "100"
+        assert find_code("L008", "hexcorp")[0] == "L008"  # Hexcorp drones kept their mndlos codes
+        monkeypatch.setitem(hivemap, "hexonly", {"sym": "H", "owner": 1, "codes": ["hex"]})
+        assert find_code("100 hi", "hexonly")[0] == "100"
+        assert find_code("L008", "hexonly") == (None, None)
+        assert find_code("L008", "mndlos")[0] == "L008"
+        assert find_code("100", "mndlos")[0] == "100"
+        assert find_code("L008", "lapine/unaffiliated")[0] == "L008"
@@ -0,0 +1,44 @@
+import aiohttp
+import pytest
+from util import metrics
+
+
+def test_histogram_renders_cumulative_buckets():
+    h = metrics.Histogram("tst_seconds", "Test histogram", ("stage",), buckets=(0.1, 1))
+    h.observe(0.05, "a")
+    h.observe(0.5, "a")
+    h.observe(5, "a")
+    lines = h.render()
+    metrics.registry.remove(h)
+    assert 'tst_seconds_bucket{stage="a",le="0.1"} 1' in lines
+    assert 'tst_seconds_bucket{stage="a",le="1"} 2' in lines
+    assert 'tst_seconds_bucket{stage="a",le="+Inf"} 3' in lines
+    assert 'tst_seconds_count{stage="a"} 3' in lines
+
+
+def test_counter_and_gauge():
+    c = metrics.Counter("tst_total", "Test counter", ("action", "hive"))
+    c.inc("relay", 'a "hive"')
+    c.inc("relay", 'a "hive"', amount=2)
+    g = metrics.Gauge("tst_depth", "Test gauge")
+    g.fn = lambda: 7
+    out = metrics.render()
+    metrics.registry.remove(c)
+    metrics.registry.remove(g)
+    assert 'tst_total{action="relay",hive="a \\"hive\\""} 3' in out
+    assert "# TYPE tst_depth gauge\ntst_depth 7" in out
+
+
+@pytest.mark.asyncio
+async def test_server_serves_registry(unused_tcp_port):
+    with metrics.stage("tst"):
+        pass
+    server = metrics.MetricsServer("127.0.0.1", unused_tcp_port)
+    await server.start()
+    try:
+        async with aiohttp.ClientSession() as s:
+            async with s.get(f"http://127.0.0.1:{unused_tcp_port}/metrics") as r:
+                body = await r.text()
+    finally:
+        await server.stop()
+    assert 'droneos_filter_stage_seconds_count{stage="tst"} 1' in body
@@ -0,0 +1,45 @@
+import pytest
+import util
+from conftest import FILTERS, HIVES, write
+from util.reloader import Reloader
+
+
+@pytest.mark.asyncio
+class TestReloader:
+    async def test_swaps_changed_sources_in_place(self, tree):
+        hive_filters = util.hive_filters
+        r = Reloader()
+        assert await r.check() == []
+        write(tree / "filters.yml", FILTERS.replace("It", "This unit"))
+        write(tree / "codes" / "more.yml", "'200': Offline\n")
+        assert sorted(await r.check()) == ["codes", "filters"]
+        assert hive_filters["tst"].apply("I am") == "This unit am"
+        assert util.find_code("200 bye", "tst") == ("200", "Offline")
+        assert await r.check() == []
+
+    async def test_keeps_running_version_on_bad_file(self, tree):
+        r = Reloader()
+        write(tree / "hives.yml", "tst:\n  owner: 1\n")
+        assert await r.check() == []
+        assert util.hivemap["tst"]["sym"] == "T"
+        write(tree / "hives.yml", HIVES.replace("'T'", "'X'"))
+        assert await r.check() == ["hives"]
+        assert util.fhivemap == ["lapine/unaffiliated, L", "tst, X"]
+
+    async def test_rejects_configs_that_break_relays(self, tree):
+        r = Reloader()
+        write(tree / "filters.yml", "tst:\n  I: It\n")
+        assert await r.check() == []
+        assert "lapine/unaffiliated" in util.hive_filters
+        write(tree / "hives.yml", "tst:\n  sym: 'T'\n  owner: 1\n")
+        assert await r.check() == []
+        write(tree / "hives.yml", HIVES + "  codes: [tst, nope]\n")
+        assert await r.check() == []
+        assert "lapine/unaffiliated" in util.hivemap and "codes" not in util.hivemap["tst"]
+
+
+def test_removed_hive_falls_back(tree):
+    from util.filter_utils import relay_content
+
+    drone = {"droneid": "1234", "hive": "gone"}
+    assert relay_content(drone, "1234 :: 100 I am") == "1234 :: L :: Code 100 :: Online :: I am"
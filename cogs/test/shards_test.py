@@ -0,0 +1,27 @@
+from unittest.mock import MagicMock
+
+import discord
+import pytest
+from util.shards import ShardStats, shard_of
+
+
+def test_shard_of():
+    guild = MagicMock(spec=discord.Guild)
+    guild.shard_id = 3
+    msg = MagicMock()
+    msg.guild = guild
+    assert shard_of((guild,)) == 3
+    assert shard_of((msg, None)) == 3
+    assert shard_of((object(),)) is None
+    assert shard_of(()) is None
+
+
+def test_rates_are_per_shard_and_reset():
+    s = ShardStats()
+    for _ in range(3):
+        s.record(0)
+    s.record(1)
+    rates = s.rates()
+    assert rates[1] > 0 and rates[0] == pytest.approx(3 * rates[1])
+    assert s.rates() == {0: 0.0, 1: 0.0}
+    assert s.events == {0: 3, 1: 1}
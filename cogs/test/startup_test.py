@@ -0,0 +1,45 @@
+import os
+
+import pytest
+import util
+from conftest import HIVES, write
+from util.startup import load_snapshot, StartupTimer
+
+
+def test_reuses_snapshot_until_a_file_changes(tree, monkeypatch):
+    first = load_snapshot()
+    assert first.config == {"system": {"owner": 1}}
+    assert first.codes[1]["tst"].longest("100") == "100"
+
+    def unparsed():
+        raise AssertionError("parsed again")
+
+    monkeypatch.setattr(util, "read_hives", unparsed)
+    assert load_snapshot().hives == first.hives
+    write(tree / "hives.yml", HIVES, bump=2)  # Touched, same content
+    assert load_snapshot().hives == first.hives
+
+    monkeypatch.undo()
+    monkeypatch.chdir(tree)
+    write(tree / "hives.yml", HIVES.replace("'T'", "'X'"), bump=3)
+    assert load_snapshot().hives["tst"]["sym"] == "X"
+
+
+def test_rebuilds_from_corrupt_snapshot(tree):
+    os.mkdir(tree / "cache")
+    write(tree / "cache" / "startup.snapshot", "not a pickle")
+    assert load_snapshot().filters[0]["tst"] == {"I": "It"}
+
+
+def test_key_covers_snapshot_code(tree):
+    from util.startup import _sources
+    import util.matchers
+
+    assert {util.__file__, util.matchers.__file__} <= set(_sources())
+
+
+def test_timer_reports_phases():
+    t = StartupTimer()
+    with t.phase("one"):
+        pass
+    assert t.report().startswith("one: ") and "total: " in t.report()
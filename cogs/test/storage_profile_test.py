@@ -0,0 +1,51 @@
+import pytest
+from unittest.mock import MagicMock
+from util.storage import Storage, get_drone, get_drones, aget_channel
+from util import storage_profile
+from util.storage_profile import StorageProfiler
+
+
+@pytest.fixture
+def profiler():
+    p = StorageProfiler(Storage, MagicMock())
+    p.install()
+    yield p
+    p.uninstall()
+
+
+def lookup_twice():
+    get_drone("9813")
+    get_drones(["9813", "0000"])
+
+
+def test_counts_ops_and_callers(profiler):
+    lookup_twice()
+    assert profiler.ops["drones.get"].count == 1
+    assert profiler.ops["drones.get_many"].count == 1  # Its own get() calls aren't counted again
+    assert profiler.ops["drones.get"].callers == {f"{__name__}.lookup_twice": 1}
+
+
+@pytest.mark.asyncio
+async def test_attributes_ops_to_pass(profiler):
+    with storage_profile.scope("/access ls"):
+        get_drone("9813")
+        await aget_channel({"channelid": 1})
+    with storage_profile.scope("/access ls"):
+        get_drone("9813")
+    assert profiler.passes == {"/access ls": 2}
+    by_op = profiler.scopes["/access ls"]
+    assert by_op["drones.get"].count == 2
+    assert by_op["afilter"].count == 1
+    profiler.logger.debug.assert_called()
+    summary = profiler.summary()
+    assert any(line.startswith("/access ls: 2 passes, 1.5 calls") for line in summary)
+
+
+def test_uninstall_restores_methods(profiler):
+    profiler.uninstall()
+    assert "get" not in vars(Storage.drones)
+    assert "filter" not in vars(Storage)
+    assert storage_profile.profiler is None
+    with storage_profile.scope("message"):
+        get_drone("9813")
+    assert not profiler.ops
@@ -0,0 +1,229 @@
+import pytest
+from util.storage import Storage, RegisteredDrone, get_drone
+
+
+@pytest.fixture
+def drone():
+    d = RegisteredDrone(
+        {"discordid": 100000000000000101, "droneid": "TSTR", "hive": "lapine/unaffiliated"}
+    )
+    Storage.save(d)
+    yield d
+    Storage.delete(d)
+
+
+class TestDroneRegistry:
+    def test_lookup_by_either_id(self, drone):
+        assert get_drone("TSTR") is drone
+        assert get_drone(100000000000000101) is drone
+        assert get_drone("100000000000000101") is drone
+
+    def test_counts_hits_and_misses(self, drone):
+        hits, misses = Storage.drones.hits, Storage.drones.misses
+        get_drone("TSTR")
+        get_drone("NOPE")
+        assert Storage.drones.hits == hits + 1
+        assert Storage.drones.misses == misses + 1
+
+    def test_reindexes_on_save(self, drone):
+        drone["droneid"] = "TSTS"
+        Storage.save(drone)
+        assert get_drone("TSTR") is None
+        assert get_drone("TSTS") is drone
+
+    def test_forgets_on_delete(self):
+        d = RegisteredDrone(
+            {"discordid": 100000000000000102, "droneid": "TSTD", "hive": "lapine/unaffiliated"}
+        )
+        Storage.save(d)
+        Storage.delete(d)
+        assert get_drone("TSTD") is None
+        assert get_drone(100000000000000102) is None
+
+    def test_loads_from_backend(self, drone):
+        Storage.drones.load(Storage.backend)
+        assert get_drone("TSTR")["discordid"] == 100000000000000101
+
+
+@pytest.fixture
+def sqlite(tmp_path):
+    from util.sqlite_backend import SqliteBackend
+
+    return SqliteBackend(str(tmp_path / "test.sqlite3"))
+
+
+class TestSqliteBackend:
+    def test_get_by_indexed_keys(self, sqlite):
+        d = RegisteredDrone({"discordid": 100000000000000201, "droneid": "SQLT", "config": {}})
+        sqlite.save(d)
+        assert sqlite.get(RegisteredDrone, {"droneid": "SQLT"})["discordid"] == 100000000000000201
+        assert sqlite.get(RegisteredDrone, {"discordid": 100000000000000201}).pk == d.pk
+        with pytest.raises(RegisteredDrone.DoesNotExist):
+            sqlite.get(RegisteredDrone, {"droneid": "NOPE"})
+
+    def test_expiry_scan(self, sqlite):
+        from util.storage import DroneChannel
+
+        sqlite.save(RegisteredDrone({"droneid": "EXP1", "config": {"enforce": 100.0}}))
+        sqlite.save(RegisteredDrone({"droneid": "EXP2", "config": {"enforce": 300.0}}))
+        sqlite.save(RegisteredDrone({"droneid": "EXP3", "config": {"enforce": True}}))
+        sqlite.save(DroneChannel({"discordid": 1000000000, "config": {"enforceall": 150.0}}))
+        expired = sqlite.filter(RegisteredDrone, {"config.enforce": {"$lte": 200}})
+        # True is 1, as in FileBackend
+        assert sorted(d["droneid"] for d in expired) == ["EXP1", "EXP3"]
+        later = sqlite.filter(RegisteredDrone, {"config.enforce": {"$gt": 200}})
+        assert [d["droneid"] for d in later] == ["EXP2"]
+        chans = sqlite.filter(
+            DroneChannel,
+            {"$or": [{"config.enforcedrones": {"$lte": 200}}, {"config.enforceall": {"$lte": 200}}]},
+        )
+        assert len(chans) == 1
+
+    def test_range_queries_are_bounded_by_the_index(self):
+        from util.sqlite_backend import _narrow
+
+        assert _narrow({"config.enforce": {"$gt": 5}}) == ("latest > ?", [5])
+        both = _narrow({"config.enforce": {"$gte": 5, "$lt": 9}})
+        assert both == ("expires < ? AND latest >= ?", [9, 5])
+
+    def test_matches_like_file_backend(self, sqlite, tmp_path):
+        from blitzdb import FileBackend
+
+        src = FileBackend(str(tmp_path / "db"))
+        src.autocommit = True
+        for n, lock in enumerate([True, False, 0, 5, 250.0]):
+            d = {"droneid": f"CMP{n}", "discordid": n, "config": {"enforce": lock}}
+            src.save(RegisteredDrone(dict(d)))
+            sqlite.save(RegisteredDrone(dict(d)))
+        for cond in ({"$gt": 0}, {"$gte": 1}, {"$lt": 1}, {"$lte": 5}, True, 0):
+            query = {"config.enforce": cond}
+            ours = sorted(d["droneid"] for d in sqlite.filter(RegisteredDrone, query))
+            assert ours == sorted(d["droneid"] for d in src.filter(RegisteredDrone, query)), cond
+
+    def test_adds_latest_to_old_databases(self, tmp_path):
+        import json
+        import sqlite3
+        from util.sqlite_backend import SqliteBackend
+
+        path = str(tmp_path / "old.sqlite3")
+        conn = sqlite3.connect(path)
+        conn.execute(
+            "CREATE TABLE documents (collection TEXT NOT NULL, pk TEXT NOT NULL, droneid TEXT, "
+            "discordid INTEGER, expires REAL, data TEXT NOT NULL, PRIMARY KEY (collection, pk))"
+        )
+        attrs = {"pk": "old", "droneid": "OLD1", "config": {"enforce": 300.0}}
+        conn.execute(
+            "INSERT INTO documents VALUES ('registereddrone', 'old', 'OLD1', NULL, 300.0, ?)",
+            (json.dumps(attrs),),
+        )
+        conn.commit()
+        conn.close()
+        later = SqliteBackend(path).filter(RegisteredDrone, {"config.enforce": {"$gt": 200}})
+        assert [d["droneid"] for d in later] == ["OLD1"]
+
+    def test_save_replaces_and_delete_removes(self, sqlite):
+        d = RegisteredDrone({"droneid": "REPL", "discordid": 100000000000000202})
+        sqlite.save(d)
+        d["droneid"] = "REP2"
+        sqlite.save(d)
+        assert len(sqlite.filter(RegisteredDrone, {})) == 1
+        sqlite.delete(d)
+        assert sqlite.filter(RegisteredDrone, {}) == []
+
+    def test_migrates_file_backend_once(self, sqlite, tmp_path):
+        from blitzdb import FileBackend
+
+        src = FileBackend(str(tmp_path / "db"))
+        src.autocommit = True
+        src.save(RegisteredDrone({"droneid": "MIGR", "discordid": 100000000000000203}))
+        assert sqlite.migrate_from(str(tmp_path / "db"), [RegisteredDrone]) == 1
+        assert sqlite.migrate_from(str(tmp_path / "db"), [RegisteredDrone]) == 0
+        assert sqlite.get(RegisteredDrone, {"droneid": "MIGR"})["discordid"] == 100000000000000203
+
+
+@pytest.mark.asyncio
+class TestAsyncStorage:
+    async def test_asave_then_read(self):
+        from util.storage import DroneChannel, aget_channel, aget_drone
+
+        d = RegisteredDrone({"discordid": 100000000000000301, "droneid": "ASYN"})
+        c = DroneChannel({"discordid": 100000000000000302, "config": {}})
+        await Storage.asave(d)
+        await Storage.asave(c)
+        assert await aget_drone("ASYN") is d
+        assert (await aget_channel({"discordid": 100000000000000302})).pk == c.pk
+        await Storage.adelete(d)
+        await Storage.adelete(c)
+        assert await aget_drone("ASYN") is None
+        assert await aget_channel({"discordid": 100000000000000302}) is None
+        await Storage.aflush()
+
+    async def test_coalesces_repeated_saves(self):
+        from util.storage import DroneChannel, aget_channel
+
+        c = DroneChannel({"discordid": 100000000000000303, "config": {}})
+        for mode in ("enforcedrones", "enforceall", "enforcedrones"):
+            c["config"] = {mode: True}
+            await Storage.asave(c)
+        assert [k for k in Storage._pending if k[1] == c.pk] == [("DroneChannel", c.pk)]
+        await Storage.aflush()
+        assert not Storage._pending and not Storage._inflight
+        stored = await aget_channel({"discordid": 100000000000000303})
+        assert stored["config"] == {"enforcedrones": True}
+        await Storage.adelete(stored)
+        await Storage.aflush()
+        assert await aget_channel({"discordid": 100000000000000303}) is None
+
+    async def test_writes_document_as_queued(self):
+        from util.storage import DroneChannel
+
+        c = DroneChannel({"discordid": 100000000000000304, "config": {}})
+        await Storage.asave(c)
+        c["config"]["enforceall"] = True  # Changed after the save, not saved again
+        await Storage.aflush()
+        stored = Storage.call(lambda: Storage.backend.get(DroneChannel, {"pk": c.pk}))
+        assert stored["config"] == {}
+        await Storage.adelete(c)
+        await Storage.aflush()
+
+    async def test_failed_commit_is_retried(self, monkeypatch):
+        import asyncio
+        from unittest.mock import MagicMock
+        from util.storage import DroneChannel, aget_channel
+
+        commit = Storage._commit
+        calls = []
+
+        def flaky(batch):
+            calls.append(batch)
+            if len(calls) == 1:
+                raise OSError("disk full")
+            commit(batch)
+
+        monkeypatch.setattr(Storage, "_commit", flaky)
+        monkeypatch.setattr(Storage, "flush_window", 0.01)
+        monkeypatch.setattr(Storage, "retry_window", 0.05)
+        monkeypatch.setattr(Storage, "logger", MagicMock())
+        c = DroneChannel({"discordid": 100000000000000305, "config": {}})
+        await Storage.asave(c)
+        await asyncio.sleep(0.3)
+        assert len(calls) == 2
+        Storage.logger.exception.assert_called_once()
+        assert not Storage._pending and not Storage._inflight
+        monkeypatch.undo()
+        await Storage.adelete(await aget_channel({"discordid": 100000000000000305}))
+        await Storage.aflush()
+
+
+def test_get_drones_keeps_input_order():
+    from util.storage import get_drones
+
+    ds = [
+        RegisteredDrone({"discordid": 100000000000000061 + n, "droneid": f"TSB{n}"}) for n in range(3)
+    ]
+    for d in ds:
+        Storage.save(d)
+    found = get_drones(["TSB2", 100000000000000061, "ZZZZ", "bad", 100000000000000062, "TSB0"])
+    assert found == [ds[2], ds[0], ds[1], ds[0]]
+    for d in ds:
+        Storage.delete(d)
@@ -0,0 +1,39 @@
+import asyncio
+import time
+
+import pytest
+from unittest.mock import MagicMock
+from util.watchdog import LoopWatchdog
+
+
+def block_the_loop():
+    time.sleep(0.3)
+
+
+@pytest.mark.asyncio
+async def test_reports_blocking_stack():
+    logger = MagicMock()
+    sentry = MagicMock()
+    w = LoopWatchdog(logger, sentry, threshold=0.1, interval=0.02)
+    w.start()
+    await asyncio.sleep(0.05)
+    block_the_loop()
+    await asyncio.sleep(0.05)
+    w.stop()
+    assert w.stalls == 1
+    assert w.max_lag >= 0.2
+    report = logger.warning.call_args_list[0].args[0]
+    assert "block_the_loop" in report
+    sentry.capture_message.assert_called_once()
+    assert "blocked for" in logger.warning.call_args_list[1].args[0]
+
+
+@pytest.mark.asyncio
+async def test_quiet_when_loop_is_free():
+    logger = MagicMock()
+    w = LoopWatchdog(logger, threshold=0.1, interval=0.02)
+    w.start()
+    await asyncio.sleep(0.15)
+    w.stop()
+    assert w.stalls == 0
+    logger.warning.assert_not_called()
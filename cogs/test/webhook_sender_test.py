@@ -0,0 +1,47 @@
+import asyncio
+import time
+
+import pytest
+from unittest.mock import AsyncMock
+from util.webhook_sender import Throttled, WebhookSender
+
+
+@pytest.fixture
+def hook():
+    hook = AsyncMock(name="webhook")
+    hook.id = 1234
+    return hook
+
+
+@pytest.mark.asyncio
+class TestWebhookSender:
+    async def test_turns_sends_away_when_bucket_is_empty(self, hook):
+        s = WebhookSender(limit=2, per=0.2)
+        for n in range(2):
+            await s.send(hook, content=str(n))
+        with pytest.raises(Throttled) as e:
+            await s.send(hook, content="2")
+        assert 0 < e.value.delay <= 0.2 and s.throttled == e.value.delay
+        assert hook.send.call_count == 2 and s.sent == 2
+        await asyncio.sleep(e.value.delay)
+        await s.send(hook, content="2")
+        assert hook.send.call_count == 3
+
+    async def test_buckets_follow_headers(self, hook):
+        s = WebhookSender(limit=5, per=2.0)
+        s.bucket(hook.id).update("5", "0", "0.1", time.monotonic())
+        assert 0 < s.wait_time(hook.id) <= 0.1
+        with pytest.raises(Throttled):
+            await s.send(hook, content="x")
+        await asyncio.sleep(s.wait_time(hook.id))
+        await s.send(hook, content="x")
+        hook.send.assert_called_once_with(content="x")
+
+    async def test_picks_least_loaded(self, hook):
+        s = WebhookSender(limit=5, per=2.0)
+        other = AsyncMock(name="other")
+        other.id = 5678
+        await s.send(hook, content="x")
+        assert s.pick([hook, other]) is other
+        s.bucket(other.id).update("5", "0", "1", time.monotonic())
+        assert s.pick([hook, other]) is hook
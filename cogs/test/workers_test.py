@@ -0,0 +1,167 @@
+import asyncio
+import os
+import pickle
+import runpy
+import subprocess
+import sys
+
+import discord
+import pytest
+from aiohttp import web
+from unittest.mock import AsyncMock, MagicMock
+
+import util.workers
+from util import load_codes, load_hives, load_filters, metrics
+from util.workers import FilterRecord, FilterWorker, FilterWorkers
+
+
+def record(**kwargs):
+    fields = dict(
+        channel_id=100000000000000001,
+        message_id=100000000000000002,
+        content="TSTN :: Y helo thar",
+        author_name="tstn",
+        avatar_url="https://example.com/a.png",
+        drone={"discordid": 100000000000000001, "droneid": "TSTN", "hive": "lapine/unaffiliated"},
+        ssh_drone=None,
+        ssh_name=None,
+        ssh_avatar=None,
+        channel_conf={},
+        reply=None,
+        hooks=[(1, "token")],
+    )
+    fields.update(kwargs)
+    return FilterRecord(**fields)
+
+
+@pytest.fixture
+def worker():
+    load_codes()
+    load_hives()
+    load_filters()
+    sender = MagicMock()
+    sender.send = AsyncMock()
+    return FilterWorker(AsyncMock(name="http"), sender, MagicMock(name="deleter"))
+
+
+@pytest.mark.asyncio
+class TestFilterWorker:
+    async def test_relays_and_deletes(self, worker):
+        await worker.handle(record())
+        worker.sender.partial.assert_called_once_with(1, "token")
+        kwargs = worker.sender.send.call_args.kwargs
+        assert kwargs["content"] == "TSTN :: ☼ :: Y helo thar"
+        assert kwargs["username"] == "tstn" and kwargs["embed"] is None
+        deleted = worker.deleter.delete.call_args.args[0]
+        assert (deleted.channel.id, deleted.id) == (100000000000000001, 100000000000000002)
+
+    async def test_deletes_wrong_prefix_through_http(self, worker):
+        await worker.handle(record(content="1234 :: Y helo thar"))
+        worker.sender.send.assert_not_called()
+        deleted = worker.deleter.delete.call_args.args[0]
+        await deleted.delete()
+        worker.http.delete_message.assert_called_once_with(100000000000000001, 100000000000000002)
+
+    async def test_reports_result_with_timings(self, worker, monkeypatch):
+        monkeypatch.setattr(metrics, "_stage_log", [])  # As collect_stages() does in a worker process
+        worker.results = MagicMock()
+        await worker.handle(record())
+        res = worker.results.put.call_args.args[0]
+        assert (res.action, res.hive) == ("relay", "lapine/unaffiliated")
+        assert {"format_code", "filter", "send"} <= {name for name, _ in res.stages}
+        assert metrics.take_stages() == []
+
+    async def test_passes_plain_chat(self, worker):
+        await worker.handle(record(content="Y helo thar"))
+        worker.sender.send.assert_not_called()
+        worker.deleter.delete.assert_not_called()
+
+
+def test_record_pickles():
+    rec = record(reply={"description": "hi"})
+    assert pickle.loads(pickle.dumps(rec)) == rec
+
+
+def worker_main_on_fake_api(*args):
+    """Runs in the spawned worker: points discord.py at the test's fake API, then starts the real worker."""
+    base = f"http://127.0.0.1:{os.environ['DRONEOS_TEST_API_PORT']}/api/v10"
+    discord.http.Route.base = property(lambda self: base)
+    util.workers._worker_main(*args)
+
+
+@pytest.mark.asyncio
+async def test_spawned_worker_relays_and_deletes(monkeypatch, unused_tcp_port):
+    seen = asyncio.Queue()
+
+    async def me(request):
+        user = {"id": "1", "username": "DroneOS", "discriminator": "0001", "avatar": None}
+        return web.json_response(user)
+
+    async def relay(request):
+        await seen.put(("relay", request.match_info["id"], (await request.json())["content"]))
+        return web.Response(status=204)
+
+    async def delete(request):
+        await seen.put(("delete", request.match_info["channel"], request.match_info["message"]))
+        return web.Response(status=204)
+
+    app = web.Application()
+    app.router.add_get("/api/v10/users/@me", me)
+    app.router.add_post("/api/v10/webhooks/{id}/{token}", relay)
+    app.router.add_delete("/api/v10/channels/{channel}/messages/{message}", delete)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", unused_tcp_port).start()
+    monkeypatch.setenv("DRONEOS_TEST_API_PORT", str(unused_tcp_port))
+    monkeypatch.setattr(util.workers, "_worker_main", worker_main_on_fake_api)
+
+    workers = FilterWorkers(1, "token", log_level="WARNING")
+    workers.start()
+    try:
+        workers.submit(record())
+        got = {await asyncio.wait_for(seen.get(), 30) for _ in range(2)}
+    finally:
+        await workers.stop()
+        await runner.cleanup()
+    assert got == {
+        ("relay", "1", "TSTN :: \u263c :: Y helo thar"),
+        ("delete", "100000000000000001", "100000000000000002"),
+    }
+    assert workers.handled == 1  # Counted in this process's metrics
+
+
+def test_main_is_inert_when_reimported():
+    # What a spawned worker does with the parent's main script: it must not start a second bot.
+    ns = runpy.run_path("main.py", run_name="__mp_main__")
+    assert "main" in ns and "bot" not in ns
+
+
+def test_worker_modules_leave_storage_alone():
+    # Importing util.storage opens the database and loads the drone registry, which a worker has no use for.
+    code = "import sys, util.workers; sys.exit('util.storage' in sys.modules)"
+    assert subprocess.run([sys.executable, "-c", code]).returncode == 0
+
+
+@pytest.mark.asyncio
+async def test_stop_leaves_the_loop_running():
+    import time
+
+    workers = FilterWorkers(2, "token")
+    procs = [
+        MagicMock(join=lambda timeout: time.sleep(0.2), is_alive=lambda: False) for _ in range(2)
+    ]
+    workers._procs, workers._queues = procs, [MagicMock(), MagicMock()]
+    ticks = 0
+
+    async def tick():
+        nonlocal ticks
+        while True:
+            await asyncio.sleep(0.01)
+            ticks += 1
+
+    ticker = asyncio.ensure_future(tick())
+    start = time.monotonic()
+    await workers.stop()
+    ticker.cancel()
+    assert time.monotonic() - start < 0.35  # Joined side by side
+    assert ticks >= 5 and not workers._procs
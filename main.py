@@ -2,13 +2,23 @@
 import atexit
 import sys
 import traceback
+import asyncio
 from abc import ABC
 
 import discord
-import yaml
-from discord.ext.commands.bot import Bot
+from discord.commands import ApplicationContext
+from discord.ext.commands.bot import Bot, AutoShardedBot
 
-from util import log, update_guilds, load_codes, load_hives, load_filters, load_config
+from util import log, update_guilds, install_codes, install_hives, install_filters, install_config
+from util import metrics
+from util.metrics import MetricsServer
+from util.reloader import Reloader
+from util.watchdog import LoopWatchdog
+from util.shards import ShardStats, shard_of
+from util.startup import StartupTimer, load_snapshot
+from util.storage import Storage
+from util import storage_profile
+from util.storage_profile import StorageProfiler
 
 
 # noinspection PyDunderSlots
@@ -16,34 +26,69 @@ class DroneOS(Bot, ABC):
     config = None
     ready = False
     sentry = None
+    metrics = None
     logger = None
 
     # noinspection PyUnresolvedReferences
-    def __init__(self, bot_config: dict = None):
-        i = discord.Intents()
-        i.guilds = True
-        i.members = True
-        i.messages = True
-        i.message_content = True
-        self.loaded = False
-        super().__init__(bot_config["system"]["command_prefix"], intents=i)
-        self.config = bot_config
-        self.logger = log.init_logger("bot", bot_config["system"]["log_level"])
-        self.logger.info("init: version 1.2 booting")
-        self.atshutdown = []
-        update_guilds(bot_config["system"]["guilds"])
-        load_codes()
-        load_hives()
-        load_filters()
-        load_config()  # For usage in util packages
+    def __init__(self, snapshot, timer: StartupTimer):
+        bot_config = snapshot.config
+        with timer.phase("client"):
+            i = discord.Intents()
+            i.guilds = True
+            i.members = True
+            i.messages = True
+            i.message_content = True
+            self.loaded = False
+            super().__init__(
+                bot_config["system"]["command_prefix"], intents=i, **self.shard_options(bot_config)
+            )
+            self.config = bot_config
+            system = bot_config["system"]
+            self.logger = log.init_logger(
+                "bot", system["log_level"], system.get("log_format", "text")
+            )
+            self.logger.info("init: version 1.2 booting")
+            self.atshutdown = []
+            self.atclose = []  # Coroutine functions awaited in close(), while the loop is still running
+            update_guilds(bot_config["system"]["guilds"])
+        with timer.phase("definitions"):
+            install_codes(snapshot.codes)
+            install_hives(snapshot.hives)
+            install_filters(snapshot.filters)
+            install_config(bot_config)  # For usage in util packages
+            self.reloader = Reloader(self.logger, bot_config["system"].get("reload_interval", 5))
+        with timer.phase("storage"):
+            storage_conf = bot_config["system"].get("storage") or {}
+            storage_kind = storage_conf.get("backend", "file")
+            Storage.open(storage_kind, storage_conf.get("path"))
+            Storage.flush_window = storage_conf.get("flush_window", Storage.flush_window)
+            Storage.logger = self.logger
+            self.logger.info(f"storage: {storage_kind} backend, {len(Storage.drones)} drones")
+            self.atshutdown.append(Storage.close)
+            if storage_conf.get("profile"):
+                profiler = StorageProfiler(Storage, self.logger)
+                profiler.install()
+                self.atshutdown.append(lambda: self.logger.info("\n".join(profiler.summary())))
+                self.logger.warning("storage: profiling enabled")
 
         # Sentry.io integration
         if "sentry" in self.config.keys():
-            import sentry_sdk
-
-            self.sentry = sentry_sdk
-            self.sentry.init(self.config["sentry"]["init_url"], environment="production")
-            self.logger.warning("sentry: integration enabled")
+            with timer.phase("sentry"):
+                import sentry_sdk
+
+                self.sentry = sentry_sdk
+                self.sentry.init(self.config["sentry"]["init_url"], environment="production")
+                self.logger.warning("sentry: integration enabled")
+        self.watchdog = LoopWatchdog(
+            self.logger,
+            self.sentry,
+            bot_config["system"].get("loop_lag_threshold", 2.0),
+            bot_config["system"].get("loop_lag_interval", 1.0),
+        )
+        self.logger.debug(f"init: {timer.report()}")
+
+    def shard_options(self, bot_config: dict) -> dict:
+        return {}
 
     async def on_error(self, event, *args, **kwargs):
         exc = sys.exc_info()
@@ -71,34 +116,140 @@ class DroneOS(Bot, ABC):
                     self.logger.error(f"{n} start error")
                     continue
             self.loaded = True
+            self.reloader.start()
+            self.atshutdown.append(self.reloader.stop)
+            self.watchdog.start()
+            self.atshutdown.append(self.watchdog.stop)
+            await self.start_metrics()
+
+    async def start_metrics(self):
+        """Serves Prometheus metrics if `metrics` is set in config.yml."""
+        conf = self.config["system"].get("metrics")
+        if not conf:
+            return
+        metrics.drone_lookups.fn = lambda: {
+            ("hit",): Storage.drones.hits,
+            ("miss",): Storage.drones.misses,
+        }
+        metrics.shard_latency.fn = lambda: {("0",): self.latency}
+        metrics.loop_lag.fn = lambda: self.watchdog.lag
+        metrics.loop_stalls.fn = lambda: self.watchdog.stalls
+        host, port = conf.get("host", "127.0.0.1"), conf.get("port", 9108)
+        self.metrics = MetricsServer(host, port, self.logger)
+        try:
+            await self.metrics.start()
+        except OSError as e:
+            self.logger.error(f"metrics: can't listen on {host}:{port} ({e})")
 
     async def on_ready(self):
-        self.logger.info("reached runlevel 5")
-        self.logger.info(self.guilds)
+        self.logger.info("reached runlevel 5 in %d guilds", len(self.guilds))
+        self.logger.debug("guilds: %s", self.guilds)
         await self.sync_commands()
 
+    async def invoke_application_command(self, ctx: ApplicationContext):
+        with storage_profile.scope(f"/{ctx.command.qualified_name}"):
+            await super().invoke_application_command(ctx)
+
     async def on_join_guild(self, guild):
-        self.logger.info(f"Invited to a guild: {guild}")
+        self.logger.info(f"Invited to a guild: {guild} (shard {guild.shard_id})")
         update_guilds(self.guilds)
 
     async def on_guild_remove(self, guild):
-        self.logger.info(f"Removed from a guild: {guild}")
+        self.logger.info(f"Removed from a guild: {guild} (shard {guild.shard_id})")
         update_guilds(self.guilds)
 
     # Seems to randomly trigger despite not actually being disconnected.
     # async def on_disconnect(self):
     #     self.logger.warning("Disconnected!")
 
+    async def close(self):
+        while self.atclose:
+            f = self.atclose.pop(0)
+            try:
+                await f()
+            except Exception:
+                self.logger.exception(f"close: {f} failed")
+        await super().close()
+
     def shutdown(self):
         self.logger.warning("Shutting down")
         for f in self.atshutdown:
             self.logger.debug("Executing shutdown triggers: ")
             f()
+        log.stop(self.logger)
+
 
+class ShardedDroneOS(DroneOS, AutoShardedBot):
+    """DroneOS spread over several gateway connections in one process, for when a single websocket can't keep up.
+    Turned on by `shards` in config.yml: a shard count, or `auto` to use the count Discord recommends."""
 
-with open("config.yml", "r") as file:
-    conf = yaml.safe_load(file)
+    def __init__(self, snapshot, timer: StartupTimer):
+        self.shard_stats = ShardStats()
+        super().__init__(snapshot, timer)
 
-bot = DroneOS(bot_config=conf)
-atexit.register(bot.shutdown)
-bot.run(conf["system"]["bot_token"])
+    def shard_options(self, bot_config: dict) -> dict:
+        shards = bot_config["system"].get("shards")
+        return {"shard_count": shards} if isinstance(shards, int) else {}
+
+    async def start_metrics(self):
+        await super().start_metrics()
+        metrics.shard_latency.fn = lambda: {(str(s),): lat for s, lat in self.latencies}
+        metrics.shard_events.fn = lambda: {(str(s),): n for s, n in self.shard_stats.events.items()}
+
+    def dispatch(self, event_name: str, *args, **kwargs):
+        self.shard_stats.record(shard_of(args))
+        super().dispatch(event_name, *args, **kwargs)
+
+    async def on_connect(self):
+        first = not self.loaded
+        await super().on_connect()
+        if first:
+            interval = self.config["system"].get("shard_report_interval", 300)
+            if interval:
+                asyncio.ensure_future(self.report_shards(interval))
+
+    async def on_shard_connect(self, shard_id: int):
+        self.logger.info(f"shard {shard_id}: eth0 up")
+
+    async def on_shard_ready(self, shard_id: int):
+        n = sum(1 for g in self.guilds if g.shard_id == shard_id)
+        self.logger.info(f"shard {shard_id}: ready with {n} guilds")
+
+    async def on_shard_resumed(self, shard_id: int):
+        self.logger.info(f"shard {shard_id}: session resumed")
+
+    async def on_shard_disconnect(self, shard_id: int):
+        self.logger.warning(f"shard {shard_id}: disconnected")
+
+    async def report_shards(self, interval: float):
+        """Logs each shard's latency and event rate every `interval` seconds."""
+        while True:
+            await asyncio.sleep(interval)
+            rates = self.shard_stats.rates()
+            for shard_id, latency in self.latencies:
+                self.logger.info(
+                    f"shard {shard_id}: latency {latency * 1000:.0f}ms, "
+                    f"{rates.get(shard_id, 0.0):.1f} events/s"
+                )
+
+
+def main():
+    startup = StartupTimer()
+    with startup.phase("snapshot"):
+        snap = load_snapshot()
+
+    bot = (ShardedDroneOS if snap.config["system"].get("shards") else DroneOS)(
+        snapshot=snap, timer=startup
+    )
+    if "--profile-startup" in sys.argv:
+        # Report where start-up time goes and stop before connecting
+        bot.logger.info(f"init: {startup.report()}")
+        bot.shutdown()
+        sys.exit(0)
+    atexit.register(bot.shutdown)
+    bot.run(snap.config["system"]["bot_token"])
+
+
+# Filter worker processes are spawned, and spawn imports this file again as __mp_main__ in each one.
+if __name__ == "__main__":
+    main()
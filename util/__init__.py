@@ -1,14 +1,19 @@
 import discord
-from typing import Any, Union
+from typing import Any, Dict, Optional, Tuple, Union
 import yaml
 import os
 
+from util.matchers import HiveFilter, CodeIndex
+
 guilds = []
 hivemap = {}
 fhivemap = []
 filters = {}
+hive_filters = {}  # Hive name -> compiled HiveFilter, rebuilt by load_filters
 config = {}
-codes = None
+FALLBACK_HIVE = "lapine/unaffiliated"  # Stands in for a drone's hive when it has no entry of its own
+codes = {}  # Code namespace (file name in codes/ without .yml) -> {code: meaning}
+code_indexes = {}  # Code namespace -> compiled CodeIndex
 
 
 def mkembed(kind: str, description: str, **kwargs) -> discord.Embed:
@@ -39,30 +44,119 @@ def aget(listlike: Union[list, tuple], index: int, default: Any) -> Any:
         return default
 
 
+def read_codes() -> Tuple[Dict[str, dict], Dict[str, CodeIndex]]:
+    """Parses and compiles every file in codes/ without touching the live tables. Raises ValueError if a file
+    isn't a mapping of codes."""
+    new = {}
+    for codefile in sorted(os.listdir("codes")):
+        with open(os.path.join("codes", codefile), "r") as f:
+            parsed = yaml.safe_load(f) or {}
+        if not isinstance(parsed, dict):
+            raise ValueError(f"codes/{codefile} is not a mapping of codes")
+        new[os.path.splitext(codefile)[0]] = parsed
+    return new, {ns: CodeIndex(c) for ns, c in new.items()}
+
+
+def install_codes(parsed: Tuple[Dict[str, dict], Dict[str, CodeIndex]]):
+    new, compiled = parsed
+    codes.clear()
+    codes.update(new)
+    code_indexes.clear()
+    code_indexes.update(compiled)
+
+
 def load_codes():
-    """Populates util.codes with the contents of codes.yml"""
-    global codes
-    codes = {}
-    for codefiles in os.listdir("codes"):
-        with open(os.path.join("codes", codefiles), 'r') as f:
-            codes.update(yaml.safe_load(f))
+    """Populates util.codes and util.code_indexes with one namespace per file in codes/, updating them in place."""
+    install_codes(read_codes())
 
 
-def load_hives():
+def find_code(content: str, hive: str) -> (Optional[str], Optional[str]):
+    """Returns the longest status code `content` starts with and its meaning, looking only in the code namespaces
+    listed under `codes` for `hive` in hives.yml (every namespace if it lists none). Earlier namespaces win ties."""
+    namespaces = hivemap.get(hive, {}).get("codes") or code_indexes.keys()
+    best = None
+    for ns in namespaces:
+        idx = code_indexes.get(ns)
+        code = idx.longest(content) if idx else None
+        if code and (not best or len(code) > len(best[0])):
+            best = (code, idx.codes[code])
+    return best or (None, None)
+
+
+def read_hives() -> dict:
+    """Parses hives.yml. Raises ValueError unless every hive has a `sym` and an `owner`, every code namespace
+    it lists is a file in codes/, and the fallback hive is there."""
     with open("hives.yml", "r") as f:
-        global hivemap
-        global fhivemap
-        hivemap = yaml.safe_load(f)
-        fhivemap = [f"{x}, {hivemap[x]['sym']}" for x in hivemap.keys()]
+        new = yaml.safe_load(f) or {}
+    if not isinstance(new, dict):
+        raise ValueError("hives.yml is not a mapping of hives")
+    namespaces = {os.path.splitext(f)[0] for f in os.listdir("codes")}
+    for hive, conf in new.items():
+        if not isinstance(conf, dict) or "sym" not in conf or "owner" not in conf:
+            raise ValueError(f"hive {hive} needs a sym and an owner")
+        if not isinstance(conf.get("codes") or [], list):
+            raise ValueError(f"codes for hive {hive} must be a list")
+        unknown = [ns for ns in conf.get("codes") or [] if ns not in namespaces]
+        if unknown:
+            unknown = ", ".join(map(str, unknown))
+            raise ValueError(f"hive {hive} lists codes that aren't in codes/: {unknown}")
+    if FALLBACK_HIVE not in new:
+        raise ValueError(f"hives.yml has no {FALLBACK_HIVE}, which hiveless drones fall back to")
+    return new
 
 
-def load_filters():
+def get_hive(hive: str) -> dict:
+    """Returns `hive`'s entry in hives.yml, or the fallback hive's if it has none (say it was removed)."""
+    return hivemap.get(hive) or hivemap[FALLBACK_HIVE]
+
+
+def install_hives(new: dict):
+    hivemap.clear()
+    hivemap.update(new)
+    fhivemap[:] = [f"{x}, {hivemap[x]['sym']}" for x in hivemap.keys()]
+
+
+def load_hives():
+    """Populates util.hivemap and util.fhivemap from hives.yml, updating them in place."""
+    install_hives(read_hives())
+
+
+def read_filters() -> Tuple[dict, Dict[str, HiveFilter]]:
+    """Parses and compiles filters.yml. Raises ValueError if a hive's filters aren't a mapping, or the fallback
+    hive has none."""
     with open("filters.yml", "r") as f:
-        global filters
-        filters = yaml.safe_load(f)
+        new = yaml.safe_load(f) or {}
+    if not isinstance(new, dict) or not all(v is None or isinstance(v, dict) for v in new.values()):
+        raise ValueError("filters.yml must map each hive to its filters")
+    if FALLBACK_HIVE not in new:
+        raise ValueError(f"filters.yml has no {FALLBACK_HIVE}, which hives without filters fall back to")
+    return new, {hive: HiveFilter(entries) for hive, entries in new.items()}
 
 
-def load_config():
+def install_filters(parsed: Tuple[dict, Dict[str, HiveFilter]]):
+    new, compiled = parsed
+    filters.clear()
+    filters.update(new)
+    hive_filters.clear()
+    hive_filters.update(compiled)
+
+
+def load_filters():
+    """Populates util.filters from filters.yml and compiles util.hive_filters from it. Both are updated in place so
+    modules holding a reference see the new filters."""
+    install_filters(read_filters())
+
+
+def read_config() -> dict:
     with open("config.yml", "r") as f:
-        global config
-        config = yaml.safe_load(f)
+        return yaml.safe_load(f)
+
+
+def install_config(new: dict):
+    config.clear()
+    config.update(new)
+
+
+def load_config():
+    """Populates util.config from config.yml, updating it in place."""
+    install_config(read_config())
@@ -1,55 +1,56 @@
-from typing import Optional
+from typing import List
 
 import discord
 
 from util import mkembed, hivemap, config
-from util.storage import RegisteredDrone, Storage, get_drone
+from util.storage import RegisteredDrone, Storage, get_drones, aget_drone
 
 
 def has_access(source: RegisteredDrone, target: RegisteredDrone) -> bool:
-    """Returns true if `source` is in `target`'s access list"""
-    target_al = target.get("access", None)
-    if not target_al:
-        target["access"] = [target["discordid"]]
-        Storage.backend.save(target)
+    """Returns true if `source` may control `target`: it is `target` itself, on `target`'s access list, the owner of
+    `target`'s hive or the Director. Answered from the registry's access index, nothing is read or written."""
+    source_id = int(source["discordid"])
+    return (
+        source_id == int(target["discordid"])
+        or source_id in Storage.drones.controllers_of(target)
+        or source_id == hivemap.get(target["hive"], {}).get("owner")
+        or source_id == config["system"]["owner"]  # Director
+    )
 
-    if source["discordid"] in target["access"]:
-        return True
-    elif source["discordid"] == get_drone_hive_owner(target)["discordid"]:
-        return True
-    elif source["discordid"] == config["system"]["owner"]:  # Director
-        return True
-    else:
-        return False
 
+def access_list(drone: RegisteredDrone) -> List[int]:
+    """Returns `drone`'s access list. Drones that have never had one are on their own."""
+    return list(drone.get("access") or [drone["discordid"]])
 
-def grant_access(from_drone: RegisteredDrone, to_drone: RegisteredDrone) -> bool:
+
+async def grant_access(from_drone: RegisteredDrone, to_drone: RegisteredDrone) -> bool:
     """Adds `from_drone`'s discord ID to the access list of `to_drone`"""
     if has_access(from_drone, to_drone):
         return False
     else:
-        to_drone["access"].append(from_drone["discordid"])
-        Storage.backend.save(to_drone)
+        to_drone["access"] = access_list(to_drone) + [from_drone["discordid"]]
+        await Storage.asave(to_drone)
         return True
 
 
-def revoke_access(from_drone: RegisteredDrone, to_drone: RegisteredDrone) -> bool:
+async def revoke_access(from_drone: RegisteredDrone, to_drone: RegisteredDrone) -> bool:
     """Removes `from_drone`'s discord ID from the access list of `to_drone`"""
-    if not has_access(from_drone, to_drone):
+    if int(from_drone["discordid"]) not in Storage.drones.controllers_of(to_drone):
         return False
     else:
-        to_drone["access"].remove(from_drone["discordid"])
-        Storage.backend.save(to_drone)
+        to_drone["access"] = [i for i in access_list(to_drone) if i != from_drone["discordid"]]
+        await Storage.asave(to_drone)
         return True
 
 
+def controlled_drones(controller: RegisteredDrone) -> List[RegisteredDrone]:
+    """Returns the drones whose access lists `controller` is on, other than itself."""
+    ids = Storage.drones.controlled_by(controller["discordid"]) - {int(controller["discordid"])}
+    return sorted(accesslist_to_dronelist(ids), key=lambda d: d["droneid"])
+
+
 def accesslist_to_dronelist(accesslst: [int]) -> [RegisteredDrone]:
-    r = []
-    for i in accesslst:
-        db_drone = get_drone(i)
-        if db_drone:
-            r.append(db_drone)
-    return r
+    return get_drones(accesslst)
 
 
 async def get_command_drones(
@@ -61,10 +62,10 @@ async def get_command_drones(
     longer Discord ID. Returns an optional Embed in the third position as an error, this should be sent to the invoking
     user and the caller should return early if present. If `chkaccess` is true, also checks that `operator` is in
     `target`'s access list."""
-    operator_drone = get_drone(operator)
+    operator_drone = await aget_drone(operator)
     if not operator_drone:
         return None, None, mkembed("error", "`You do not appear to be a registered drone.`")
-    target_drone = get_drone(target)
+    target_drone = await aget_drone(target)
     if not target_drone:
         return (
             operator_drone,
@@ -76,8 +77,3 @@ async def get_command_drones(
             return operator_drone, target_drone, mkembed("error", "`Permission denied.`")
     return operator_drone, target_drone, None
 
-
-def get_drone_hive_owner(drone: RegisteredDrone) -> Optional[RegisteredDrone]:
-    owner_id = hivemap[drone["hive"]]["owner"]
-    drone_owner = get_drone(owner_id)
-    return drone_owner
@@ -0,0 +1,109 @@
+import asyncio
+import datetime
+from collections import OrderedDict
+from typing import Dict, Set
+
+import discord
+
+from util.metrics import stage
+
+BULK_MAX = 100  # Most messages one bulk delete accepts
+# Older messages can't be bulk deleted, with a minute's leeway for clock skew
+BULK_MAX_AGE = datetime.timedelta(days=14) - datetime.timedelta(minutes=1)
+
+
+class DeleteBatcher:
+    """Collects deletes per channel for `window` seconds and sends them as bulk deletes where Discord allows it."""
+
+    def __init__(self, window: float = 0.3, logger=None, remember: int = 1000):
+        self.window = window
+        self.logger = logger
+        self.remember = remember
+        self.bulk = 0  # Bulk delete calls made
+        self.single = 0  # Single delete calls made
+        self._pending: Dict[int, Dict[int, discord.Message]] = {}  # Channel ID -> message ID -> message
+        self._timers: Dict[int, asyncio.Task] = {}
+        self._done: "OrderedDict[int, None]" = OrderedDict()  # Recently deleted message IDs
+        self._deleting: Set[int] = set()  # Message IDs with a delete call under way
+
+    def delete(self, msg: discord.Message):
+        """Queues `msg` for deletion."""
+        if msg.id in self._done or msg.id in self._deleting:
+            return
+        pending = self._pending.setdefault(msg.channel.id, {})
+        if msg.id in pending:
+            return
+        pending[msg.id] = msg
+        if msg.channel.id not in self._timers:
+            self._timers[msg.channel.id] = asyncio.ensure_future(self._later(msg.channel.id))
+
+    def depth(self) -> int:
+        return sum(len(p) for p in self._pending.values())
+
+    async def _later(self, channel_id: int):
+        await asyncio.sleep(self.window)
+        self._timers.pop(channel_id, None)
+        await self._flush_channel(channel_id)
+
+    async def flush(self):
+        """Deletes everything queued right away."""
+        for t in self._timers.values():
+            t.cancel()
+        self._timers.clear()
+        for channel_id in list(self._pending):
+            await self._flush_channel(channel_id)
+
+    def _forget(self, msgs):
+        for m in msgs:
+            self._done[m.id] = None
+        while len(self._done) > self.remember:
+            self._done.popitem(last=False)
+
+    async def _flush_channel(self, channel_id: int):
+        msgs = list(self._pending.pop(channel_id, {}).values())
+        if not msgs:
+            return
+        self._deleting.update(m.id for m in msgs)
+        try:
+            await self._delete(msgs)
+        finally:
+            self._deleting.difference_update(m.id for m in msgs)
+
+    async def _delete(self, msgs):
+        single = msgs
+        if len(msgs) > 1:
+            cutoff = discord.utils.utcnow() - BULK_MAX_AGE
+            bulk = [m for m in msgs if discord.utils.snowflake_time(m.id) > cutoff]
+            single = [m for m in msgs if m not in bulk]
+            if len(bulk) == 1:
+                single = bulk + single
+                bulk = []
+            channel = msgs[0].channel
+            for n in range(0, len(bulk), BULK_MAX):
+                chunk = bulk[n : n + BULK_MAX]
+                try:
+                    with stage("delete"):
+                        await channel.delete_messages(chunk)
+                    self.bulk += 1
+                    self._forget(chunk)
+                except discord.HTTPException as e:
+                    if self.logger:
+                        self.logger.warning(
+                            "bulk delete of %d in %s failed (%s), retrying singly",
+                            len(chunk),
+                            channel,
+                            e,
+                        )
+                    single.extend(chunk)
+        for m in single:
+            try:
+                with stage("delete"):
+                    await m.delete()
+                self.single += 1
+            except discord.NotFound:
+                pass
+            except discord.HTTPException as e:
+                if self.logger:
+                    self.logger.warning("delete of %s in %s failed (%s)", m.id, m.channel, e)
+                continue
+            self._forget([m])
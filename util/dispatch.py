@@ -0,0 +1,113 @@
+import asyncio
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Hashable, List, Optional
+
+
+class Retry(Exception):
+    """Raised by a handler that can't make progress for `delay` seconds. The item stays at the head of its
+    channel's queue and the channel goes back to a worker after the delay, leaving the worker free meanwhile."""
+
+    def __init__(self, delay: float):
+        super().__init__(delay)
+        self.delay = delay
+
+
+class ChannelDispatcher:
+    """Runs `handler` on submitted items from `workers` tasks, in order within a channel and round robin across them."""
+
+    def __init__(
+        self,
+        handler: Callable[[Any], Awaitable],
+        workers: int = 4,
+        logger=None,
+        on_error: Optional[Callable[[Any], Awaitable]] = None,
+        warn_depth: int = 50,
+    ):
+        self.handler = handler
+        self.workers = workers
+        self.logger = logger
+        self.on_error = on_error
+        self.warn_depth = warn_depth
+        self.processed = 0
+        self.retries = 0
+        self._queues: Dict[Hashable, Deque] = {}  # Only channels with work, including the item being handled
+        self._ready: Optional[asyncio.Queue] = None  # Channels waiting for a worker, each at most once
+        self._tasks: List[asyncio.Task] = []
+        self._timers: Dict[Hashable, asyncio.TimerHandle] = {}  # Channels waiting out a Retry
+
+    def start(self):
+        if not self._tasks:
+            self._ready = asyncio.Queue()
+            for q in self._queues:
+                if q not in self._timers:
+                    self._ready.put_nowait(q)
+            self._tasks = [asyncio.ensure_future(self._work()) for _ in range(self.workers)]
+
+    def stop(self):
+        for t in self._tasks:
+            t.cancel()
+        self._tasks = []
+        for h in self._timers.values():
+            h.cancel()
+        self._timers.clear()
+
+    def submit(self, channel: Hashable, item: Any):
+        self.start()
+        q = self._queues.get(channel)
+        if q is None:
+            self._queues[channel] = deque([item])
+            self._ready.put_nowait(channel)
+            return
+        q.append(item)
+        if len(q) == self.warn_depth and self.logger:
+            self.logger.warning("dispatch: %d messages queued in channel %s", len(q), channel)
+
+    def depth(self, channel: Hashable = None) -> int:
+        """Items waiting or in progress, for one channel or in total."""
+        if channel is not None:
+            return len(self._queues.get(channel, ()))
+        return sum(len(q) for q in self._queues.values())
+
+    def depths(self) -> Dict[Hashable, int]:
+        return {c: len(q) for c, q in self._queues.items()}
+
+    async def join(self):
+        """Waits until every submitted item has been handled."""
+        while self._queues:
+            await asyncio.sleep(0.01)
+
+    async def _work(self):
+        while True:
+            channel = await self._ready.get()
+            q = self._queues[channel]
+            retry = None
+            try:
+                await self.handler(q[0])
+            except Retry as e:
+                retry = e
+            except Exception:
+                if self.on_error:
+                    try:
+                        await self.on_error(q[0])
+                    except Exception:
+                        if self.logger:
+                            self.logger.exception(
+                                f"dispatch: error handler failed in channel {channel}"
+                            )
+            finally:
+                if retry is not None:
+                    self.retries += 1
+                    self._timers[channel] = asyncio.get_running_loop().call_later(
+                        retry.delay, self._resume, channel
+                    )
+                else:
+                    q.popleft()
+                    self.processed += 1
+                    if q:
+                        self._ready.put_nowait(channel)
+                    else:
+                        del self._queues[channel]
+
+    def _resume(self, channel: Hashable):
+        del self._timers[channel]
+        self._ready.put_nowait(channel)
@@ -1,10 +1,31 @@
 import re
+from enum import Enum
 
 import discord
-from typing import Optional, List
+from typing import TYPE_CHECKING, Dict, NamedTuple, Optional, List, Set
 
-from util import aget, codes
-from util.storage import RegisteredDrone
+from util import FALLBACK_HIVE, find_code, get_hive, hive_filters
+from util.metrics import stage
+
+if TYPE_CHECKING:
+    # Not imported for real: filter worker processes import this module and must not open the database.
+    from util.storage import RegisteredDrone
+
+_PREFIX = re.compile(r"^([A-z0-9]{4}) :: (.*)")
+
+
+class Action(Enum):
+    PASS = "pass"  # Leave the message alone
+    DELETE = "delete"  # Remove it without relaying
+    RELAY = "relay"  # Rewrite it, send it as the drone and remove the original
+    REDIRECT = "redirect"  # As RELAY, but as the drone the author has direct control of
+
+
+class Decision(NamedTuple):
+    action: Action
+    drone: Optional["RegisteredDrone"] = None  # Who to relay as
+    reason: Optional[str] = None  # Why it's being deleted, for the log; a fixed string per kind of delete
+    detail: Optional[str] = None  # Anything particular to this message, logged after the reason
 
 
 async def reply_builder(msg: discord.Message) -> Optional[discord.Embed]:
@@ -24,17 +45,90 @@ async def reply_builder(msg: discord.Message) -> Optional[discord.Embed]:
     return reply_embed
 
 
+WEBHOOK_NAME = "Drone speech optimization"
+MAX_WEBHOOKS = 10  # Discord's per-channel webhook limit
+
+# Channel ID -> that channel's pool of speech optimization webhooks, empty when it has none. Filled lazily by
+# get_drone_webhooks or up front by warm_drone_webhooks, and kept current by the filter cog.
+webhooks: Dict[int, List[discord.Webhook]] = {}
+
+
+# Channels the filter has work in: those with speech optimization webhooks or a channel lock. on_message checks this
+# before doing anything else, so a message anywhere else costs one set lookup.
+active_channels: Set[int] = set()
+locked_channels: Set[int] = set()
+
+
+def _update_active(channel_id: int):
+    if webhooks.get(channel_id) or channel_id in locked_channels:
+        active_channels.add(channel_id)
+    else:
+        active_channels.discard(channel_id)
+
+
+def is_active(channel_id: int) -> bool:
+    """True if `channel_id` has speech optimizations or a lock, or isn't in the webhook registry yet."""
+    return channel_id in active_channels or channel_id not in webhooks
+
+
+def set_channel_locked(channel_id: int, locked: bool):
+    if locked:
+        locked_channels.add(channel_id)
+    else:
+        locked_channels.discard(channel_id)
+    _update_active(channel_id)
+
+
+def find_drone_webhooks(hooks: List[discord.Webhook]) -> List[discord.Webhook]:
+    """Returns the speech optimization webhooks out of `hooks`."""
+    return [h for h in hooks or [] if h.name == WEBHOOK_NAME]
+
+
+async def get_drone_webhooks(channel: discord.channel) -> List[discord.Webhook]:
+    """Returns every 'Drone speech optimization' webhook in `channel`. Only asks Discord the first time a channel is
+    seen, after that the answer comes from the webhook registry."""
+    try:
+        return webhooks[channel.id]
+    except KeyError:
+        return await refresh_drone_webhooks(channel)
+
+
 async def get_drone_webhook(channel: discord.channel) -> Optional[discord.Webhook]:
-    """Returns the 'Drone speech optimization' webhook for `channel` if it exists, otherwise None."""
-    hooks = await channel.webhooks()
-    if not hooks:
-        return None
+    """Returns one of `channel`'s speech optimization webhooks if it has any, otherwise None."""
+    hooks = await get_drone_webhooks(channel)
+    return hooks[0] if hooks else None
+
 
+async def refresh_drone_webhooks(channel: discord.channel) -> List[discord.Webhook]:
+    """Re-reads `channel`'s webhooks from Discord and updates the registry."""
+    hooks = find_drone_webhooks(await channel.webhooks())
+    webhooks[channel.id] = hooks
+    _update_active(channel.id)
+    return hooks
+
+
+async def warm_drone_webhooks(guild: discord.Guild):
+    """Fills the registry for every text channel in `guild` with a single API call. Raises discord.Forbidden if we
+    lack Manage Webhooks, in which case channels are filled lazily instead."""
+    hooks = await guild.webhooks()
+    for c in guild.text_channels:
+        webhooks[c.id] = []
     for h in hooks:
-        if h.name == "Drone speech optimization":
-            return h
+        if h.name == WEBHOOK_NAME and h.channel_id:
+            webhooks.setdefault(h.channel_id, []).append(h)
+    for c in guild.text_channels:
+        _update_active(c.id)
+
 
-    return None
+def set_drone_webhooks(channel_id: int, hooks: List[discord.Webhook]):
+    webhooks[channel_id] = list(hooks)
+    _update_active(channel_id)
+
+
+def forget_drone_webhooks(channel_id: int):
+    """Drops `channel_id` from the registry so the next lookup asks Discord again."""
+    webhooks.pop(channel_id, None)
+    _update_active(channel_id)
 
 
 def _get_emojis(msg: discord.Message) -> List[dict]:
@@ -61,11 +155,89 @@ def _format_emoji(emo: dict) -> str:
     return f"<{'a' if emo['animated'] else ''}:{emo['name']}:{emo['id']}> "
 
 
-def format_code(content: str, drone: RegisteredDrone) -> (Optional[str], Optional[str]):
+def decide(
+    content: str,
+    drone: Optional[dict],
+    chan_conf: dict,
+    ssh_drone: Optional[dict] = None,
+) -> Decision:
+    """The speech optimization policy, with no I/O. `drone` is the author's drone record (None for non-drones),
+    `chan_conf` the channel's lock config and `ssh_drone` the drone the author is in direct control of, if any."""
+    attempted_chat = _PREFIX.match(content)
+    attempted_droneid = attempted_chat.group(1) if attempted_chat else None
+    attempted_content = attempted_chat.group(2) if attempted_chat else None
+
+    if ssh_drone and drone and drone.get("config", {}).get("ssh", False) is not False:
+        return Decision(Action.REDIRECT, ssh_drone)
+
+    if attempted_droneid and not attempted_content:
+        # Malformed attempt, yeet it.
+        return Decision(Action.DELETE, reason="Malformed delete")
+
+    # Is the channel locked to enforce mode?
+    if chan_conf.get("enforcedrones"):  # All registered drones must use speech opt
+        if drone:
+            if not attempted_droneid and not attempted_content:
+                return Decision(Action.DELETE, reason="Chan enforcedrone delete")
+            else:
+                return Decision(Action.RELAY, drone)
+
+    if chan_conf.get("enforceall"):
+        if not attempted_droneid:  # Only drones may speak
+            return Decision(Action.DELETE, reason="Chan Enforceall delete")
+
+    # If a non-drone uses a prefix, just bail.
+    if not drone:
+        return Decision(Action.PASS)
+
+    # Is the drone locked to enforce mode?
+    if drone.get("config", {}).get("enforce"):
+        if not attempted_droneid and not attempted_content:
+            return Decision(Action.DELETE, reason="Drone enforce delete")
+        else:
+            return Decision(Action.RELAY, drone)
+
+    if not attempted_droneid:
+        return Decision(Action.PASS)
+
+    # Is the drone using their own prefix?
+    if drone["droneid"] != attempted_droneid:
+        return Decision(
+            Action.DELETE,
+            reason="Wrong prefix delete",
+            detail=f"got {attempted_droneid}, should be {drone['droneid']}",
+        )
+
+    return Decision(Action.RELAY, drone)
+
+
+def apply_filter(content: str, drone: dict) -> str:
+    """Rewrites `content` with the filters of `drone`'s hive."""
+    hf = hive_filters.get(drone["hive"]) or hive_filters[FALLBACK_HIVE]
+    return hf.apply(content)
+
+
+def relay_content(drone: dict, content: str) -> str:
+    """Builds the text `drone` says when relaying `content`: its ID, hive symbol, status code and filtered message."""
+    droneid = drone["droneid"]
+    hivesym = get_hive(drone["hive"])["sym"]
+    content = content.replace(f"{droneid} :: ", "")
+    with stage("format_code"):
+        code = format_code(content, drone)
+
+    if code[0]:
+        content = content[len(code[1]) :].lstrip()
+    with stage("filter"):
+        content = apply_filter(content, drone)
+
+    # This list can be thought of as the 'fields' in a drone message. Empty ones are left out.
+    return " :: ".join(f for f in (droneid, hivesym, code[0], content) if f)
+
+
+def format_code(content: str, drone: "RegisteredDrone") -> (Optional[str], Optional[str]):
     """Given a drone and its message content, return a nicely formatted status code block and the status code used"""
     if drone:
-        c = aget(re.findall(r"^(.{3,4})(.*)$", content), 0, None)
-        if c:
-            if c[0] in codes.keys():
-                return f"Code {c[0]} :: {codes[c[0]]}", c[0]
+        code, meaning = find_code(content, drone.get("hive"))
+        if code:
+            return f"Code {code} :: {meaning}", code
     return None, None
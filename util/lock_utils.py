@@ -0,0 +1,75 @@
+import asyncio
+import heapq
+import itertools
+import time
+from typing import Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+
+# Lock values live under these config keys; a number is an expiry timestamp, True an indefinite lock.
+DRONE_LOCK_KEYS = ("enforce",)
+CHANNEL_LOCK_KEYS = ("enforcedrones", "enforceall")
+
+
+def lock_deadline(value) -> Optional[float]:
+    """Returns the expiry timestamp of a lock value, or None if the lock is indefinite or off."""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    return None
+
+
+class ExpiryScheduler:
+    """Calls `callback(key, deadline)` once per key when its deadline (a Unix timestamp) passes."""
+
+    def __init__(self, callback: Callable[[Hashable, float], Awaitable], logger=None):
+        self._callback = callback
+        self._logger = logger
+        self._heap: List[Tuple[float, int, Hashable]] = []
+        self._deadlines: Dict[Hashable, float] = {}
+        self._seq = itertools.count()
+        self._wake: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def schedule(self, key: Hashable, deadline: float):
+        self._deadlines[key] = deadline
+        heapq.heappush(self._heap, (deadline, next(self._seq), key))
+        if self._wake and self._heap[0][2] == key:
+            self._wake.set()
+
+    def cancel(self, key: Hashable):
+        self._deadlines.pop(key, None)
+
+    def start(self):
+        if self._task is None:
+            self._wake = asyncio.Event()
+            self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    async def _run(self):
+        while True:
+            while self._heap and self._deadlines.get(self._heap[0][2]) != self._heap[0][0]:
+                heapq.heappop(self._heap)
+            self._wake.clear()
+            if not self._heap:
+                await self._wake.wait()
+                continue
+            deadline, _, key = self._heap[0]
+            delay = deadline - time.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            heapq.heappop(self._heap)
+            del self._deadlines[key]
+            try:
+                await self._callback(key, deadline)
+            except Exception as e:
+                if self._logger:
+                    self._logger.error(f"lock expiry for {key} failed: {e}")
@@ -1,15 +1,116 @@
+import json
 import logging
 import logging.handlers
+import queue
+import time
+from typing import Dict, Hashable, List, Optional
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Queues records untouched. The stock QueueHandler formats each record before queueing it, on the caller's
+    thread, which is the work we want off the event loop; the listener thread formats instead."""
+
+    def __init__(self, q):
+        super().__init__(q)
+        self.listener: Optional[logging.handlers.QueueListener] = None  # The thread writing this queue out
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class KeyValueFormatter(logging.Formatter):
+    """Formats records as key=value pairs, quoting values that need it, for log pipelines that parse fields."""
+
+    def __init__(self, debug: bool = False):
+        super().__init__()
+        self.debug = debug
+
+    @staticmethod
+    def _value(v) -> str:
+        s = str(v)
+        return json.dumps(s) if not s or any(c in s for c in ' "=\n') else s
+
+    def format(self, record: logging.LogRecord) -> str:
+        fields = [
+            ("ts", self.formatTime(record, "%Y-%m-%dT%H:%M:%S")),
+            ("level", record.levelname),
+            ("logger", record.name),
+            ("module", record.module),
+        ]
+        if self.debug:
+            fields.append(("at", f"{record.funcName}:{record.lineno}"))
+        fields.append(("msg", record.getMessage()))
+        if record.exc_info:
+            fields.append(("exc", self.formatException(record.exc_info)))
+        return " ".join(f"{k}={self._value(v)}" for k, v in fields)
+
+
+class RateLimitFilter(logging.Filter):
+    """Lets through `burst` records and then `rate` a second per kind, a kind being the format string and first
+    argument (keep that a fixed category, like a delete reason). The next record let through counts the drops."""
+
+    def __init__(self, rate: float = 5, burst: int = 20, idle: float = 300):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.idle = idle  # Seconds after which a quiet kind's bucket is forgotten
+        self.suppressed = 0
+        self._buckets: Dict[Hashable, List[float]] = {}  # kind -> [tokens, last refill, dropped]
+        self._swept = time.monotonic()
+
+    @staticmethod
+    def _kind(record: logging.LogRecord) -> Hashable:
+        first = record.args[0] if isinstance(record.args, tuple) and record.args else None
+        return record.msg, str(first)
+
+    def _sweep(self, now: float):
+        self._swept = now
+        for kind in [k for k, b in self._buckets.items() if now - b[1] > self.idle]:
+            del self._buckets[kind]
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        now = time.monotonic()
+        if now - self._swept > self.idle:
+            self._sweep(now)
+        b = self._buckets.get(self._kind(record))
+        if b is None:
+            b = self._buckets[self._kind(record)] = [float(self.burst), now, 0]
+        b[0] = min(self.burst, b[0] + (now - b[1]) * self.rate)
+        b[1] = now
+        if b[0] < 1:
+            b[2] += 1
+            self.suppressed += 1
+            return False
+        b[0] -= 1
+        if b[2] and isinstance(record.args, tuple):
+            msg = str(record.msg) if record.args else str(record.msg).replace("%", "%%")
+            record.msg = msg + " (%d like this dropped)"
+            record.args += (int(b[2]),)
+            b[2] = 0
+        return True
+
+
+def enforcement_logger(logger: logging.Logger, rate: float = 5, burst: int = 20) -> logging.Logger:
+    """A child of `logger` for per-message enforcement lines (deletes and the like), rate limited so a raid or a
+    spamming drone can't flood the log."""
+    child = logger.getChild("enforce")
+    if not any(isinstance(f, RateLimitFilter) for f in child.filters):
+        child.addFilter(RateLimitFilter(rate, burst))
+    return child
 
 
 # Copied from https://stackoverflow.com/questions/37958568/how-to-implement-a-global-python-logger
-def init_logger(name, level: str):
+def init_logger(name, level: str, log_format: str = "text"):
     # logger settings
-    if logging.getLevelName(level) is logging.DEBUG:
-        log_format = "%(asctime)s [%(levelname)s] %(filename)s(%(funcName)s:%(lineno)s): %(message)s"
+    debug = logging.getLevelName(level) is logging.DEBUG
+    if log_format == "kv":
+        formatter = KeyValueFormatter(debug)
+    elif debug:
+        formatter = logging.Formatter(
+            "%(asctime)s [%(levelname)s] %(filename)s(%(funcName)s:%(lineno)s): %(message)s"
+        )
     else:
-        log_format = "%(asctime)s [%(levelname)s] %(module)s: %(message)s"
-    formatter = logging.Formatter(log_format)
+        formatter = logging.Formatter("%(asctime)s [%(levelname)s] %(module)s: %(message)s")
 
     # setup logger
     logger = logging.getLogger(name)
@@ -18,6 +119,20 @@ def init_logger(name, level: str):
     streamhandler = logging.StreamHandler()
     streamhandler.setFormatter(formatter)
 
-    logger.addHandler(streamhandler)
+    # The logger only puts records on a queue; a listener thread formats them and writes to stderr.
+    q = queue.SimpleQueue()
+    handler = _DeferredQueueHandler(q)
+    handler.listener = logging.handlers.QueueListener(q, streamhandler, respect_handler_level=True)
+    handler.listener.start()
+    logger.addHandler(handler)
 
     return logger
+
+
+def stop(logger: logging.Logger):
+    """Writes out everything `logger` still has queued and stops its listener thread, leaving other loggers be."""
+    for h in [h for h in logger.handlers if isinstance(h, _DeferredQueueHandler)]:
+        logger.removeHandler(h)
+        if h.listener is not None:
+            h.listener.stop()
+            h.listener = None
@@ -0,0 +1,134 @@
+import re
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+_WORD = re.compile(r"[\w']+")
+
+
+def _is_word(c: str) -> bool:
+    return c.isalnum() or c in "_'"
+
+
+class PhraseAutomaton:
+    """Aho-Corasick matcher for a set of phrases, on word boundaries, leftmost-longest."""
+
+    def __init__(self, phrases: Dict[str, str]):
+        self.replacements: List[str] = []
+        self.lengths: List[int] = []
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._out: List[List[int]] = [[]]
+        for phrase, repl in phrases.items():
+            self._add(" ".join(phrase.split()), repl)
+        self._link()
+
+    def _add(self, phrase: str, repl: str):
+        node = 0
+        for c in phrase:
+            nxt = self._goto[node].get(c)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[node][c] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append([])
+            node = nxt
+        self._out[node].append(len(self.replacements))
+        self.replacements.append(repl)
+        self.lengths.append(len(phrase))
+
+    def _link(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for c, child in self._goto[node].items():
+                queue.append(child)
+                f = self._fail[node]
+                while f and c not in self._goto[f]:
+                    f = self._fail[f]
+                self._fail[child] = self._goto[f].get(c, 0)
+                self._out[child] = self._out[child] + self._out[self._fail[child]]
+
+    def find(self, text: str) -> List[Tuple[int, int, str]]:
+        """Returns non-overlapping (start, end, replacement) matches in `text`, in order."""
+        goto, fail, out, lengths = self._goto, self._fail, self._out, self.lengths
+        n = len(text)
+        found = []
+        node = 0
+        for i, c in enumerate(text):
+            if c.isspace():
+                c = " "
+            while node and c not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(c, 0)
+            for p in out[node]:
+                start = i - lengths[p] + 1
+                if start > 0 and _is_word(text[start]) and _is_word(text[start - 1]):
+                    continue
+                if i + 1 < n and _is_word(c) and _is_word(text[i + 1]):
+                    continue
+                found.append((start, -lengths[p], p))
+        found.sort()
+        res = []
+        pos = 0
+        for start, neglen, p in found:
+            if start >= pos:
+                res.append((start, start - neglen, self.replacements[p]))
+                pos = start - neglen
+        return res
+
+    def __len__(self):
+        return len(self.replacements)
+
+
+class HiveFilter:
+    """One hive's filters.yml entry, compiled. Keys with a space are phrases and win over single words."""
+
+    def __init__(self, entries: Dict[str, str]):
+        entries = {str(k): str(v) for k, v in (entries or {}).items()}
+        self.words = {k: v for k, v in entries.items() if len(k.split()) == 1}
+        phrases = {k: v for k, v in entries.items() if len(k.split()) > 1}
+        self.phrases = PhraseAutomaton(phrases) if phrases else None
+
+    def _sub(self, m: re.Match) -> str:
+        w = m.group(0)
+        return self.words.get(w, w)
+
+    def apply(self, content: str) -> str:
+        if not self.phrases:
+            return _WORD.sub(self._sub, content)
+        res = []
+        pos = 0
+        for start, end, repl in self.phrases.find(content):
+            res.append(_WORD.sub(self._sub, content[pos:start]))
+            res.append(repl)
+            pos = end
+        res.append(_WORD.sub(self._sub, content[pos:]))
+        return "".join(res)
+
+
+class CodeIndex:
+    """Prefix trie over one code file. longest() finds the longest code at the start of a message."""
+
+    def __init__(self, codes: Dict[str, str]):
+        self.codes = {str(k): str(v) for k, v in (codes or {}).items()}
+        self._root: dict = {}
+        for code in self.codes:
+            node = self._root
+            for c in code:
+                node = node.setdefault(c, {})
+            node[None] = code
+
+    def longest(self, text: str) -> Optional[str]:
+        node = self._root
+        best = None
+        for i, c in enumerate(text):
+            node = node.get(c)
+            if node is None:
+                break
+            if None in node and (i + 1 == len(text) or not _is_word(text[i + 1])):
+                best = node[None]
+        return best
+
+    def __len__(self):
+        return len(self.codes)
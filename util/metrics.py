@@ -0,0 +1,230 @@
+import bisect
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+from aiohttp import web
+
+# Enough of the Prometheus client model for DroneOS: counters, histograms and callback gauges, rendered in the text
+# exposition format. Everything here is touched from the event loop only, so there's no locking.
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+registry: List["_Metric"] = []
+
+
+def _escape(v) -> str:
+    return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names: Sequence[str], values: Sequence, extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, doc: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        registry.append(self)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        head = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} {self.kind}"]
+        return head + self.samples()
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, doc: str, labels: Sequence[str] = ()):
+        super().__init__(name, doc, labels)
+        self.values: Dict[tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{_labels(self.labels, k)} {v}" for k, v in self.values.items()]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        doc: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, doc, labels)
+        self.buckets = tuple(buckets)
+        # Label values -> (count per bucket, [sum of observations])
+        self.values: Dict[tuple, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, *labels):
+        v = self.values.get(labels)
+        if v is None:
+            v = self.values[labels] = ([0] * (len(self.buckets) + 1), [0.0])
+        v[0][bisect.bisect_left(self.buckets, value)] += 1
+        v[1][0] += value
+
+    @contextmanager
+    def time(self, *labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def samples(self) -> List[str]:
+        res = []
+        for k, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, n in zip(self.buckets + ("+Inf",), counts):
+                cumulative += n
+                le = f'le="{bound}"'
+                res.append(f"{self.name}_bucket{_labels(self.labels, k, le)} {cumulative}")
+            res.append(f"{self.name}_sum{_labels(self.labels, k)} {total[0]}")
+            res.append(f"{self.name}_count{_labels(self.labels, k)} {cumulative}")
+        return res
+
+
+class Gauge(_Metric):
+    """A value read when scraped from `fn`, set by whoever owns it. `fn` returns a number, or a dict of label value
+    tuples to numbers. Pass kind="counter" for running totals kept elsewhere."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, doc: str, labels: Sequence[str] = (), kind: str = "gauge"):
+        super().__init__(name, doc, labels)
+        self.kind = kind
+        self.fn: Optional[Callable[[], Union[float, Dict[tuple, float]]]] = None
+
+    def samples(self) -> List[str]:
+        if self.fn is None:
+            return []
+        v = self.fn()
+        if not isinstance(v, dict):
+            v = {(): v}
+        return [f"{self.name}{_labels(self.labels, k)} {n}" for k, n in v.items()]
+
+
+def render() -> str:
+    return "\n".join(line for m in registry for line in m.render()) + "\n"
+
+
+# The message pipeline, from on_message to the relay and delete.
+stage_seconds = Histogram(
+    "droneos_filter_stage_seconds", "Time spent in each stage of the filter pipeline", ("stage",)
+)
+handled = Counter(
+    "droneos_filter_messages_total",
+    "Messages through the filter, by outcome and hive",
+    ("action", "hive"),
+)
+
+queue_depth = Gauge(
+    "droneos_filter_queue_depth", "Messages waiting in the per-channel filter queues"
+)
+throttled_seconds = Gauge(
+    "droneos_webhook_throttled_seconds_total",
+    "Time relays spent waiting for a webhook's rate limit",
+    kind="counter",
+)
+rate_limited = Gauge(
+    "droneos_webhook_rate_limited_total", "Relays that were rate limited anyway", kind="counter"
+)
+deletes = Gauge(
+    "droneos_delete_calls_total",
+    "Message delete API calls, bulk or single",
+    ("kind",),
+    kind="counter",
+)
+drone_lookups = Gauge(
+    "droneos_drone_lookups_total", "Drone registry lookups by result", ("result",), kind="counter"
+)
+shard_latency = Gauge(
+    "droneos_shard_latency_seconds", "Gateway heartbeat latency per shard", ("shard",)
+)
+shard_events = Gauge(
+    "droneos_shard_events_total", "Gateway events dispatched per shard", ("shard",), kind="counter"
+)
+
+loop_lag = Gauge(
+    "droneos_loop_lag_seconds", "How late the event loop ran its latest watchdog heartbeat"
+)
+loop_stalls = Gauge(
+    "droneos_loop_stalls_total",
+    "Times the event loop was blocked past the watchdog threshold",
+    kind="counter",
+)
+
+
+# Stage timings not yet handed on, in a filter worker process: it has no metrics server, so it sends them to the
+# gateway process with its results instead. None everywhere else.
+_stage_log: Optional[List[Tuple[str, float]]] = None
+
+
+def collect_stages():
+    """Keeps every stage timing from here on for take_stages(), as well as observing it locally."""
+    global _stage_log
+    if _stage_log is None:
+        _stage_log = []
+
+
+def take_stages() -> List[Tuple[str, float]]:
+    """The (stage, seconds) timings since the last call, with collect_stages() on."""
+    global _stage_log
+    if _stage_log is None:
+        return []
+    taken, _stage_log = _stage_log, []
+    return taken
+
+
+@contextmanager
+def stage(name: str):
+    """Times the enclosed block as filter pipeline stage `name`."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        stage_seconds.observe(elapsed, name)
+        if _stage_log is not None:
+            _stage_log.append((name, elapsed))
+
+
+class MetricsServer:
+    """Serves everything in the registry at /metrics over HTTP, in Prometheus text format."""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 9108, logger=None):
+        self.host = host
+        self.port = port
+        self.logger = logger
+        self._runner: Optional[web.AppRunner] = None
+
+    async def _metrics(self, request: web.Request) -> web.Response:
+        return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/metrics", self._metrics)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        if self.logger:
+            self.logger.info(f"metrics: serving on http://{self.host}:{self.port}/metrics")
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
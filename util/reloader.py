@@ -0,0 +1,82 @@
+import asyncio
+import os
+from typing import Callable, Dict, List, Optional, Tuple
+
+import util
+
+
+def _file_stamp(path: str) -> Optional[Tuple[int, int]]:
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+def _dir_stamp(path: str) -> tuple:
+    return tuple((f, _file_stamp(os.path.join(path, f))) for f in sorted(os.listdir(path)))
+
+
+class Reloader:
+    """Polls codes/, hives.yml and filters.yml every `interval` seconds and installs whatever changed.
+    A file that fails to parse is logged and the running definitions are kept."""
+
+    def __init__(self, logger=None, interval: float = 5.0):
+        self.logger = logger
+        self.interval = interval
+        self.reloads = 0
+        # Name -> (stamp, read, install). read runs off the loop, install swaps its result in.
+        self.sources: Dict[str, Tuple[Callable, Callable, Callable]] = {
+            "codes": (lambda: _dir_stamp("codes"), util.read_codes, util.install_codes),
+            "hives": (lambda: _file_stamp("hives.yml"), util.read_hives, util.install_hives),
+            "filters": (
+                lambda: _file_stamp("filters.yml"),
+                util.read_filters,
+                util.install_filters,
+            ),
+        }
+        self._stamps = self._stamp_all()
+        self._task: Optional[asyncio.Task] = None
+
+    def _stamp_all(self) -> Dict[str, object]:
+        return {name: stamp() for name, (stamp, _, _) in self.sources.items()}
+
+    def start(self):
+        if self._task is None and self.interval > 0:
+            self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def check(self) -> List[str]:
+        """Reloads every source that changed since the last check. Returns the names of those reloaded."""
+        loop = asyncio.get_running_loop()
+        stamps = await loop.run_in_executor(None, self._stamp_all)
+        done = []
+        for name, (_, read, install) in self.sources.items():
+            if stamps[name] == self._stamps.get(name):
+                continue
+            self._stamps[name] = stamps[name]
+            try:
+                parsed = await loop.run_in_executor(None, read)
+            except Exception as e:
+                if self.logger:
+                    self.logger.error(f"reload: {name} rejected, keeping the running version ({e})")
+                continue
+            install(parsed)
+            self.reloads += 1
+            done.append(name)
+            if self.logger:
+                self.logger.info(f"reload: {name} updated")
+        return done
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.check()
+            except Exception as e:
+                if self.logger:
+                    self.logger.error(f"reload: check failed ({e})")
@@ -0,0 +1,32 @@
+import time
+from typing import Dict, Optional, Sequence
+
+import discord
+
+
+def shard_of(args: Sequence) -> Optional[int]:
+    """Returns the shard an event belongs to, judged by the guild of its first argument, or None if it has none."""
+    if not args:
+        return None
+    guild = args[0] if isinstance(args[0], discord.Guild) else getattr(args[0], "guild", None)
+    return getattr(guild, "shard_id", None)
+
+
+class ShardStats:
+    """Counts gateway events per shard. rates() gives events per second for each shard since it was last called."""
+
+    def __init__(self):
+        self.events: Dict[Optional[int], int] = {}
+        self._last: Dict[Optional[int], int] = {}
+        self._last_at = time.monotonic()
+
+    def record(self, shard_id: Optional[int]):
+        self.events[shard_id] = self.events.get(shard_id, 0) + 1
+
+    def rates(self) -> Dict[Optional[int], float]:
+        now = time.monotonic()
+        elapsed = max(now - self._last_at, 1e-9)
+        res = {s: (n - self._last.get(s, 0)) / elapsed for s, n in self.events.items()}
+        self._last = dict(self.events)
+        self._last_at = now
+        return res
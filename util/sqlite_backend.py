@@ -0,0 +1,272 @@
+import json
+import operator
+import os
+import sqlite3
+import threading
+from typing import List, Optional, Tuple, Type
+
+from blitzdb import Document, FileBackend
+
+from util.lock_utils import DRONE_LOCK_KEYS, CHANNEL_LOCK_KEYS
+
+LOCK_KEYS = DRONE_LOCK_KEYS + CHANNEL_LOCK_KEYS
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    collection TEXT NOT NULL,
+    pk TEXT NOT NULL,
+    droneid TEXT,
+    discordid INTEGER,
+    expires REAL,
+    latest REAL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (collection, pk)
+);
+CREATE INDEX IF NOT EXISTS documents_droneid ON documents (collection, droneid);
+CREATE INDEX IF NOT EXISTS documents_discordid ON documents (collection, discordid);
+CREATE INDEX IF NOT EXISTS documents_expires ON documents (collection, expires);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+"""
+# Run after _upgrade, which adds `latest` to databases made before it existed.
+_LATEST_INDEX = "CREATE INDEX IF NOT EXISTS documents_latest ON documents (collection, latest)"
+
+_MISSING = object()
+
+
+def _is_number(v) -> bool:
+    return isinstance(v, (int, float)) and not isinstance(v, bool)
+
+
+def _lookup(attrs: dict, key: str):
+    v = attrs
+    for part in key.split("."):
+        if not isinstance(v, dict) or part not in v:
+            return _MISSING
+        v = v[part]
+    return v
+
+
+_RANGE = {"$gt": operator.gt, "$gte": operator.ge, "$lt": operator.lt, "$lte": operator.le}
+
+
+def _compare(op: str, value, operand) -> bool:
+    # As in blitzdb's FileBackend: Python's own comparison, so an indefinite lock (True) counts as 1, and a list
+    # matches if any element does. Where FileBackend raises on values that don't compare, this doesn't match.
+    if op in _RANGE:
+        if value is _MISSING:
+            return False
+        try:
+            if isinstance(value, list):
+                return any(_RANGE[op](v, operand) for v in value)
+            return bool(_RANGE[op](value, operand))
+        except TypeError:
+            return False
+    if op == "$ne":
+        return value is _MISSING or value != operand
+    if op == "$in":
+        return value is not _MISSING and value in operand
+    if op == "$exists":
+        return (value is not _MISSING) == bool(operand)
+    raise ValueError(f"Unsupported query operator {op}")
+
+
+def match(attrs: dict, query: dict) -> bool:
+    """Evaluates the subset of blitzdb's query language DroneOS uses (dotted keys, equality, list membership, $or,
+    $and and the comparison operators) against a plain attribute dict."""
+    for key, cond in query.items():
+        if key == "$or":
+            if not any(match(attrs, q) for q in cond):
+                return False
+        elif key == "$and":
+            if not all(match(attrs, q) for q in cond):
+                return False
+        else:
+            value = _lookup(attrs, key)
+            if isinstance(cond, dict) and cond and all(k.startswith("$") for k in cond):
+                if not all(_compare(op, value, operand) for op, operand in cond.items()):
+                    return False
+            elif isinstance(value, list) and not isinstance(cond, list):
+                if cond not in value:
+                    return False
+            elif value is _MISSING or value != cond:
+                return False
+    return True
+
+
+def _narrow(query: dict) -> Optional[Tuple[str, list]]:
+    """Translates the indexable part of `query` into a WHERE clause selecting a superset of the matching rows, or
+    None if nothing in it is indexed. Rows are always re-checked with match()."""
+    clauses, params = [], []
+    for key, cond in query.items():
+        if key == "$or":
+            branches = [_narrow(q) for q in cond]
+            if branches and all(branches):
+                clauses.append("(" + " OR ".join(f"({b[0]})" for b in branches) + ")")
+                for b in branches:
+                    params.extend(b[1])
+        elif key == "droneid" and isinstance(cond, str):
+            clauses.append("droneid = ?")
+            params.append(cond)
+        elif key == "discordid" and _is_number(cond):
+            clauses.append("discordid = ?")
+            params.append(int(cond))
+        elif key == "pk" and isinstance(cond, str):
+            clauses.append("pk = ?")
+            params.append(cond)
+        elif key.startswith("config.") and key[7:] in LOCK_KEYS and isinstance(cond, dict):
+            # `expires` and `latest` hold the earliest and latest lock, so they bound any one lock either way.
+            if _is_number(cond.get("$lt")):
+                clauses.append("expires < ?")
+                params.append(cond["$lt"])
+            elif _is_number(cond.get("$lte")):
+                clauses.append("expires <= ?")
+                params.append(cond["$lte"])
+            if _is_number(cond.get("$gt")):
+                clauses.append("latest > ?")
+                params.append(cond["$gt"])
+            elif _is_number(cond.get("$gte")):
+                clauses.append("latest >= ?")
+                params.append(cond["$gte"])
+    if not clauses:
+        return None
+    return " AND ".join(clauses), params
+
+
+def _columns(
+    attrs: dict,
+) -> Tuple[Optional[str], Optional[int], Optional[float], Optional[float]]:
+    droneid = attrs.get("droneid")
+    discordid = attrs.get("discordid")
+    config = attrs.get("config")
+    locks = [config[k] for k in LOCK_KEYS if k in config] if isinstance(config, dict) else []
+    locks = [float(v) for v in locks if isinstance(v, (int, float))]  # True is 1, as in _compare
+    return (
+        str(droneid) if droneid is not None else None,
+        int(discordid) if _is_number(discordid) else None,
+        min(locks) if locks else None,
+        max(locks) if locks else None,
+    )
+
+
+class SqliteBackend:
+    """Single-file SQLite document store with the slice of blitzdb's backend API that Storage uses."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.autocommit = True
+        self.in_transaction = False
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+        self._upgrade()
+        self._conn.execute(_LATEST_INDEX)
+        self._conn.commit()
+
+    def _upgrade(self):
+        # Databases from before `latest` get the column, and every row's lock columns recomputed.
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(documents)")}
+        if "latest" in columns:
+            return
+        self._conn.execute("ALTER TABLE documents ADD COLUMN latest REAL")
+        rows = self._conn.execute("SELECT collection, pk, data FROM documents").fetchall()
+        for collection, pk, data in rows:
+            self._conn.execute(
+                "UPDATE documents SET expires = ?, latest = ? WHERE collection = ? AND pk = ?",
+                (*_columns(json.loads(data))[2:], collection, pk),
+            )
+
+    @staticmethod
+    def _collection(cls: Type[Document]) -> str:
+        return cls.__name__.lower()
+
+    def begin(self):
+        with self._lock:
+            if self.in_transaction:
+                self._conn.commit()
+            self.in_transaction = True
+
+    def commit(self):
+        with self._lock:
+            self._conn.commit()
+            self.in_transaction = False
+
+    def rollback(self):
+        with self._lock:
+            self._conn.rollback()
+            self.in_transaction = False
+
+    def _autocommit(self):
+        if self.autocommit and not self.in_transaction:
+            self._conn.commit()
+
+    def save(self, doc: Document):
+        if doc.pk is None:
+            doc.autogenerate_pk()
+        attrs = doc.attributes
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO documents "
+                "(collection, pk, droneid, discordid, expires, latest, data) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (self._collection(type(doc)), doc.pk, *_columns(attrs), json.dumps(attrs)),
+            )
+            self._autocommit()
+
+    def delete(self, doc: Document):
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM documents WHERE collection = ? AND pk = ?",
+                (self._collection(type(doc)), doc.pk),
+            )
+            self._autocommit()
+
+    def filter(self, cls: Type[Document], query: dict) -> List[Document]:
+        sql = "SELECT data FROM documents WHERE collection = ?"
+        params = [self._collection(cls)]
+        narrowed = _narrow(query)
+        if narrowed:
+            sql += f" AND {narrowed[0]}"
+            params.extend(narrowed[1])
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        docs = []
+        for (data,) in rows:
+            attrs = json.loads(data)
+            if match(attrs, query):
+                docs.append(cls(attrs))
+        return docs
+
+    def get(self, cls: Type[Document], query: dict) -> Document:
+        docs = self.filter(cls, query)
+        if not docs:
+            raise cls.DoesNotExist
+        if len(docs) > 1:
+            raise cls.MultipleDocumentsReturned
+        return docs[0]
+
+    def migrate_from(self, path: str, classes: List[Type[Document]]) -> int:
+        """One-shot copy of a blitzdb FileBackend directory at `path` into this database. Does nothing if it has
+        already run or `path` holds no FileBackend. Returns the number of documents copied."""
+        with self._lock:
+            done = self._conn.execute("SELECT value FROM meta WHERE key = 'migrated_from'").fetchone()
+        if done or not os.path.exists(os.path.join(path, "config.json")):
+            return 0
+        source = FileBackend(path)
+        n = 0
+        self.begin()
+        try:
+            for cls in classes:
+                for doc in source.filter(cls, {}):
+                    self.save(cls(dict(doc.attributes)))
+                    n += 1
+            with self._lock:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO meta (key, value) VALUES ('migrated_from', ?)", (path,)
+                )
+        except Exception:
+            self.rollback()
+            raise
+        self.commit()
+        return n
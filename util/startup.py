@@ -0,0 +1,106 @@
+import hashlib
+import os
+import pickle
+import time
+from contextlib import contextmanager
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import util
+import util.matchers
+
+SNAPSHOT_PATH = os.path.join("cache", "startup.snapshot")
+_FORMAT = 1  # Bump when Snapshot changes shape
+
+
+class Snapshot(NamedTuple):
+    """Everything start-up parses, in the form the util install_* functions take."""
+
+    config: dict
+    codes: tuple
+    hives: dict
+    filters: tuple
+
+
+def _sources() -> List[str]:
+    # The code that builds the snapshot is part of its key, so a snapshot from an older util/__init__.py (the read_*
+    # functions) or matchers.py (the compiled matchers) is never unpickled.
+    files = ["config.yml", "hives.yml", "filters.yml", util.__file__, util.matchers.__file__]
+    return files + [os.path.join("codes", f) for f in sorted(os.listdir("codes"))]
+
+
+def _stat(path: str) -> Tuple[int, int]:
+    st = os.stat(path)
+    return st.st_mtime_ns, st.st_size
+
+
+def _digest(path: str) -> str:
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def _read(path: str) -> Optional[dict]:
+    try:
+        with open(path, "rb") as f:
+            saved = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception:  # Truncated, or from a version we can't unpickle any more
+        return None
+    if not isinstance(saved, dict) or saved.get("format") != _FORMAT:
+        return None
+    return saved
+
+
+def _write(path: str, files: Dict[str, tuple], snapshot: Snapshot, logger=None):
+    try:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path + ".tmp", "wb") as f:
+            pickle.dump(
+                {"format": _FORMAT, "files": files, "snapshot": snapshot},
+                f,
+                protocol=pickle.HIGHEST_PROTOCOL,
+            )
+        os.replace(path + ".tmp", path)
+    except OSError as e:
+        if logger:
+            logger.warning(f"startup: can't write snapshot to {path} ({e})")
+
+
+def load_snapshot(path: str = SNAPSHOT_PATH, logger=None) -> Snapshot:
+    """Returns the parsed definitions and config, from the snapshot at `path` if no source changed since it was written.
+    The snapshot holds the bot token, so protect it like config.yml."""
+    sources = _sources()
+    stats = {p: _stat(p) for p in sources}
+    saved = _read(path)
+    if saved and set(saved["files"]) == set(sources):
+        files = saved["files"]
+        touched = [p for p in sources if files[p][:2] != stats[p]]
+        if not touched:
+            return saved["snapshot"]
+        if all(files[p][2] == _digest(p) for p in touched):
+            _write(path, {p: stats[p] + (files[p][2],) for p in sources}, saved["snapshot"], logger)
+            return saved["snapshot"]
+    snapshot = Snapshot(util.read_config(), util.read_codes(), util.read_hives(), util.read_filters())
+    _write(path, {p: stats[p] + (_digest(p),) for p in sources}, snapshot, logger)
+    return snapshot
+
+
+class StartupTimer:
+    """Records how long each named phase of start-up takes."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases: List[Tuple[str, float]] = []
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - start))
+
+    def report(self) -> str:
+        lines = [f"{name}: {secs * 1000:.1f}ms" for name, secs in self.phases]
+        lines.append(f"total: {(time.perf_counter() - self.started) * 1000:.1f}ms")
+        return ", ".join(lines)
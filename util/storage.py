@@ -1,4 +1,8 @@
-from typing import Optional
+import asyncio
+import copy
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple, Type, Union
 from blitzdb import Document, FileBackend
 
 
@@ -10,36 +14,318 @@ class DroneChannel(Document):
     pass
 
 
+class DroneRegistry:
+    """Every RegisteredDrone, in memory and indexed by drone ID and Discord ID."""
+
+    def __init__(self):
+        self.by_droneid: Dict[str, RegisteredDrone] = {}
+        self.by_discordid: Dict[int, RegisteredDrone] = {}
+        self._keys: Dict[str, Tuple[str, int]] = {}  # pk -> keys the drone was last indexed under
+        # The access graph, both ways round: a drone's Discord ID -> the Discord IDs on its access list, and a Discord
+        # ID -> the drones whose access lists it is on.
+        self.controllers: Dict[int, Set[int]] = {}
+        self.controlled: Dict[int, Set[int]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, backend):
+        self.by_droneid.clear()
+        self.by_discordid.clear()
+        self._keys.clear()
+        self.controllers.clear()
+        self.controlled.clear()
+        for d in backend.filter(RegisteredDrone, {}):
+            self.put(d)
+
+    def put(self, drone: RegisteredDrone):
+        """(Re)indexes `drone`, dropping any keys it was previously known by."""
+        self.discard(drone)
+        keys = (str(drone["droneid"]), int(drone["discordid"]))
+        self.by_droneid[keys[0]] = drone
+        self.by_discordid[keys[1]] = drone
+        self._keys[drone.pk] = keys
+        access = {int(i) for i in drone.get("access") or ()}
+        self.controllers[keys[1]] = access
+        for i in access:
+            self.controlled.setdefault(i, set()).add(keys[1])
+
+    def discard(self, drone: RegisteredDrone):
+        keys = self._keys.pop(drone.pk, None)
+        if not keys:
+            return
+        if self.by_droneid.get(keys[0]) is not None and self.by_droneid[keys[0]].pk == drone.pk:
+            del self.by_droneid[keys[0]]
+        if self.by_discordid.get(keys[1]) is not None and self.by_discordid[keys[1]].pk == drone.pk:
+            del self.by_discordid[keys[1]]
+            for i in self.controllers.pop(keys[1], ()):
+                self.controlled[i].discard(keys[1])
+                if not self.controlled[i]:
+                    del self.controlled[i]
+
+    def get(self, query: Union[int, str]) -> Optional[RegisteredDrone]:
+        if len(str(query)) == 4:
+            d = self.by_droneid.get(str(query))
+        elif len(str(query)) >= 10:
+            try:
+                d = self.by_discordid.get(int(query))
+            except ValueError:
+                d = None
+        else:
+            raise RuntimeError("Invalid drone ID")
+        if d is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return d
+
+    def get_many(self, queries: Iterable[Union[int, str]]) -> List[RegisteredDrone]:
+        """Looks up each of `queries` as get() does and returns the drones found, in the same order. IDs that don't
+        match a drone, or aren't valid IDs, are left out."""
+        res = []
+        for q in queries:
+            try:
+                d = self.get(q)
+            except RuntimeError:
+                continue
+            if d is not None:
+                res.append(d)
+        return res
+
+    def controllers_of(self, drone: RegisteredDrone) -> Set[int]:
+        """Discord IDs on `drone`'s access list."""
+        access = self.controllers.get(int(drone["discordid"]))
+        if access is None:  # Not in the registry, read the document itself
+            access = {int(i) for i in drone.get("access") or ()}
+        return access
+
+    def controlled_by(self, discordid: int) -> Set[int]:
+        """Discord IDs of the drones whose access lists `discordid` is on."""
+        return self.controlled.get(int(discordid), set())
+
+    def __len__(self):
+        return len(self._keys)
+
+
 class _StorageBackend:
+    """Facade over the storage engine. Backend calls run on one storage thread, and writes on the loop are batched
+    for `flush_window` seconds. Async code should use the a* methods."""
+
     def __init__(self):
-        self.backend = FileBackend("db")
-        self.backend.autocommit = True
+        self.backend = None
+        self.drones = DroneRegistry()
+        self.flush_window = 0.5
+        self.retry_window = 5
+        self.logger = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="storage")
+        # (type name, pk) -> (op, the live document, a copy of it as queued)
+        self._pending: Dict[Tuple[str, str], Tuple[str, Document, Document]] = {}
+        self._inflight: Dict[Tuple[str, str], Tuple[str, Document, Document]] = {}
+        self._flush_handle = None
+        self._flush_loop = None
+        self.open()
 
+    def open(self, kind: str = "file", path: Optional[str] = None):
+        """Selects the storage engine. "file" is blitzdb's FileBackend (one JSON file per object under db/), "sqlite"
+        a single indexed database which is populated from db/ the first time it is opened."""
+        self.flush()
+        self.call(self._open, kind, path)
 
-Storage = _StorageBackend()
+    def _open(self, kind: str, path: Optional[str]):
+        if kind == "file":
+            backend = FileBackend(path or "db")
+            backend.autocommit = True
+        elif kind == "sqlite":
+            from util.sqlite_backend import SqliteBackend
 
+            backend = SqliteBackend(path or os.path.join("db", "droneos.sqlite3"))
+            backend.migrate_from("db", [RegisteredDrone, DroneChannel])
+        else:
+            raise RuntimeError(f"Unknown storage backend {kind}")
+        self.backend = backend
+        self.drones.load(backend)
 
-def get_drone(query: int) -> Optional[RegisteredDrone]:
-    if len(str(query)) == 4:
+    def call(self, fn: Callable, *args) -> Any:
+        """Runs `fn(*args)` on the storage thread and waits for the result."""
         try:
-            db_drone = Storage.backend.get(RegisteredDrone, {"droneid": str(query)})
-        except RegisteredDrone.DoesNotExist:
-            return None
-        return db_drone
-    elif len(str(query)) >= 10:
+            future = self._executor.submit(fn, *args)
+        except RuntimeError:  # Interpreter shutdown, nothing else can be touching the backend now
+            return fn(*args)
+        return future.result()
+
+    async def acall(self, fn: Callable, *args) -> Any:
+        """Runs `fn(*args)` on the storage thread without blocking the event loop."""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    @staticmethod
+    def _key(doc: Document) -> Tuple[str, str]:
+        return type(doc).__name__, doc.pk
+
+    def _queue(self, op: str, doc: Document):
+        if doc.pk is None:
+            doc.autogenerate_pk()
+        # Index the document before it's written so readers on the event loop see it straight away.
+        if isinstance(doc, RegisteredDrone):
+            if op == "save":
+                self.drones.put(doc)
+            else:
+                self.drones.discard(doc)
+        # The storage thread writes a copy, as cogs keep changing the live document on the loop.
+        queued = type(doc)(copy.deepcopy(doc.attributes))
+        self._pending.pop(self._key(doc), None)
+        self._pending[self._key(doc)] = (op, doc, queued)
+
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.flush()
+            return
+        self._arm(loop, self.flush_window)
+
+    def _arm(self, loop: asyncio.AbstractEventLoop, delay: float):
+        if self._flush_handle is None or self._flush_loop is not loop:
+            self._flush_loop = loop
+            self._flush_handle = loop.call_later(
+                delay, lambda: asyncio.ensure_future(self._flush_later())
+            )
+
+    async def _flush_later(self):
         try:
-            db_drone = Storage.backend.get(RegisteredDrone, {"discordid": query})
-        except RegisteredDrone.DoesNotExist:
-            return None
-        return db_drone
-    else:
-        raise RuntimeError("Invalid drone ID")
+            await self.aflush()
+        except Exception:
+            if self.logger:
+                self.logger.exception(
+                    f"storage: committing queued writes failed, retrying in {self.retry_window}s"
+                )
+
+    def _take_batch(self) -> Dict[Tuple[str, str], Tuple[str, Document, Document]]:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+        self._flush_handle = None
+        batch, self._pending = self._pending, {}
+        self._inflight.update(batch)
+        return batch
+
+    def _settle(self, batch: dict, ok: bool):
+        for k, v in batch.items():
+            if self._inflight.get(k) is v:
+                del self._inflight[k]
+            if not ok and k not in self._pending:
+                self._pending[k] = v  # Retried by the next flush
+
+    def _commit(self, batch: dict):
+        backend = self.backend
+        autocommit = backend.autocommit
+        backend.autocommit = False
+        try:
+            backend.begin()
+            for op, _, doc in batch.values():
+                if op == "save":
+                    backend.save(doc)
+                else:
+                    backend.delete(doc)
+            backend.commit()
+        except Exception:
+            backend.rollback()
+            raise
+        finally:
+            backend.autocommit = autocommit
+
+    def flush(self):
+        """Commits every queued write now, blocking until it is on disk."""
+        if not self._pending:
+            return
+        batch = self._take_batch()
+        try:
+            self.call(self._commit, batch)
+        except Exception:
+            self._settle(batch, False)
+            raise
+        self._settle(batch, True)
+
+    async def aflush(self):
+        if not self._pending:
+            return
+        batch = self._take_batch()
+        try:
+            await self.acall(self._commit, batch)
+        except Exception:
+            self._settle(batch, False)
+            self._arm(asyncio.get_running_loop(), self.retry_window)
+            raise
+        self._settle(batch, True)
+
+    def _overlay(self, cls: Type[Document], query: dict, docs: List[Document]) -> List[Document]:
+        """Applies queued and in-flight writes on top of what the backend returned for `query`."""
+        if not self._pending and not self._inflight:
+            return docs
+        from util.sqlite_backend import match
+
+        queued = {**self._inflight, **self._pending}
+        res = {d.pk: d for d in docs if (cls.__name__, d.pk) not in queued}
+        for (name, pk), (op, doc, _) in queued.items():
+            if name == cls.__name__ and op == "save" and match(doc.attributes, query):
+                res[pk] = doc
+        return list(res.values())
+
+    def save(self, doc: Document):
+        """Writes `doc` to the backend, keeping the drone registry in step. Use this rather than backend.save."""
+        self._queue("save", doc)
+
+    async def asave(self, doc: Document):
+        self._queue("save", doc)
+
+    def delete(self, doc: Document):
+        self._queue("delete", doc)
+
+    async def adelete(self, doc: Document):
+        self._queue("delete", doc)
+
+    def filter(self, cls: Type[Document], query: dict) -> List[Document]:
+        docs = self.call(lambda: list(self.backend.filter(cls, query)))
+        return self._overlay(cls, query, docs)
+
+    async def afilter(self, cls: Type[Document], query: dict) -> List[Document]:
+        docs = await self.acall(lambda: list(self.backend.filter(cls, query)))
+        return self._overlay(cls, query, docs)
+
+    def close(self):
+        """Commits whatever is still queued and stops the storage thread. Registered in DroneOS.atshutdown."""
+        self.flush()
+        self._executor.shutdown(wait=True)
+
+
+Storage = _StorageBackend()
+
+
+def get_drone(query: Union[int, str]) -> Optional[RegisteredDrone]:
+    """Looks a drone up by its 4 character drone ID or its Discord ID. Served from the drone registry."""
+    return Storage.drones.get(query)
+
+
+async def aget_drone(query: Union[int, str]) -> Optional[RegisteredDrone]:
+    """Async twin of get_drone. The registry is in memory, so this never waits on the storage thread."""
+    return Storage.drones.get(query)
+
+
+def get_drones(queries: Iterable[Union[int, str]]) -> List[RegisteredDrone]:
+    """Resolves a mixed list of drone IDs and Discord IDs in one go, in input order, skipping unknown ones. Served
+    from the drone registry, so no backend query is made however long the list is."""
+    return Storage.drones.get_many(queries)
+
+
+async def aget_drones(queries: Iterable[Union[int, str]]) -> List[RegisteredDrone]:
+    return Storage.drones.get_many(queries)
+
+
+def _one_channel(docs: List[DroneChannel]) -> Optional[DroneChannel]:
+    if len(docs) > 1:
+        raise DroneChannel.MultipleDocumentsReturned
+    return docs[0] if docs else None
 
 
 def get_channel(query: dict) -> Optional[DroneChannel]:
-    try:
-        db_drone = Storage.backend.get(DroneChannel, query)
-    except DroneChannel.DoesNotExist:
-        return None
-    else:
-        return db_drone
+    return _one_channel(Storage.filter(DroneChannel, query))
+
+
+async def aget_channel(query: dict) -> Optional[DroneChannel]:
+    return _one_channel(await Storage.afilter(DroneChannel, query))
@@ -0,0 +1,186 @@
+import inspect
+import logging
+import os
+import sys
+import time
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from functools import wraps
+from typing import Dict, List, Optional
+
+# Facade and registry methods that are timed, and what they're reported as.
+STORAGE_OPS = ("save", "asave", "delete", "adelete", "filter", "afilter", "flush", "aflush")
+REGISTRY_OPS = ("get", "get_many", "controllers_of", "controlled_by")
+
+# Frames in these files are the facade and the profiler itself, never the caller.
+_SKIP = tuple(os.path.join("util", f) for f in ("storage.py", "storage_profile.py"))
+
+_pass: ContextVar[Optional["_Pass"]] = ContextVar("storage_pass", default=None)
+_inside: ContextVar[bool] = ContextVar("storage_inside", default=False)
+
+profiler: Optional["StorageProfiler"] = None
+
+
+class OpStats:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.callers: Dict[str, int] = {}
+
+    def add(self, seconds: float, caller: Optional[str] = None, count: int = 1):
+        self.count += count
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        if caller:
+            self.callers[caller] = self.callers.get(caller, 0) + count
+
+    def __str__(self):
+        avg = self.total / self.count * 1000 if self.count else 0
+        return f"{self.count}x avg {avg:.2f}ms max {self.max * 1000:.2f}ms"
+
+
+class _Pass:
+    """The storage operations made by one slash command or one message going through the filter."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.ops: Dict[str, OpStats] = {}
+
+    def describe(self) -> str:
+        calls = sum(s.count for s in self.ops.values())
+        ms = sum(s.total for s in self.ops.values()) * 1000
+        ops = ", ".join(f"{op} x{s.count}" for op, s in self.ops.items())
+        return f"{self.name} made {calls} storage calls in {ms:.2f}ms: {ops}"
+
+
+def _caller() -> str:
+    f = sys._getframe(2)
+    while f is not None and f.f_code.co_filename.endswith(_SKIP):
+        f = f.f_back
+    if f is None:
+        return "?"
+    return f"{f.f_globals.get('__name__', '?')}.{f.f_code.co_name}"
+
+
+class StorageProfiler:
+    """Counts and times storage operations by caller and by pass (see scope()). Off unless installed."""
+
+    def __init__(self, storage, logger=None):
+        self.storage = storage
+        self.logger = logger
+        self.ops: Dict[str, OpStats] = {}
+        self.scopes: Dict[str, Dict[str, OpStats]] = {}  # Pass name -> operation -> stats
+        self.passes: Dict[str, int] = {}
+        self.started = time.monotonic()
+        self._originals = []
+
+    def _record(self, op: str, seconds: float, caller: str):
+        stats = self.ops.get(op)
+        if stats is None:
+            stats = self.ops[op] = OpStats()
+        stats.add(seconds, caller)
+        p = _pass.get()
+        if p is not None:
+            p.ops.setdefault(op, OpStats()).add(seconds)
+
+    def _wrap(self, op: str, fn):
+        # Only the outermost operation is counted: get_many() calling get(), or save() flushing, is one operation.
+        if inspect.iscoroutinefunction(fn):
+
+            @wraps(fn)
+            async def timed(*args, **kwargs):
+                if _inside.get():
+                    return await fn(*args, **kwargs)
+                caller = _caller()
+                token = _inside.set(True)
+                start = time.perf_counter()
+                try:
+                    return await fn(*args, **kwargs)
+                finally:
+                    self._record(op, time.perf_counter() - start, caller)
+                    _inside.reset(token)
+
+        else:
+
+            @wraps(fn)
+            def timed(*args, **kwargs):
+                if _inside.get():
+                    return fn(*args, **kwargs)
+                caller = _caller()
+                token = _inside.set(True)
+                start = time.perf_counter()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    self._record(op, time.perf_counter() - start, caller)
+                    _inside.reset(token)
+
+        return timed
+
+    def install(self):
+        global profiler
+        if self._originals:
+            return
+        for target, names, prefix in (
+            (self.storage, STORAGE_OPS, ""),
+            (self.storage.drones, REGISTRY_OPS, "drones."),
+        ):
+            for name in names:
+                self._originals.append((target, name))
+                setattr(target, name, self._wrap(prefix + name, getattr(target, name)))
+        profiler = self
+
+    def uninstall(self):
+        global profiler
+        for target, name in self._originals:
+            delattr(target, name)  # Drops the instance attribute, uncovering the class's method
+        self._originals = []
+        if profiler is self:
+            profiler = None
+
+    def reset(self):
+        self.ops.clear()
+        self.scopes.clear()
+        self.passes.clear()
+        self.started = time.monotonic()
+
+    @contextmanager
+    def scope(self, name: str):
+        if _pass.get() is not None:  # Already inside a pass, which gets the credit
+            yield
+            return
+        p = _Pass(name)
+        token = _pass.set(p)
+        try:
+            yield
+        finally:
+            _pass.reset(token)
+            self.passes[name] = self.passes.get(name, 0) + 1
+            by_op = self.scopes.setdefault(name, {})
+            for op, stats in p.ops.items():
+                by_op.setdefault(op, OpStats()).add(stats.total, count=stats.count)
+            if p.ops and self.logger and self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug("storage: %s", p.describe())
+
+    def summary(self, top: int = 3) -> List[str]:
+        """Human readable totals: each operation with its busiest callers, then what each kind of pass costs."""
+        lines = [f"storage profile over {time.monotonic() - self.started:.0f}s"]
+        for op, stats in sorted(self.ops.items(), key=lambda i: -i[1].total):
+            callers = sorted(stats.callers.items(), key=lambda i: -i[1])[:top]
+            lines.append(f"{op}: {stats} from " + ", ".join(f"{c} ({n})" for c, n in callers))
+        for name, n in sorted(self.passes.items(), key=lambda i: -i[1]):
+            by_op = self.scopes.get(name, {})
+            calls = sum(s.count for s in by_op.values())
+            ms = sum(s.total for s in by_op.values()) * 1000
+            detail = ", ".join(f"{op} {s.count / n:.1f}" for op, s in by_op.items())
+            lines.append(
+                f"{name}: {n} passes, {calls / n:.1f} calls and {ms / n:.2f}ms each"
+                + (f" ({detail})" if detail else "")
+            )
+        return lines
+
+
+def scope(name: str):
+    """Attributes storage operations in the enclosed block to the pass `name`, when profiling is on."""
+    return profiler.scope(name) if profiler is not None else nullcontext()
@@ -0,0 +1,77 @@
+import asyncio
+import sys
+import threading
+import time
+import traceback
+from typing import Optional
+
+
+class LoopWatchdog:
+    """Tracks event loop lag, and logs the loop thread's stack when it is blocked for `threshold` seconds."""
+
+    def __init__(self, logger=None, sentry=None, threshold: float = 2.0, interval: float = 1.0):
+        self.logger = logger
+        self.sentry = sentry
+        self.threshold = threshold
+        self.interval = interval  # Heartbeat period, which is also how often an idle loop gets woken
+        self.lag = 0.0  # Lateness of the latest heartbeat
+        self.max_lag = 0.0
+        self.stalls = 0
+        self._beat = time.monotonic()
+        self._loop_thread: Optional[int] = None
+        self._stalled = False
+        self._task: Optional[asyncio.Task] = None
+        self._stop = threading.Event()
+
+    def start(self):
+        if self._task is not None or self.threshold <= 0:
+            return
+        self._loop_thread = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stop.clear()
+        self._task = asyncio.ensure_future(self._heartbeat())
+        threading.Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _heartbeat(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self.lag = max(now - expected, 0.0)
+            self.max_lag = max(self.max_lag, self.lag)
+            self._beat = now
+            if self._stalled:
+                self._stalled = False
+                if self.logger:
+                    self.logger.warning(f"watchdog: event loop was blocked for {self.lag:.3f}s")
+
+    def _watch(self):
+        while not self._stop.wait(self.interval / 2):
+            stuck = time.monotonic() - self._beat - self.interval
+            if stuck >= self.threshold and not self._stalled:
+                self._stalled = True
+                self.stalls += 1
+                self.report(stuck)
+
+    def stack(self) -> str:
+        """The loop thread's current stack, innermost call last."""
+        frame = sys._current_frames().get(self._loop_thread)
+        return "".join(traceback.format_stack(frame)) if frame else "(loop thread not found)"
+
+    def report(self, stuck: float):
+        stack = self.stack()
+        if self.logger:
+            self.logger.warning(
+                f"watchdog: event loop blocked for {stuck:.3f}s so far, in:\n{stack}"
+            )
+        if self.sentry:
+            with self.sentry.push_scope() as scope:
+                scope.set_extra("stack", stack)
+                scope.set_extra("blocked_seconds", stuck)
+                self.sentry.capture_message("Event loop blocked", level="warning")
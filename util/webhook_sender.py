@@ -0,0 +1,136 @@
+import re
+import time
+from typing import Dict, List, Optional
+
+import aiohttp
+import discord
+
+from util.dispatch import Retry
+
+_WEBHOOK_URL = re.compile(r"/webhooks/(\d+)/")
+
+
+class _Bucket:
+    """Token bucket for one webhook. Starts from Discord's documented webhook limit and is corrected from the
+    X-RateLimit-* headers of every response."""
+
+    def __init__(self, limit: int, per: float):
+        self.limit = limit
+        self.per = per
+        self.remaining = limit
+        self.reset_at = 0.0
+
+    def wait_time(self, now: float) -> float:
+        if self.remaining > 0 or now >= self.reset_at:
+            return 0.0
+        return self.reset_at - now
+
+    def available(self, now: float) -> int:
+        return self.limit if now >= self.reset_at else self.remaining
+
+    def take(self, now: float):
+        if now >= self.reset_at:
+            self.remaining = self.limit
+            self.reset_at = now + self.per
+        self.remaining -= 1
+
+    def update(self, limit: Optional[str], remaining: str, reset_after: str, now: float):
+        if limit is not None:
+            self.limit = int(limit)
+        self.remaining = int(remaining)
+        self.reset_at = now + float(reset_after)
+
+
+class Throttled(Retry):
+    """Raised by WebhookSender.send when the webhook's bucket is empty, with the seconds until it refills."""
+
+
+class WebhookSender:
+    """Sends webhook messages through a per-webhook token bucket kept in step with the rate limit headers."""
+
+    def __init__(self, limit: int = 5, per: float = 2.0, logger=None):
+        self.limit = limit
+        self.per = per
+        self.logger = logger
+        self.buckets: Dict[int, _Bucket] = {}
+        self.sent = 0
+        self.rate_limited = 0  # 429s we ran into anyway
+        self.throttled = 0.0  # Seconds sends were turned away for, waiting for a bucket
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._hooks: Dict[int, discord.Webhook] = {}
+
+    def bucket(self, hook_id: int) -> _Bucket:
+        b = self.buckets.get(hook_id)
+        if b is None:
+            b = self.buckets[hook_id] = _Bucket(self.limit, self.per)
+        return b
+
+    def wait_time(self, hook_id: int) -> float:
+        """Seconds until `hook_id` can send again without being rate limited."""
+        return self.bucket(hook_id).wait_time(time.monotonic())
+
+    def pick(self, hooks: List[discord.Webhook]) -> discord.Webhook:
+        """Returns the one of `hooks` that can send soonest."""
+        now = time.monotonic()
+        best, best_key = None, None
+        for h in hooks:
+            b = self.bucket(h.id)
+            key = (b.wait_time(now), -b.available(now))
+            if best_key is None or key < best_key:
+                best, best_key = h, key
+        return best
+
+    async def _on_request_end(self, session, ctx, params: aiohttp.TraceRequestEndParams):
+        m = _WEBHOOK_URL.search(params.url.path + "/")
+        if not m:
+            return
+        headers = params.response.headers
+        remaining = headers.get("X-RateLimit-Remaining")
+        reset_after = headers.get("X-RateLimit-Reset-After")
+        if remaining is not None and reset_after is not None:
+            self.bucket(int(m.group(1))).update(
+                headers.get("X-RateLimit-Limit"), remaining, reset_after, time.monotonic()
+            )
+        if params.response.status == 429:
+            self.rate_limited += 1
+
+    def partial(self, hook_id: int, token: str) -> discord.Webhook:
+        """Returns a webhook for `hook_id` that sends through this sender's own HTTP session."""
+        bound = self._hooks.get(hook_id)
+        if bound is None or bound.token != token:
+            if self._session is None:
+                trace = aiohttp.TraceConfig()
+                trace.on_request_end.append(self._on_request_end)
+                self._session = aiohttp.ClientSession(trace_configs=[trace])
+            bound = self._hooks[hook_id] = discord.Webhook.partial(
+                hook_id, token, session=self._session
+            )
+        return bound
+
+    def _bind(self, hook: discord.Webhook) -> discord.Webhook:
+        # Webhooks fetched from a channel share the bot's HTTP session, so send through our own copy instead
+        # to see the response headers. Anything we can't rebind (no token) is used as it is.
+        if not isinstance(hook, discord.Webhook) or not hook.token:
+            return hook
+        return self.partial(hook.id, hook.token)
+
+    async def send(self, hook: discord.Webhook, **kwargs):
+        """Sends through `hook`, or raises Throttled without sending if its bucket is empty. The dispatcher then
+        puts the message back in its channel's queue rather than holding a worker while the bucket refills."""
+        b = self.bucket(hook.id)
+        now = time.monotonic()
+        wait = b.wait_time(now)
+        if wait > 0:
+            self.throttled += wait
+            if self.logger:
+                self.logger.debug("webhook %s: throttled for %.2fs", hook.id, wait)
+            raise Throttled(wait)
+        b.take(now)
+        self.sent += 1
+        return await self._bind(hook).send(**kwargs)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+        self._hooks.clear()
@@ -0,0 +1,287 @@
+import asyncio
+import multiprocessing
+from typing import List, NamedTuple, Optional, Tuple
+
+import discord
+from discord.http import HTTPClient
+
+import util
+from util import log, metrics
+from util.delete_batcher import DeleteBatcher
+from util.dispatch import ChannelDispatcher
+from util.filter_utils import decide, relay_content, Action
+from util.reloader import Reloader
+from util.webhook_sender import WebhookSender
+
+
+class FilterRecord(NamedTuple):
+    """Everything a filter worker needs to handle one message, looked up by the gateway process. Plain data only, so
+    it pickles small and the worker never touches storage or the gateway cache."""
+
+    channel_id: int
+    message_id: int
+    content: str
+    author_name: str
+    avatar_url: str
+    drone: Optional[dict]  # The author's drone record
+    ssh_drone: Optional[dict]  # The drone the author is in direct control of
+    ssh_name: Optional[str]  # Name and avatar to relay a redirected message under
+    ssh_avatar: Optional[str]
+    channel_conf: dict
+    reply: Optional[dict]  # Reply embed, as Embed.to_dict()
+    hooks: List[Tuple[int, str]]  # The channel's webhooks as (id, token)
+
+
+class FilterResult(NamedTuple):
+    """What a worker did with a FilterRecord, sent back so the gateway process's metrics count it."""
+
+    action: Optional[str]  # Action value, None for a result that only carries stage timings
+    hive: Optional[str]
+    stages: List[Tuple[str, float]]  # (stage, seconds) timed in the worker since its previous result
+
+
+class _RemoteChannel:
+    """Just enough of a TextChannel for DeleteBatcher, backed by a bare HTTP client."""
+
+    def __init__(self, http: HTTPClient, channel_id: int):
+        self.id = channel_id
+        self.http = http
+
+    async def delete_messages(self, msgs: list):
+        if len(msgs) == 1:
+            await msgs[0].delete()
+        else:
+            await self.http.delete_messages(self.id, [m.id for m in msgs])
+
+    def __str__(self):
+        return f"channel {self.id}"
+
+
+class _RemoteMessage:
+    def __init__(self, channel: _RemoteChannel, message_id: int):
+        self.id = message_id
+        self.channel = channel
+
+    async def delete(self):
+        await self.channel.http.delete_message(self.channel.id, self.id)
+
+
+class FilterWorker:
+    """The policy half of the filter cog's message handler, run in a worker process: decides what to do with a
+    FilterRecord and sends the relay and delete itself."""
+
+    def __init__(
+        self,
+        http: HTTPClient,
+        sender: WebhookSender,
+        deleter: DeleteBatcher,
+        logger=None,
+        results=None,
+    ):
+        self.http = http
+        self.sender = sender
+        self.deleter = deleter
+        self.logger = logger
+        self.results = results  # Queue for a FilterResult per handled record
+        self._channels = {}
+
+    def report(self, action: Optional[str] = None, hive: Optional[str] = None):
+        if self.results is not None:
+            self.results.put(FilterResult(action, hive, metrics.take_stages()))
+
+    def _message(self, rec: FilterRecord) -> _RemoteMessage:
+        channel = self._channels.get(rec.channel_id)
+        if channel is None:
+            channel = self._channels[rec.channel_id] = _RemoteChannel(self.http, rec.channel_id)
+        return _RemoteMessage(channel, rec.message_id)
+
+    async def handle(self, rec: FilterRecord):
+        decision = decide(rec.content, rec.drone, rec.channel_conf, rec.ssh_drone)
+        if decision.action is Action.DELETE:
+            if self.logger and decision.detail:
+                self.logger.info(
+                    "%s: %s, message %s in %s",
+                    decision.reason,
+                    decision.detail,
+                    rec.message_id,
+                    rec.channel_id,
+                )
+            elif self.logger:
+                self.logger.info(
+                    "%s: message %s in %s", decision.reason, rec.message_id, rec.channel_id
+                )
+            self.deleter.delete(self._message(rec))
+        elif decision.action in (Action.RELAY, Action.REDIRECT):
+            if decision.action is Action.REDIRECT and rec.ssh_name:
+                name, avatar = rec.ssh_name, rec.ssh_avatar
+            else:
+                name, avatar = rec.author_name, rec.avatar_url
+            hooks = [self.sender.partial(i, token) for i, token in rec.hooks]
+            content = relay_content(decision.drone, rec.content)
+            with metrics.stage("send"):
+                await self.sender.send(
+                    self.sender.pick(hooks),
+                    username=name,
+                    content=content,
+                    avatar_url=avatar,
+                    embed=discord.Embed.from_dict(rec.reply) if rec.reply else None,
+                )
+            self.deleter.delete(self._message(rec))
+        self.report(decision.action.value, rec.drone["hive"] if rec.drone else "none")
+
+
+async def _serve(
+    index: int, queue, results, token: str, logger, reload_interval: float, log_rate: float
+):
+    http = HTTPClient()
+    try:
+        await http.static_login(token)
+        worker = FilterWorker(
+            http,
+            WebhookSender(logger=logger),
+            DeleteBatcher(logger=logger),
+            log.enforcement_logger(logger, log_rate),
+            results,
+        )
+
+        async def on_error(rec: FilterRecord):
+            logger.exception(f"worker {index}: message {rec.message_id} in {rec.channel_id} failed")
+
+        dispatcher = ChannelDispatcher(worker.handle, logger=logger, on_error=on_error)
+        reloader = Reloader(logger, reload_interval)
+        reloader.start()
+        logger.info(f"worker {index}: ready")
+        loop = asyncio.get_running_loop()
+        while True:
+            rec = await loop.run_in_executor(None, queue.get)
+            if rec is None:
+                break
+            dispatcher.submit(rec.channel_id, rec)
+        await dispatcher.join()
+        dispatcher.stop()
+        reloader.stop()
+        await worker.deleter.flush()
+        worker.report()  # Timings of the last deletes
+        await worker.sender.close()
+    finally:
+        await http.close()
+
+
+def _worker_main(
+    index: int,
+    queue,
+    results,
+    token: str,
+    log_level: str,
+    log_format: str,
+    log_rate: float,
+    reload_interval: float,
+):
+    logger = log.init_logger(f"filter-{index}", log_level, log_format)
+    util.load_codes()
+    util.load_hives()
+    util.load_filters()
+    metrics.collect_stages()
+    try:
+        asyncio.run(_serve(index, queue, results, token, logger, reload_interval, log_rate))
+    finally:
+        log.stop(logger)
+
+
+class FilterWorkers:
+    """A pool of spawned filter worker processes. Each channel goes to one worker, so its messages stay in order."""
+
+    def __init__(
+        self,
+        processes: int,
+        token: str,
+        logger=None,
+        log_level: str = "INFO",
+        log_format: str = "text",
+        log_rate: float = 5,
+        reload_interval: float = 5,
+    ):
+        self.processes = processes
+        self.token = token
+        self.logger = logger
+        self.log_level = log_level
+        self.log_format = log_format
+        self.log_rate = log_rate
+        self.reload_interval = reload_interval
+        self.submitted = 0
+        self.handled = 0
+        self._ctx = multiprocessing.get_context("spawn")
+        self._queues = []
+        self._procs: List[Optional[multiprocessing.Process]] = []
+        self._results = None  # FilterResults from every worker
+        self._collector: Optional[asyncio.Task] = None
+
+    def _spawn(self, n: int) -> multiprocessing.Process:
+        p = self._ctx.Process(
+            target=_worker_main,
+            args=(
+                n,
+                self._queues[n],
+                self._results,
+                self.token,
+                self.log_level,
+                self.log_format,
+                self.log_rate,
+                self.reload_interval,
+            ),
+            name=f"filter-{n}",
+            daemon=True,
+        )
+        p.start()
+        return p
+
+    def start(self):
+        if self._procs:
+            return
+        self._queues = [self._ctx.Queue() for _ in range(self.processes)]
+        self._results = self._ctx.Queue()
+        self._procs = [self._spawn(n) for n in range(self.processes)]
+        self._collector = asyncio.ensure_future(self._collect(self._results))
+
+    def record(self, res: FilterResult):
+        """Counts a worker's result in this process's metrics, as if the message had been handled here."""
+        if res.action is not None:
+            metrics.handled.inc(res.action, res.hive)
+            self.handled += 1
+        for name, seconds in res.stages:
+            metrics.stage_seconds.observe(seconds, name)
+
+    async def _collect(self, results):
+        loop = asyncio.get_running_loop()
+        while True:
+            res = await loop.run_in_executor(None, results.get)
+            if res is None:
+                break
+            self.record(res)
+
+    def submit(self, rec: FilterRecord):
+        n = rec.channel_id % self.processes
+        if not self._procs[n].is_alive():
+            if self.logger:
+                self.logger.error(f"filter worker {n} exited ({self._procs[n].exitcode}), restarting")
+            self._procs[n] = self._spawn(n)
+        self._queues[n].put(rec)
+        self.submitted += 1
+
+    async def stop(self, timeout: float = 5):
+        """Lets each worker finish its queue and exits it, terminating any still running after `timeout` seconds.
+        The joins run in the executor, all at once, so the loop carries on meanwhile."""
+        procs, self._procs = self._procs, []
+        for q in self._queues:
+            q.put(None)
+        self._queues = []
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(loop.run_in_executor(None, p.join, timeout) for p in procs))
+        for p in procs:
+            if p.is_alive():
+                p.terminate()
+        if self._collector is not None:
+            self._results.put(None)  # After the workers' own results, which are counted first
+            await self._collector
+            self._collector = None
+        self._results = None